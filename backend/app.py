@@ -4,12 +4,34 @@
 """
 
 import os
+import sys
 import json
 import asyncio
+import atexit
+import functools
+import gzip
+import hashlib
 import re
-from typing import Dict, List, Any, Optional, Tuple
-from flask import Flask, request, jsonify, render_template, send_from_directory
+import math
+import random
+import socket
+import sqlite3
+import threading
+import time
+import unicodedata
+import urllib.parse
+import uuid
+import warnings
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Dict, List, Any, Optional, Tuple, AsyncIterator, FrozenSet, NamedTuple
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, stream_with_context, g, has_app_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import click
 import httpx
 from openai import OpenAI
 from dotenv import load_dotenv
@@ -25,14 +47,64 @@ import plotly.express as px
 from datetime import datetime, timedelta
 import requests
 
+# トークン計測用（未導入の環境では文字種ベースの推定にフォールバック）
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 高速JSONシリアライズ・Brotli圧縮用（未導入の環境では標準実装・gzipにフォールバック）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # 環境変数読み込み
 load_dotenv()
 
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """orjsonによるJSONシリアライズ（未導入時・非対応の値は標準実装にフォールバック）"""
+    
+    option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY) if orjson else 0
+    
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if orjson is None or kwargs.keys() - {"separators"}:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self.option).decode("utf-8")
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+    
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    def response(self, *args: Any, **kwargs: Any):
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            with profile_stage("response.json"):
+                body = orjson.dumps(obj, default=self.default, option=self.option | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 app = Flask(__name__, 
            template_folder='../frontend',
            static_folder='../static')
+app.json = OrjsonJSONProvider(app)
 CORS(app)
 
+# この大きさ（バイト）以上のレスポンスを圧縮する
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson", "text/html", "text/plain", "text/css", "application/javascript"}
+
 # OpenAI クライアント設定
 client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
@@ -73,63 +145,3020 @@ def format_response_text(text: str) -> str:
     text = re.sub(r'([。！？])([ア-ン])', r'\1\n\n\2', text)
     text = re.sub(r'([。！？])([A-Za-z])', r'\1\n\n\2', text)
     
-    # 連続する改行を整理
-    text = re.sub(r'\n{4,}', '\n\n\n', text)
-    text = re.sub(r'\n{3}', '\n\n', text)
+    # 連続する改行を整理
+    text = re.sub(r'\n{4,}', '\n\n\n', text)
+    text = re.sub(r'\n{3}', '\n\n', text)
+    
+    # 行の先頭と末尾の空白を除去
+    lines = [line.strip() for line in text.split('\n')]
+    
+    # 空行を適切に配置し、段落構造を改善
+    formatted_lines = []
+    for i, line in enumerate(lines):
+        if line:  # 空行でない場合
+            # 見出し行の前後に空行を追加
+            if ('■' in line or '◆' in line or '★' in line or '━' in line):
+                if formatted_lines and formatted_lines[-1]:
+                    formatted_lines.append('')
+                formatted_lines.append(line)
+                formatted_lines.append('')
+            # リスト項目の場合
+            elif line.startswith('  ▶') or line.startswith('  【'):
+                formatted_lines.append(line)
+            # 通常の文章の場合
+            else:
+                formatted_lines.append(line)
+        elif i > 0 and formatted_lines and formatted_lines[-1]:  # 前の行が空行でない場合のみ空行を追加
+            formatted_lines.append('')
+    
+    # 最終的な整形
+    result = '\n'.join(formatted_lines)
+    
+    # 先頭と末尾の余分な改行を除去
+    result = result.strip()
+    
+    # 最後に全体の構造を整える
+    result = re.sub(r'\n\n\n+', '\n\n', result)  # 3つ以上の連続改行を2つに
+    
+    return result
+
+# 呼び出し種別ごとの入力トークン予算（環境変数で上書き可能）
+PROMPT_TOKEN_BUDGETS = {
+    "chat": int(os.getenv("PROMPT_TOKEN_BUDGET_CHAT", "1500")),
+    "business_ideas": int(os.getenv("PROMPT_TOKEN_BUDGET_BUSINESS_IDEAS", "1800"))
+}
+
+_token_encodings: Dict[str, Any] = {}
+
+def _get_token_encoding(model: str):
+    """モデルに対応するtiktokenエンコーディングを取得（取得できない場合はNone）"""
+    if tiktoken is None:
+        return None
+    if model not in _token_encodings:
+        try:
+            try:
+                _token_encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _token_encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"トークナイザー読み込みエラー（推定値を使用）: {e}")
+            _token_encodings[model] = None
+    return _token_encodings[model]
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """テキストのトークン数をローカルで計測"""
+    if not text:
+        return 0
+    encoding = _get_token_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 推定: 日本語（非ASCII）は1文字≒1トークン、ASCIIは4文字≒1トークン
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+def compact_dataset_context(dataset: Dict[str, Any], notes_limit: int = 160) -> Dict[str, Any]:
+    """LLMに渡すデータセット情報を圧縮（説明文の切り詰め・タグの重複除去）"""
+    notes = re.sub(r'\s+', ' ', dataset.get("notes") or "").strip()
+    if len(notes) > notes_limit:
+        notes = notes[:notes_limit] + "…"
+    
+    tags = []
+    for tag in dataset.get("tags", []) or []:
+        name = tag.get("display_name", "") if isinstance(tag, dict) else str(tag)
+        if name and name not in tags:
+            tags.append(name)
+    
+    compact = {"title": dataset.get("title", "")}
+    if notes:
+        compact["notes"] = notes
+    if tags:
+        compact["tags"] = tags
+    organization = dataset.get("organization")
+    if isinstance(organization, dict) and organization.get("title"):
+        compact["org"] = organization["title"]
+    compact["resources"] = len(dataset.get("resources", []) or [])
+    return compact
+
+class PromptBuilder:
+    """入力トークン予算内に収まるよう、優先度の低いセクションから削ってプロンプトを組み立てる"""
+    
+    def __init__(self, budget_tokens: int, model: str = "gpt-4o-mini", reserved_tokens: int = 0):
+        self.budget_tokens = budget_tokens
+        self.model = model
+        self.reserved_tokens = reserved_tokens
+        self.sections: List[Dict[str, Any]] = []
+        self.baseline_tokens: Optional[int] = None
+        self.stats: Dict[str, Any] = {}
+    
+    def add(self, name: str, text: str, priority: int = 50, truncatable: bool = False,
+            required: bool = False) -> "PromptBuilder":
+        """セクションを追加（priorityが低いものから削除・切り詰め対象になる。requiredは削らない）"""
+        if text:
+            self.sections.append({
+                "name": name,
+                "text": text,
+                "original_text": text,
+                "priority": priority,
+                "truncatable": truncatable,
+                "required": required,
+                "tokens": count_tokens(text, self.model)
+            })
+        return self
+    
+    def set_baseline(self, text: str) -> "PromptBuilder":
+        """圧縮前のプロンプトを登録し、削減トークン数の算出に使う"""
+        self.baseline_tokens = count_tokens(text, self.model) + self.reserved_tokens
+        return self
+    
+    def build(self) -> str:
+        """予算内に収めたプロンプト文字列を返す"""
+        available = self.budget_tokens - self.reserved_tokens
+        total = sum(section["tokens"] for section in self.sections)
+        if self.baseline_tokens is None:
+            self.baseline_tokens = total + self.reserved_tokens
+        trimmed = []
+        
+        # 優先度の低い順（同順位なら後ろのセクションから）に削る。必須セクションは対象外
+        for section in sorted(self.sections, key=lambda x: (x["priority"], -self.sections.index(x))):
+            if section["required"]:
+                continue
+            while total > available and section["tokens"] > 0:
+                overflow = total - available
+                if section["truncatable"] and section["tokens"] > overflow + 1:
+                    keep_ratio = (section["tokens"] - overflow - 1) / section["tokens"]
+                    text = section["text"].rstrip("…")
+                    section["text"] = text[:int(len(text) * keep_ratio)] + "…"
+                    new_tokens = count_tokens(section["text"], self.model)
+                    action = "truncated"
+                else:
+                    section["text"] = ""
+                    new_tokens = 0
+                    action = "dropped"
+                total -= section["tokens"] - new_tokens
+                section["tokens"] = new_tokens
+            if section["text"] != section["original_text"]:
+                trimmed.append({"section": section["name"], "action": "truncated" if section["text"] else "dropped"})
+            if total <= available:
+                break
+        
+        prompt = "\n".join(section["text"] for section in self.sections if section["text"])
+        input_tokens = count_tokens(prompt, self.model) + self.reserved_tokens
+        self.stats = {
+            "input_tokens": input_tokens,
+            "budget_tokens": self.budget_tokens,
+            "baseline_tokens": self.baseline_tokens,
+            "tokens_saved": max(0, self.baseline_tokens - input_tokens),
+            "trimmed_sections": trimmed,
+            "token_counter": "tiktoken" if _get_token_encoding(self.model) is not None else "estimate"
+        }
+        return prompt
+
+class LLMOverloadedError(Exception):
+    """LLM呼び出しの受付上限を超えたため、リクエストを処理できないことを表す例外"""
+    
+    def __init__(self, reason: str, retry_after: float, status_code: int = 503):
+        super().__init__(f"LLM呼び出しが混雑しています ({reason})")
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.status_code = status_code
+
+class LLMAdmissionController:
+    """LLM呼び出しの同時実行数とトークンレートを制限し、超過分は待ち行列で待たせるか即座に拒否する"""
+    
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 16, queue_timeout: float = 20.0,
+                 tokens_per_minute: int = 0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.tokens_per_minute = max(0, tokens_per_minute)  # 0はトークン予算なし
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._tokens = float(self.tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._avg_call_seconds = 5.0  # 呼び出し所要時間の指数移動平均（Retry-Afterの推定に使用）
+        self._peak_queue_depth = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        # 非同期側から枠待ち・ストリーム読み取りを行うスレッド（待ち行列の分だけ同時にブロックし得る）
+        self._threads = ThreadPoolExecutor(max_workers=self.max_concurrency + self.max_queue + 1,
+                                           thread_name_prefix="llm-io")
+        self.counters = {
+            "admitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "shed_queue_full": 0,
+            "shed_timeout": 0,
+            "shed_token_budget": 0
+        }
+    
+    def _refill(self, now: float) -> None:
+        if self.tokens_per_minute:
+            elapsed = now - self._refilled_at
+            self._tokens = min(float(self.tokens_per_minute), self._tokens + elapsed * self.tokens_per_minute / 60.0)
+        self._refilled_at = now
+    
+    def _token_wait_seconds(self, tokens: int) -> float:
+        """トークン予算が必要量まで回復するまでの秒数"""
+        if not self.tokens_per_minute:
+            return 0.0
+        deficit = min(tokens, self.tokens_per_minute) - self._tokens
+        return max(0.0, deficit * 60.0 / self.tokens_per_minute)
+    
+    def _queue_retry_after(self) -> float:
+        """待ち行列が空くまでのおおよその秒数"""
+        return self._avg_call_seconds * (self._waiting + 1) / self.max_concurrency
+    
+    def _is_saturated(self) -> bool:
+        return self._in_flight >= self.max_concurrency and self._waiting >= self.max_queue
+    
+    def check_admission(self) -> None:
+        """待ち行列が満杯なら処理を始める前に即座に拒否する（LLMを使うAPIの入口で呼ぶ）"""
+        with self._condition:
+            if self._is_saturated():
+                self.counters["shed_queue_full"] += 1
+                raise LLMOverloadedError("queue_full", self._queue_retry_after(), 503)
+    
+    def acquire(self, estimated_tokens: int) -> float:
+        """実行枠とトークン予算を確保する。確保できなければLLMOverloadedErrorを送出。待ち時間（秒）を返す"""
+        started_at = time.monotonic()
+        deadline = started_at + self.queue_timeout
+        with self._condition:
+            if (self._in_flight >= self.max_concurrency or self._waiting) and self._waiting >= self.max_queue:
+                self.counters["shed_queue_full"] += 1
+                raise LLMOverloadedError("queue_full", self._queue_retry_after(), 503)
+            
+            self._waiting += 1
+            self._peak_queue_depth = max(self._peak_queue_depth, self._waiting)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    token_wait = self._token_wait_seconds(estimated_tokens)
+                    if self._in_flight < self.max_concurrency and token_wait == 0:
+                        break
+                    remaining = deadline - now
+                    if token_wait > remaining:
+                        # 待ってもトークン予算が回復しないので、待たせずに拒否
+                        self.counters["shed_token_budget"] += 1
+                        raise LLMOverloadedError("token_budget", token_wait, 429)
+                    if remaining <= 0:
+                        self.counters["shed_timeout"] += 1
+                        raise LLMOverloadedError("queue_timeout", self._queue_retry_after(), 503)
+                    self._condition.wait(min(remaining, token_wait) if token_wait else remaining)
+            finally:
+                self._waiting -= 1
+            
+            if self.tokens_per_minute:
+                self._tokens -= min(estimated_tokens, self.tokens_per_minute)
+            self._in_flight += 1
+            self.counters["admitted"] += 1
+            waited = time.monotonic() - started_at
+            self._total_wait_seconds += waited
+            self._max_wait_seconds = max(self._max_wait_seconds, waited)
+            return waited
+    
+    def release(self, elapsed_seconds: float, estimated_tokens: int = 0,
+                actual_tokens: Optional[int] = None, failed: bool = False) -> None:
+        """実行枠を返却し、実際の使用トークン数が分かれば予算の見積もり差分を精算する"""
+        with self._condition:
+            self._in_flight -= 1
+            self.counters["failed" if failed else "completed"] += 1
+            self._avg_call_seconds = 0.8 * self._avg_call_seconds + 0.2 * elapsed_seconds
+            if self.tokens_per_minute and actual_tokens is not None:
+                self._tokens = min(float(self.tokens_per_minute),
+                                   self._tokens + min(estimated_tokens, self.tokens_per_minute) - actual_tokens)
+            self._condition.notify_all()
+    
+    def release_unused(self, estimated_tokens: int) -> None:
+        """呼び出しを始める前に不要になった枠を返却し、差し引いたトークン予算も戻す"""
+        with self._condition:
+            self._in_flight -= 1
+            self.counters["cancelled"] += 1
+            if self.tokens_per_minute:
+                self._tokens = min(float(self.tokens_per_minute),
+                                   self._tokens + min(estimated_tokens, self.tokens_per_minute))
+            self._condition.notify_all()
+    
+    def submit(self, func, *args, **kwargs) -> Future:
+        """ブロッキング呼び出しを専用スレッドで実行する（ContextVarは呼び出し元のものを引き継ぐ）"""
+        return self._threads.submit(copy_context().run, func, *args, **kwargs)
+    
+    async def acquire_async(self, estimated_tokens: int) -> float:
+        """acquireの非同期版。待機中にキャンセルされた場合は、後から確保できた枠をその場で返却する"""
+        future = self.submit(self.acquire, estimated_tokens)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # スレッドはキャンセルできないため、確保が完了した時点で枠を返す
+            def _give_back(done: Future) -> None:
+                if not done.cancelled() and done.exception() is None:
+                    self.release_unused(estimated_tokens)
+            future.add_done_callback(_give_back)
+            raise
+    
+    @contextmanager
+    def slot(self, estimated_tokens: int):
+        """実行枠を確保している間だけLLMを呼び出すためのコンテキストマネージャ"""
+        self.acquire(estimated_tokens)
+        started_at = time.monotonic()
+        lease = {"actual_tokens": None}
+        failed = False
+        try:
+            yield lease
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.release(time.monotonic() - started_at, estimated_tokens, lease["actual_tokens"], failed)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """キュー長・拒否数などのメトリクス"""
+        with self._condition:
+            self._refill(time.monotonic())
+            admitted = self.counters["admitted"]
+            return {
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "peak_queue_depth": self._peak_queue_depth,
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "queue_timeout_seconds": self.queue_timeout,
+                "tokens_per_minute": self.tokens_per_minute,
+                "tokens_available": round(self._tokens) if self.tokens_per_minute else None,
+                "avg_call_seconds": round(self._avg_call_seconds, 3),
+                "avg_wait_seconds": round(self._total_wait_seconds / admitted, 3) if admitted else 0.0,
+                "max_wait_seconds": round(self._max_wait_seconds, 3),
+                "shed_total": sum(v for k, v in self.counters.items() if k.startswith("shed_")),
+                **self.counters
+            }
+
+llm_limiter = LLMAdmissionController(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("LLM_MAX_QUEUE", "16")),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "20")),
+    tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+)
+
+class RequestProfile:
+    """1リクエスト分のサンプリングプロファイル（スタックのサンプル）と処理段階ごとの所要時間"""
+    
+    # サンプルのスタックから所要時間の内訳を判定するための手がかり（上から順に判定）
+    CATEGORY_RULES = [
+        ("llm", ("openai", "create_chat_completion", "_stream_business_ideas")),
+        ("ckan", ("httpx", "httpcore", "_load_upstream", "_fetch_adaptive", "search_datasets")),
+        ("extraction", ("extract_numbers_from_text", "extract_series", "extract_age_table", "parse_csv", "sre_", "re/__init__")),
+        ("json", ("orjson", "json/", "project_fields", "exclude_fields", "apply_response_view"))
+    ]
+    WAITING_FUNCTIONS = ("select", "poll", "epoll", "wait", "acquire", "_run_once", "sleep")
+    
+    def __init__(self, request_id: str, method: str, path: str, interval: float):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.started_at = datetime.now()
+        self.samples: List[Tuple[Tuple[str, str, int], ...]] = []
+        self.stages: List[Tuple[str, float, float]] = []  # (名前, 開始からの秒数, 所要秒数)
+        self.status_code: Optional[int] = None
+        self.elapsed: Optional[float] = None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{request_id}", daemon=True)
+    
+    def start(self) -> None:
+        self._sampler.start()
+    
+    def stop(self) -> None:
+        self.elapsed = time.perf_counter() - self.started
+        self._stop.set()
+        self._sampler.join(timeout=1.0)
+    
+    def _sample(self) -> None:
+        """リクエストを処理しているスレッドのスタックを一定間隔で記録（イベントループ上のコルーチンも含む）"""
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < 128:
+                code = frame.f_code
+                stack.append((getattr(code, "co_qualname", code.co_name), code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.samples.append(tuple(reversed(stack)))
+    
+    def record_stage(self, name: str, started: float, duration: float) -> None:
+        self.stages.append((name, started - self.started, duration))
+    
+    def _categorize(self, stack: Tuple[Tuple[str, str, int], ...]) -> str:
+        if stack[-1][0].rsplit(".", 1)[-1] in self.WAITING_FUNCTIONS:
+            return "waiting"
+        for category, hints in self.CATEGORY_RULES:
+            if any(hint in name or hint in filename for name, filename, _ in stack for hint in hints):
+                return category
+        return "other"
+    
+    def summary(self) -> Dict[str, Any]:
+        """段階別の所要時間、サンプルの内訳（CKAN・LLM・抽出・JSON・待機）、自己時間の長い関数"""
+        stages: Dict[str, Dict[str, float]] = {}
+        for name, _, duration in self.stages:
+            stage = stages.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += duration * 1000
+            stage["max_ms"] = max(stage["max_ms"], duration * 1000)
+        categories: Dict[str, int] = {}
+        self_time: Dict[str, int] = {}
+        for stack in self.samples:
+            category = self._categorize(stack)
+            categories[category] = categories.get(category, 0) + 1
+            leaf = f"{stack[-1][0]} ({os.path.basename(stack[-1][1])}:{stack[-1][2]})"
+            self_time[leaf] = self_time.get(leaf, 0) + 1
+        total_samples = len(self.samples) or 1
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "started_at": self.started_at.isoformat(),
+            "total_ms": round((self.elapsed or 0) * 1000, 1),
+            "sample_interval_ms": round(self.interval * 1000, 2),
+            "samples": len(self.samples),
+            "stages": {
+                name: {key: round(value, 1) if isinstance(value, float) else value for key, value in stage.items()}
+                for name, stage in sorted(stages.items(), key=lambda item: -item[1]["total_ms"])
+            },
+            "sample_breakdown": {
+                category: {"samples": count, "ratio": round(count / total_samples, 3)}
+                for category, count in sorted(categories.items(), key=lambda item: -item[1])
+            },
+            "top_self_time": [
+                {"frame": frame, "samples": count, "ratio": round(count / total_samples, 3)}
+                for frame, count in sorted(self_time.items(), key=lambda item: -item[1])[:20]
+            ]
+        }
+    
+    def speedscope(self) -> Dict[str, Any]:
+        """speedscope（https://www.speedscope.app）で開けるサンプリング形式のプロファイル"""
+        frames: List[Dict[str, Any]] = []
+        frame_index: Dict[Tuple[str, str, int], int] = {}
+        samples = []
+        for stack in self.samples:
+            indices = []
+            for name, filename, line in stack:
+                key = (name, filename, line)
+                if key not in frame_index:
+                    frame_index[key] = len(frames)
+                    frames.append({"name": name, "file": filename, "line": line})
+                indices.append(frame_index[key])
+            samples.append(indices)
+        interval_ms = self.interval * 1000
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"{self.method} {self.path} ({self.request_id})",
+            "exporter": "kanazawa-ai-profiler",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{self.method} {self.path}",
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": len(samples) * interval_ms,
+                "samples": samples,
+                "weights": [interval_ms] * len(samples)
+            }]
+        }
+    
+    def write(self, directory: str) -> Tuple[str, str]:
+        """speedscopeファイルと段階別サマリーをリクエストIDのファイル名で保存"""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for suffix, document in (("speedscope.json", self.speedscope()), ("summary.json", self.summary())):
+            path = os.path.join(directory, f"{self.request_id}.{suffix}")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(document, f, ensure_ascii=False)
+            paths.append(path)
+        return paths[0], paths[1]
+
+_active_profile: ContextVar[Optional[RequestProfile]] = ContextVar("active_profile", default=None)
+
+class profile_stage:
+    """処理段階の所要時間をプロファイル中のリクエストに記録する（プロファイルしていなければ何もしない）"""
+    
+    __slots__ = ("name", "profile", "started")
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.profile = None
+    
+    def __enter__(self):
+        self.profile = _active_profile.get()
+        if self.profile is not None:
+            self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        if self.profile is not None:
+            self.profile.record_stage(self.name, self.started, time.perf_counter() - self.started)
+
+# リクエスト単位のプロファイリング（X-Profileヘッダーに管理トークンを指定するか、サンプリング率で有効化）
+PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN", "")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_INTERVAL_SECONDS = float(os.getenv("PROFILING_INTERVAL_MS", "5")) / 1000
+PROFILING_OUTPUT_DIR = os.getenv(
+    "PROFILING_OUTPUT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+)
+
+# OpenTelemetry互換のスパン（OTLPのSpanKind・StatusCodeの値）
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+SPAN_STATUS_OK = 1
+SPAN_STATUS_ERROR = 2
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+class TraceSpan:
+    """OpenTelemetryのデータモデルに沿った処理区間（trace_id・親スパン・属性・イベント・状態）"""
+    
+    __slots__ = ("name", "trace_id", "span_id", "parent_span_id", "kind", "sampled",
+                 "start_ns", "end_ns", "attributes", "events", "status_code", "status_message")
+    
+    def __init__(self, name: str, trace_id: str, parent_span_id: str = "", kind: str = "internal",
+                 sampled: bool = True, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.events: List[Tuple[str, int, Dict[str, Any]]] = []
+        self.status_code = 0
+        self.status_message = ""
+        if attributes:
+            self.set_attributes(attributes)
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        if value is None:
+            return
+        if isinstance(value, str) and len(value) > TRACING_MAX_ATTRIBUTE_LENGTH:
+            value = value[:TRACING_MAX_ATTRIBUTE_LENGTH] + "…"
+        self.attributes[key] = value
+    
+    def set_attributes(self, attributes: Dict[str, Any]) -> None:
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+    
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        self.events.append((name, time.time_ns(), attributes or {}))
+    
+    def set_error(self, error: BaseException) -> None:
+        self.status_code = SPAN_STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"[:TRACING_MAX_ATTRIBUTE_LENGTH]
+        self.add_event("exception", {"exception.type": type(error).__name__, "exception.message": str(error)})
+    
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if self.sampled:
+                span_exporter.export(self)
+    
+    @property
+    def traceparent(self) -> str:
+        """W3C Trace Contextのtraceparentヘッダー値"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+    
+    @staticmethod
+    def _otlp_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        if isinstance(value, (list, tuple)):
+            return {"arrayValue": {"values": [TraceSpan._otlp_value(item) for item in value]}}
+        return {"stringValue": str(value)}
+    
+    @classmethod
+    def _otlp_attributes(cls, attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [{"key": key, "value": cls._otlp_value(value)} for key, value in attributes.items()]
+    
+    def to_otlp(self) -> Dict[str, Any]:
+        """OTLP/JSON（ExportTraceServiceRequest内のSpan）形式"""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS.get(self.kind, 1),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": self._otlp_attributes(self.attributes),
+            "status": {"code": self.status_code}
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        if self.events:
+            span["events"] = [
+                {"name": name, "timeUnixNano": str(at), "attributes": self._otlp_attributes(attributes)}
+                for name, at, attributes in self.events
+            ]
+        return span
+
+class _NoopSpan:
+    """トレースしていないときに返す何もしないスパン"""
+    
+    __slots__ = ()
+    sampled = False
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+    
+    def set_attributes(self, attributes: Dict[str, Any]) -> None:
+        pass
+    
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        pass
+    
+    def set_error(self, error: BaseException) -> None:
+        pass
+    
+    def end(self) -> None:
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class SpanExporter:
+    """終了したスパンをまとめてOTLP/JSON形式でファイル（1行1バッチ）とコレクターに送る"""
+    
+    def __init__(self, path: str = "", collector_url: str = "", service_name: str = "kanazawa-ai",
+                 batch_size: int = 256, flush_interval: float = 2.0, max_queue: int = 10000):
+        self.path = path
+        self.collector_url = collector_url
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._spans: deque = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self.counters = {"exported": 0, "dropped": 0, "export_errors": 0}
+    
+    def export(self, span: TraceSpan) -> None:
+        with self._lock:
+            if len(self._spans) >= self.max_queue:
+                self.counters["dropped"] += 1
+                return
+            self._spans.append(span)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._worker.start()
+                atexit.register(self.flush)
+            if len(self._spans) >= self.batch_size:
+                self._wakeup.set()
+    
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def flush(self) -> int:
+        """溜まっているスパンをすべて書き出す"""
+        exported = 0
+        while True:
+            with self._lock:
+                batch = [self._spans.popleft() for _ in range(min(self.batch_size, len(self._spans)))]
+            if not batch:
+                return exported
+            document = self.document(batch)
+            try:
+                if self.path:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(document, ensure_ascii=False) + "\n")
+                if self.collector_url:
+                    requests.post(self.collector_url, json=document, timeout=5).raise_for_status()
+                self.counters["exported"] += len(batch)
+                exported += len(batch)
+            except Exception as e:
+                self.counters["export_errors"] += 1
+                print(f"スパンの送信エラー: {e}")
+    
+    def document(self, spans: List[TraceSpan]) -> Dict[str, Any]:
+        return {"resourceSpans": [{
+            "resource": {"attributes": TraceSpan._otlp_attributes({
+                "service.name": self.service_name, "process.pid": os.getpid()
+            })},
+            "scopeSpans": [{"scope": {"name": "kanazawa-ai.tracing"}, "spans": [span.to_otlp() for span in spans]}]
+        }]}
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": TRACING_ENABLED,
+            "path": self.path or None,
+            "collector_url": self.collector_url or None,
+            "queued": len(self._spans),
+            **self.counters
+        }
+
+# 分散トレーシング（OTLP/JSONでファイル・コレクターへ出力）
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1.0"))
+TRACING_MAX_ATTRIBUTE_LENGTH = int(os.getenv("TRACING_MAX_ATTRIBUTE_LENGTH", "256"))
+span_exporter = SpanExporter(
+    path=os.getenv("TRACING_EXPORT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces", "spans.jsonl")),
+    collector_url=os.getenv("TRACING_COLLECTOR_URL", ""),
+    service_name=os.getenv("TRACING_SERVICE_NAME", "kanazawa-ai")
+)
+
+_current_span: ContextVar[Optional[TraceSpan]] = ContextVar("current_span", default=None)
+
+def current_span():
+    """実行中のスパン（トレースしていなければ何もしないスパン）"""
+    return _current_span.get() or NOOP_SPAN
+
+def start_span(name: str, kind: str = "internal", attributes: Optional[Dict[str, Any]] = None,
+               traceparent: str = ""):
+    """スパンを開始する（実行中のスパンの子になる。なければtraceparentか新しいトレースのルートになる）"""
+    if not TRACING_ENABLED:
+        return NOOP_SPAN
+    parent = _current_span.get()
+    if parent is not None:
+        return TraceSpan(name, parent.trace_id, parent.span_id, kind, parent.sampled, attributes)
+    match = TRACEPARENT_PATTERN.match(traceparent.strip().lower()) if traceparent else None
+    if match:
+        return TraceSpan(name, match.group(1), match.group(2), kind, match.group(3) == "01", attributes)
+    sampled = TRACING_SAMPLE_RATE >= 1 or random.random() < TRACING_SAMPLE_RATE
+    return TraceSpan(name, os.urandom(16).hex(), "", kind, sampled, attributes)
+
+def trace_headers() -> Dict[str, str]:
+    """外部への呼び出しに付けるtraceparentヘッダー"""
+    span = _current_span.get()
+    return {"traceparent": span.traceparent} if span is not None else {}
+
+class trace_span:
+    """withブロックをスパンとして記録し、ブロック内では実行中のスパンにする（トレース無効時は何もしない）"""
+    
+    __slots__ = ("span", "token")
+    
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None, kind: str = "internal"):
+        self.span = start_span(name, kind, attributes)
+        self.token = None
+    
+    def __enter__(self):
+        if self.span is not NOOP_SPAN:
+            self.token = _current_span.set(self.span)
+        return self.span
+    
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self.token is not None:
+            _current_span.reset(self.token)
+        if exc is not None and not isinstance(exc, (GeneratorExit, asyncio.CancelledError)):
+            self.span.set_error(exc)
+        self.span.end()
+
+def traced(name: str, attributes=None):
+    """非同期関数の呼び出しをスパンとして記録するデコレータ（attributesは引数から属性を作る関数）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not TRACING_ENABLED:
+                return await func(*args, **kwargs)
+            with trace_span(name, attributes(*args, **kwargs) if attributes else None) as span:
+                result = await func(*args, **kwargs)
+                if isinstance(result, dict) and result.get("success") is False:
+                    span.status_code = SPAN_STATUS_ERROR
+                    span.status_message = str(result.get("error", ""))[:TRACING_MAX_ATTRIBUTE_LENGTH]
+                return result
+        return wrapper
+    return decorator
+
+def estimate_completion_tokens(messages: List[Dict[str, str]], max_tokens: int = 0,
+                               model: str = "gpt-4o-mini") -> int:
+    """1回の呼び出しで消費するトークン数の上限見積もり（入力＋最大出力）"""
+    return sum(count_tokens(m.get("content") or "", model) + 4 for m in messages) + (max_tokens or 0)
+
+def _chat_completion_attributes(kwargs: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    """呼び出しのトークン見積もりとスパン属性"""
+    estimated = estimate_completion_tokens(
+        kwargs.get("messages", []), kwargs.get("max_tokens", 0), kwargs.get("model", "gpt-4o-mini")
+    )
+    return estimated, {
+        "gen_ai.system": "openai",
+        "gen_ai.operation.name": "chat",
+        "gen_ai.request.model": kwargs.get("model"),
+        "gen_ai.request.max_tokens": kwargs.get("max_tokens"),
+        "llm.estimated_tokens": estimated
+    }
+
+def _completion_total_tokens(response: Any, span: Any) -> Optional[int]:
+    """APIが返した使用トークン数をスパンに記録し、合計を返す（返っていなければNone）"""
+    usage = getattr(response, "usage", None)
+    if usage is None or getattr(usage, "total_tokens", None) is None:
+        return None
+    span.set_attributes({
+        "gen_ai.usage.input_tokens": getattr(usage, "prompt_tokens", None),
+        "gen_ai.usage.output_tokens": getattr(usage, "completion_tokens", None)
+    })
+    return usage.total_tokens
+
+def create_chat_completion(**kwargs: Any):
+    """同時実行数・トークン予算の制限下でChat Completions APIを呼び出す（ストリーミング以外）"""
+    estimated, attributes = _chat_completion_attributes(kwargs)
+    with trace_span("openai.chat.completions", attributes, kind="client") as span, profile_stage("llm"):
+        queued = time.perf_counter()
+        with llm_limiter.slot(estimated) as lease, profile_stage("llm.api"):
+            span.set_attribute("llm.queue_wait_ms", round((time.perf_counter() - queued) * 1000, 1))
+            response = client.chat.completions.create(**kwargs)
+            lease["actual_tokens"] = _completion_total_tokens(response, span)
+            return response
+
+async def acreate_chat_completion(**kwargs: Any):
+    """create_chat_completionの非同期版。枠の待機とAPI呼び出しはLLM用のスレッドで行い、イベントループを塞がない
+
+    待機中にキャンセルされた場合は枠を返却してリクエストを送らない。送信済みの呼び出しは止められないため、
+    応答が戻ってから枠を返す（同時実行数の上限を守る）。
+    """
+    estimated, attributes = _chat_completion_attributes(kwargs)
+    with trace_span("openai.chat.completions", attributes, kind="client") as span, profile_stage("llm"):
+        queued = time.perf_counter()
+        await llm_limiter.acquire_async(estimated)
+        started_at = time.monotonic()
+        span.set_attribute("llm.queue_wait_ms", round((time.perf_counter() - queued) * 1000, 1))
+        call = llm_limiter.submit(client.chat.completions.create, **kwargs)
+        try:
+            with profile_stage("llm.api"):
+                response = await asyncio.wrap_future(call)
+        except asyncio.CancelledError:
+            def _settle(done: Future) -> None:
+                if done.cancelled():
+                    llm_limiter.release_unused(estimated)  # 送信前に取り消せた
+                elif done.exception() is not None:
+                    llm_limiter.release(time.monotonic() - started_at, estimated, failed=True)
+                else:
+                    llm_limiter.release(time.monotonic() - started_at, estimated,
+                                        _completion_total_tokens(done.result(), NOOP_SPAN))
+            call.add_done_callback(_settle)
+            raise
+        except BaseException:
+            llm_limiter.release(time.monotonic() - started_at, estimated, failed=True)
+            raise
+        llm_limiter.release(time.monotonic() - started_at, estimated, _completion_total_tokens(response, span))
+        return response
+
+class ResourceSummary(NamedTuple):
+    """データセットに含まれるリソースの要約"""
+    id: str
+    name: str
+    format: str
+    url: str
+    last_modified: str
+
+class DatasetRecord:
+    """解析用に正規化したデータセット情報（CKANの生データから一度だけ構築する）"""
+    
+    __slots__ = ("id", "title", "title_lower", "notes_lower", "tags", "organization",
+                 "resource_count", "resources", "metadata_modified")
+    
+    def __init__(self, id: str, title: str, notes: str = "", tags: FrozenSet[str] = frozenset(),
+                 organization: str = "", resources: Tuple[ResourceSummary, ...] = (),
+                 resource_count: Optional[int] = None, metadata_modified: str = ""):
+        self.id = id
+        self.title = title
+        self.title_lower = title.lower()
+        self.notes_lower = notes.lower()
+        self.tags = tags
+        self.organization = organization
+        self.resources = resources
+        self.resource_count = len(resources) if resource_count is None else resource_count
+        self.metadata_modified = metadata_modified
+    
+    @classmethod
+    def from_ckan(cls, dataset: Dict[str, Any]) -> "DatasetRecord":
+        """CKANのパッケージ辞書からレコードを構築"""
+        organization = dataset.get("organization")
+        resources = tuple(
+            ResourceSummary(
+                id=resource.get("id") or "",
+                name=resource.get("name") or "",
+                format=(resource.get("format") or "").lower(),
+                url=resource.get("url") or "",
+                last_modified=resource.get("last_modified") or resource.get("created") or ""
+            )
+            for resource in dataset.get("resources") or [] if isinstance(resource, dict)
+        )
+        return cls(
+            id=dataset.get("id") or "",
+            title=dataset.get("title") or "",
+            notes=dataset.get("notes") or "",
+            tags=frozenset(
+                (tag.get("display_name") or tag.get("name") or "") if isinstance(tag, dict) else str(tag)
+                for tag in dataset.get("tags") or []
+            ) - {""},
+            organization=organization.get("title", "") if isinstance(organization, dict) else "",
+            resources=resources,
+            resource_count=dataset.get("num_resources", len(resources)) if not resources else None,
+            metadata_modified=dataset.get("metadata_modified") or ""
+        )
+    
+    @classmethod
+    def from_ckan_list(cls, datasets: List[Any]) -> List["DatasetRecord"]:
+        """複数の検索結果をレコード化（同一IDのデータセットは同じレコードを共有）"""
+        records: List[DatasetRecord] = []
+        by_id: Dict[str, DatasetRecord] = {}
+        for dataset in datasets:
+            if not dataset:
+                continue
+            if isinstance(dataset, DatasetRecord):
+                records.append(dataset)
+                continue
+            dataset_id = dataset.get("id") or ""
+            record = by_id.get(dataset_id) if dataset_id else None
+            if record is None:
+                record = cls.from_ckan(dataset)
+                if dataset_id:
+                    by_id[dataset_id] = record
+            records.append(record)
+        return records
+    
+    def mentions(self, keywords: Tuple[str, ...]) -> bool:
+        """小文字化済みのキーワードのいずれかがタイトルまたは説明文に含まれるか"""
+        return any(keyword in self.title_lower or keyword in self.notes_lower for keyword in keywords)
+
+class CacheBackend:
+    """キャッシュ保存先の共通インターフェース（キー・値ともにバイト列を扱う）"""
+    
+    name = "base"
+    
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+    
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+    
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+    
+    def ping(self) -> bool:
+        return True
+
+class MemoryCacheBackend(CacheBackend):
+    """プロセス内LRUキャッシュ（ワーカー間では共有されない）"""
+    
+    name = "memory"
+    
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[bytes, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+class SQLiteCacheBackend(CacheBackend):
+    """SQLiteファイルを使うキャッシュ（同一ホストの全ワーカーで共有、追加依存なし）"""
+    
+    name = "sqlite"
+    
+    def __init__(self, path: str, purge_every: int = 500):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+        )
+    
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+    
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, sqlite3.Binary(value), time.time() + ttl if ttl else None)
+        )
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            # 期限切れの行をときどき掃除する
+            connection.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+    
+    def delete(self, key: str) -> None:
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+class RedisCacheBackend(CacheBackend):
+    """Redisプロトコル（RESP）で話す最小限のクライアント（Redis/Valkey互換サーバー・テスト用スタンドインで動作）"""
+    
+    name = "redis"
+    
+    def __init__(self, url: str = "redis://localhost:6379/0", timeout: float = 1.0):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.username = urllib.parse.unquote(parsed.username) if parsed.username else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+    
+    def _connect(self) -> Tuple[socket.socket, Any]:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = sock.makefile("rb")
+        self._local.connection = (sock, reader)
+        if self.password:
+            self._command(*(["AUTH", self.username, self.password] if self.username else ["AUTH", self.password]))
+        if self.db:
+            self._command("SELECT", str(self.db))
+        return sock, reader
+    
+    @staticmethod
+    def _encode(*args: Any) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+    
+    @staticmethod
+    def _read_reply(reader) -> Any:
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis接続が切断されました")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(f"Redisエラー: {payload.decode('utf-8', 'replace')}")
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(payload)
+            return None if count < 0 else [RedisCacheBackend._read_reply(reader) for _ in range(count)]
+        raise ConnectionError(f"不明なRedis応答: {line[:20]!r}")
+    
+    def _command(self, *args: Any) -> Any:
+        connection = getattr(self._local, "connection", None)
+        for attempt in range(2):
+            sock, reader = connection or self._connect()
+            connection = None
+            try:
+                sock.sendall(self._encode(*args))
+                return self._read_reply(reader)
+            except (OSError, ConnectionError):
+                # 切断された接続は張り直して1回だけ再試行
+                self._local.connection = None
+                sock.close()
+                if attempt:
+                    raise
+    
+    def get(self, key: str) -> Optional[bytes]:
+        return self._command("GET", key)
+    
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if ttl:
+            self._command("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            self._command("SET", key, value)
+    
+    def delete(self, key: str) -> None:
+        self._command("DEL", key)
+    
+    def ping(self) -> bool:
+        return self._command("PING") == "PONG"
+
+# 値の形式を変えたら上げる（CACHE_VERSIONはデプロイごとの無効化用）
+CACHE_SCHEMA_VERSION = 1
+
+class SharedCache:
+    """名前空間・バージョン付きキーで値をJSON＋zlib圧縮して保存するキャッシュ層
+
+    コルーチンからはaget/asetを使い、保存先のI/Oと圧縮・展開を専用スレッドで行ってイベントループを塞がない。
+    失敗したら failure_cooldown 秒間は保存先を使わずにキャッシュなしとして扱う（Redis停止中にアクセスのたびにタイムアウトまで待たない）
+    """
+    
+    def __init__(self, backend: CacheBackend, version: str = "1", prefix: str = "kanazawa",
+                 compress_min_bytes: int = 256, failure_cooldown: float = 30.0, io_threads: int = 4):
+        self.backend = backend
+        self.version = version
+        self.prefix = prefix
+        self.compress_min_bytes = compress_min_bytes
+        self.failure_cooldown = failure_cooldown
+        self._suspended_until = 0.0
+        self._stats_lock = threading.Lock()
+        self._io = ThreadPoolExecutor(max_workers=max(1, io_threads), thread_name_prefix="cache-io")
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "errors": 0, "bypassed": 0, "bytes_raw": 0, "bytes_stored": 0}
+    
+    def make_key(self, namespace: str, key: Any) -> str:
+        """バージョンと名前空間を含むキー（任意のJSON化可能な値をハッシュ化）"""
+        digest = hashlib.sha1(
+            json.dumps(key, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        return f"{self.prefix}:v{CACHE_SCHEMA_VERSION}.{self.version}:{namespace}:{digest}"
+    
+    def _serialize(self, value: Any) -> bytes:
+        raw = orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS) if orjson else \
+            json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")
+        if len(raw) >= self.compress_min_bytes:
+            data = b"z" + zlib.compress(raw, 6)
+        else:
+            data = b"j" + raw
+        self._count("bytes_raw", len(raw))
+        self._count("bytes_stored", len(data))
+        return data
+    
+    @staticmethod
+    def _deserialize(data: bytes) -> Any:
+        raw = zlib.decompress(data[1:]) if data[:1] == b"z" else data[1:]
+        return orjson.loads(raw) if orjson else json.loads(raw)
+    
+    def _count(self, name: str, amount: int = 1) -> None:
+        # get/setは複数のスレッドから呼ばれる
+        with self._stats_lock:
+            self.stats[name] += amount
+    
+    def _available(self) -> bool:
+        """直近の失敗から待機時間が過ぎていれば保存先を使う（待機中の呼び出しは数えて素通りさせる）"""
+        if time.monotonic() < self._suspended_until:
+            self._count("bypassed")
+            return False
+        return True
+    
+    def _on_error(self, action: str, error: Exception) -> None:
+        self._count("errors")
+        self._suspended_until = time.monotonic() + self.failure_cooldown
+        print(f"キャッシュ{action}エラー ({self.backend.name}): {error}（{self.failure_cooldown:g}秒間キャッシュを使用しません）")
+    
+    def get(self, namespace: str, key: Any) -> Optional[Any]:
+        """キャッシュされた値を返す（なければ・読み出しに失敗すればNone）"""
+        if not self._available():
+            return None
+        try:
+            data = self.backend.get(self.make_key(namespace, key))
+            value = self._deserialize(data) if data is not None else None
+        except Exception as e:
+            self._on_error("読み込み", e)
+            return None
+        self._count("hits" if value is not None else "misses")
+        return value
+    
+    def set(self, namespace: str, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        """値を保存（失敗してもリクエスト処理は継続する）"""
+        if not self._available():
+            return
+        try:
+            self.backend.set(self.make_key(namespace, key), self._serialize(value), ttl)
+            self._count("sets")
+        except Exception as e:
+            self._on_error("書き込み", e)
+    
+    async def aget(self, namespace: str, key: Any) -> Optional[Any]:
+        """getの非同期版（読み出しと展開を専用スレッドで行う）"""
+        if not self._available():
+            return None
+        return await asyncio.get_running_loop().run_in_executor(self._io, self.get, namespace, key)
+    
+    async def aset(self, namespace: str, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        """setの非同期版（圧縮と書き込みを専用スレッドで行う）"""
+        if not self._available():
+            return
+        await asyncio.get_running_loop().run_in_executor(self._io, self.set, namespace, key, value, ttl)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            "backend": self.backend.name,
+            "version": f"v{CACHE_SCHEMA_VERSION}.{self.version}",
+            "hit_rate": round(stats["hits"] / lookups, 3) if lookups else None,
+            "compression_ratio": round(stats["bytes_stored"] / stats["bytes_raw"], 3) if stats["bytes_raw"] else None,
+            "suspended_seconds": round(max(0.0, self._suspended_until - time.monotonic()), 1),
+            **stats
+        }
+
+def create_cache_backend(name: str) -> CacheBackend:
+    """CACHE_BACKENDに応じた保存先を作成（接続できない場合はプロセス内キャッシュにフォールバック）"""
+    name = (name or "memory").lower()
+    try:
+        if name == "redis":
+            backend = RedisCacheBackend(os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"),
+                                        timeout=float(os.getenv("CACHE_REDIS_TIMEOUT_SECONDS", "1.0")))
+            backend.ping()
+            return backend
+        if name == "sqlite":
+            return SQLiteCacheBackend(os.getenv(
+                "CACHE_SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "kanazawa_cache.sqlite3")
+            ))
+    except Exception as e:
+        print(f"キャッシュバックエンド '{name}' を利用できません（プロセス内キャッシュを使用）: {e}")
+    return MemoryCacheBackend(int(os.getenv("CACHE_MEMORY_MAX_ENTRIES", "2048")))
+
+# 一般質問へのLLM回答をキャッシュする秒数（0で無効）
+LLM_ANSWER_CACHE_TTL_SECONDS = float(os.getenv("LLM_ANSWER_CACHE_TTL_SECONDS", "1800"))
+
+shared_cache = SharedCache(create_cache_backend(os.getenv("CACHE_BACKEND", "memory")), os.getenv("CACHE_VERSION", "1"),
+                           failure_cooldown=float(os.getenv("CACHE_FAILURE_COOLDOWN_SECONDS", "30")),
+                           io_threads=int(os.getenv("CACHE_IO_THREADS", "4")))
+
+class UpstreamUnavailableError(Exception):
+    """上流APIが利用できず、フォールバックできるキャッシュもないことを表す例外"""
+
+class CircuitBreaker:
+    """連続失敗・遅延で上流への呼び出しを遮断し、一定時間後の試行リクエスト（half-open）で復旧を確認する"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int = 5, slow_call_seconds: float = 5.0,
+                 reset_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = max(1, half_open_max_calls)
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self.last_state_change: Optional[datetime] = None
+        self.counters = {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "opened": 0}
+    
+    def allow_request(self) -> bool:
+        """上流を呼び出してよいか判定（遮断中はFalse、復旧確認中は試行枠の分だけTrue）"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.counters["rejected"] += 1
+                    return False
+                self._set_state(self.HALF_OPEN)
+                self._half_open_in_flight = 0
+            if self.state == self.HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_max_calls:
+                    self.counters["rejected"] += 1
+                    return False
+                self._half_open_in_flight += 1
+            self.counters["calls"] += 1
+            return True
+    
+    def record_success(self, elapsed_seconds: float) -> None:
+        """呼び出し成功を記録（遅すぎる呼び出しは失敗として扱う）"""
+        with self._lock:
+            if elapsed_seconds >= self.slow_call_seconds:
+                self.counters["slow_calls"] += 1
+                self._on_failure()
+                return
+            self._consecutive_failures = 0
+            if self.state == self.HALF_OPEN:
+                self._half_open_in_flight = 0
+                self._set_state(self.CLOSED)
+    
+    def release(self) -> None:
+        """成否を判定できないまま終わった呼び出し（キャンセルなど）の試行枠を返す"""
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._half_open_in_flight > 0:
+                self._half_open_in_flight -= 1
+    
+    def record_failure(self) -> None:
+        """呼び出し失敗を記録"""
+        with self._lock:
+            self.counters["failures"] += 1
+            self._on_failure()
+    
+    def _on_failure(self) -> None:
+        self._consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._half_open_in_flight = 0
+            self.counters["opened"] += 1
+            self._set_state(self.OPEN)
+    
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            print(f"サーキットブレーカー[{self.name}]: {self.state} -> {state}")
+            self.state = state
+            self.last_state_change = datetime.now()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """状態とカウンタを返す"""
+        with self._lock:
+            retry_in = self.reset_timeout - (time.monotonic() - self._opened_at) if self.state == self.OPEN else 0.0
+            return {
+                "state": self.state,
+                "consecutive_failures": self._consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "slow_call_seconds": self.slow_call_seconds,
+                "reset_timeout_seconds": self.reset_timeout,
+                "half_open_probe_in": round(max(0.0, retry_in), 1),
+                "last_state_change": self.last_state_change.isoformat() if self.last_state_change else None,
+                **self.counters
+            }
+
+class AdaptiveLatencyTracker:
+    """アクション別の応答時間分布を記録し、パーセンタイルからタイムアウトとヘッジ開始時間を決める"""
+    
+    def __init__(self, bounds: Dict[str, Tuple[float, float]], window: int = 200, min_samples: int = 20,
+                 timeout_multiplier: float = 2.0, adaptive: bool = True):
+        self.bounds = bounds  # アクション -> (最小タイムアウト, 最大タイムアウト)
+        self.window = window
+        self.min_samples = min_samples
+        self.timeout_multiplier = timeout_multiplier
+        self.adaptive = adaptive
+        self._samples: Dict[str, deque] = {action: deque(maxlen=window) for action in bounds}
+        self._lock = threading.Lock()
+        self.hedges = {"issued": 0, "won": 0}
+    
+    def record(self, action: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(action, deque(maxlen=self.window)).append(seconds)
+    
+    def percentile(self, action: str, q: float) -> Optional[float]:
+        """直近の応答時間のパーセンタイル（サンプル不足ならNone）"""
+        with self._lock:
+            samples = list(self._samples.get(action, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return float(np.percentile(samples, q))
+    
+    def timeout_for(self, action: str) -> float:
+        """p99 × 係数を上下限に収めたタイムアウト（サンプル不足時・無効時は上限値）"""
+        low, high = self.bounds.get(action, self.bounds["package_search"])
+        p99 = self.percentile(action, 99) if self.adaptive else None
+        if p99 is None:
+            return high
+        return min(high, max(low, p99 * self.timeout_multiplier))
+    
+    def hedge_delay(self, action: str) -> Optional[float]:
+        """重複リクエストを送るまでの待ち時間（p95）。サンプル不足ならNone"""
+        return self.percentile(action, 95)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        actions = {}
+        for action in self._samples:
+            p50, p95, p99 = (self.percentile(action, q) for q in (50, 95, 99))
+            actions[action] = {
+                "samples": len(self._samples[action]),
+                "p50_seconds": round(p50, 3) if p50 is not None else None,
+                "p95_seconds": round(p95, 3) if p95 is not None else None,
+                "p99_seconds": round(p99, 3) if p99 is not None else None,
+                "timeout_seconds": round(self.timeout_for(action), 3)
+            }
+        return {"adaptive": self.adaptive, "actions": actions, "hedges": dict(self.hedges)}
+
+# CKAN（金沢市オープンデータカタログ）用のサーキットブレーカーと応答時間トラッカー（全クライアントで共有）
+ckan_circuit = CircuitBreaker(
+    "ckan",
+    failure_threshold=int(os.getenv("CKAN_CIRCUIT_FAILURE_THRESHOLD", "5")),
+    slow_call_seconds=float(os.getenv("CKAN_CIRCUIT_SLOW_CALL_SECONDS", "5")),
+    reset_timeout=float(os.getenv("CKAN_CIRCUIT_RESET_SECONDS", "30"))
+)
+# 取得結果はこの秒数の間キャッシュから返し、上流障害時はCKAN_STALE_TTL_SECONDSまで古い結果で代替する
+CKAN_CACHE_TTL_SECONDS = float(os.getenv("CKAN_CACHE_TTL_SECONDS", "300"))
+CKAN_STALE_TTL_SECONDS = float(os.getenv("CKAN_STALE_TTL_SECONDS", "86400"))
+_ckan_timeout_max = float(os.getenv("CKAN_TIMEOUT_MAX_SECONDS", "10"))
+ckan_latency = AdaptiveLatencyTracker(
+    {
+        "package_search": (2.0, _ckan_timeout_max),
+        "package_show": (2.0, _ckan_timeout_max),
+        "resource": (5.0, float(os.getenv("CKAN_RESOURCE_TIMEOUT_MAX_SECONDS", "30")))
+    },
+    adaptive=os.getenv("CKAN_ADAPTIVE_TIMEOUTS", "true").lower() != "false"
+)
+# 小さく冪等な呼び出しだけをヘッジする
+CKAN_HEDGED_ACTIONS = ("package_search", "package_show")
+
+def _record_upstream_status(stale_since: Optional[datetime] = None, unavailable: bool = False) -> None:
+    """リクエスト中に古いデータで代替した（または取得できなかった）ことを記録する"""
+    if not has_app_context():
+        return
+    status = g.get("upstream_status")
+    if status is None:
+        status = g.upstream_status = {"source": "ckan", "stale": False, "stale_results": 0, "unavailable_results": 0}
+    if stale_since is not None:
+        status["stale"] = True
+        status["stale_results"] += 1
+        oldest = status.get("stale_since")
+        if oldest is None or stale_since.isoformat() < oldest:
+            status["stale_since"] = stale_since.isoformat()
+    if unavailable:
+        status["unavailable_results"] += 1
+
+# バッチ処理中に同じ上流呼び出しを1回にまとめるためのスコープ（キー -> Task）
+_upstream_fetch_scope: ContextVar[Optional[Dict[str, Any]]] = ContextVar("upstream_fetch_scope", default=None)
+
+@contextmanager
+def shared_upstream_fetches():
+    """このブロック内（とそこから作られるタスク）の上流呼び出しを共有する"""
+    scope = {"tasks": {}, "shared": 0}
+    token = _upstream_fetch_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _upstream_fetch_scope.reset(token)
+
+def get_upstream_status() -> Optional[Dict[str, Any]]:
+    """現在のリクエストで上流の劣化があった場合、その内容を返す"""
+    status = g.get("upstream_status") if has_app_context() else None
+    if status is None:
+        return None
+    return {**status, "circuit_state": ckan_circuit.state}
+
+class CatalogVectorIndex:
+    """カタログ（タイトル・説明・タグ・リソース名）の文字n-gram TF-IDF + LSAベクトルと転置インデックスを1ファイルにまとめ、
+    読み取り専用のメモリマップで検索する（gunicornの各ワーカーが同じページを共有する）"""
+    
+    INDEX_FILE = "catalog.idx"
+    MAGIC = b"KZCIDX01"
+    ALIGNMENT = 64
+    NGRAM_RANGE = (2, 3)
+    
+    def __init__(self, directory: str, dimensions: int = 256):
+        self.directory = directory
+        self.path = os.path.join(directory, self.INDEX_FILE)
+        self.dimensions = dimensions
+        self._lock = threading.Lock()
+        self._loaded_stat: Optional[Tuple[int, int]] = None
+        self._sections: Dict[str, np.ndarray] = {}
+        self.meta: Dict[str, Any] = {}
+    
+    @staticmethod
+    def document_text(dataset: Dict[str, Any]) -> str:
+        """インデックス対象のテキスト（タイトルは重みを上げるため2回含める）"""
+        title = dataset.get("title") or ""
+        tags = " ".join(tag.get("display_name", "") for tag in dataset.get("tags") or [] if tag)
+        resources = " ".join(resource.get("name") or "" for resource in dataset.get("resources") or [] if resource)
+        organization = (dataset.get("organization") or {}).get("title") or ""
+        return " ".join([title, title, tags, organization, dataset.get("notes") or "", resources])
+    
+    @staticmethod
+    def _compact_record(dataset: Dict[str, Any]) -> Dict[str, Any]:
+        """検索結果・チャットのコンテキストに必要なフィールドだけを残したCKAN形式の辞書"""
+        return {
+            "id": dataset.get("id", ""),
+            "name": dataset.get("name", ""),
+            "title": dataset.get("title", ""),
+            "notes": (dataset.get("notes") or "")[:500],
+            "metadata_modified": dataset.get("metadata_modified", ""),
+            "tags": [{"display_name": tag.get("display_name", "")} for tag in dataset.get("tags") or [] if tag],
+            "organization": {"title": (dataset.get("organization") or {}).get("title", "")},
+            "resources": [
+                {"name": r.get("name", ""), "format": r.get("format", ""), "url": r.get("url", "")}
+                for r in (dataset.get("resources") or [])[:5] if r
+            ]
+        }
+    
+    @classmethod
+    def analyze(cls, text: str) -> List[str]:
+        """TfidfVectorizer(analyzer="char_wb") と同じ文字n-gramを生成（クエリ側でsklearnのモデルを読み込まずに済むように）"""
+        min_n, max_n = cls.NGRAM_RANGE
+        ngrams = []
+        for word in re.sub(r"\s\s+", " ", text.lower()).split():
+            word = f" {word} "
+            for n in range(min_n, max_n + 1):
+                offset = 0
+                ngrams.append(word[offset:offset + n])
+                while offset + n < len(word):
+                    offset += 1
+                    ngrams.append(word[offset:offset + n])
+                if offset == 0:
+                    break
+        return ngrams
+    
+    # --- 構築 ---
+    
+    def build(self, datasets: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """データセット一覧からインデックスファイルを構築し、一時ファイルからのrenameで差し替える"""
+        from sklearn.decomposition import TruncatedSVD
+        
+        started = time.perf_counter()
+        unique = list({dataset.get("id"): dataset for dataset in datasets if dataset and dataset.get("id")}.values())
+        if not unique:
+            raise ValueError("インデックス対象のデータセットがありません")
+        
+        vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=self.NGRAM_RANGE, sublinear_tf=True,
+                                     min_df=1, max_features=100000, dtype=np.float32)
+        tfidf = vectorizer.fit_transform([self.document_text(dataset) for dataset in unique])
+        components = min(self.dimensions, tfidf.shape[0] - 1, tfidf.shape[1] - 1)
+        sections: Dict[str, np.ndarray] = {}
+        if components >= 2:
+            svd = TruncatedSVD(n_components=components, random_state=0)
+            vectors = svd.fit_transform(tfidf).astype(np.float32)
+            sections["components"] = svd.components_.astype(np.float32)
+        else:
+            vectors = tfidf.toarray().astype(np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        sections["vectors"] = vectors
+        
+        # レコードはJSONを連結し、オフセットで1件ずつ取り出す
+        encoded = [json.dumps(self._compact_record(dataset), ensure_ascii=False).encode("utf-8") for dataset in unique]
+        sections["record_offsets"] = np.concatenate([[0], np.cumsum([len(item) for item in encoded])]).astype(np.uint64)
+        sections["records"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        
+        # 語彙（sklearnの列順＝文字列順）と、語ごとの出現データセット（転置インデックス）
+        terms = [term.encode("utf-8") for term in vectorizer.get_feature_names_out()]
+        sections["term_offsets"] = np.concatenate([[0], np.cumsum([len(term) for term in terms])]).astype(np.uint64)
+        sections["terms"] = np.frombuffer(b"".join(terms), dtype=np.uint8)
+        sections["idf"] = vectorizer.idf_.astype(np.float32)
+        postings = tfidf.tocsc()
+        postings.sort_indices()
+        sections["postings_offsets"] = postings.indptr.astype(np.uint64)
+        sections["postings"] = postings.indices.astype(np.uint32)
+        
+        meta = {
+            "built_at": datetime.now().isoformat(),
+            "documents": len(unique),
+            "dimensions": int(vectors.shape[1]),
+            "vocabulary_size": len(terms),
+            "postings": int(postings.nnz)
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        self._write_file(tmp_path, meta, sections)
+        os.replace(tmp_path, self.path)
+        self.load()
+        stats = dict(meta)
+        stats["file_bytes"] = os.path.getsize(self.path)
+        stats["build_seconds"] = round(time.perf_counter() - started, 2)
+        return stats
+    
+    @classmethod
+    def _write_file(cls, path: str, meta: Dict[str, Any], sections: Dict[str, np.ndarray]) -> None:
+        """ヘッダー（マジック・目次JSONの長さ・目次JSON）に続けて、各配列を64バイト境界に並べて書き出す"""
+        def align(value: int) -> int:
+            return -(-value // cls.ALIGNMENT) * cls.ALIGNMENT
+        
+        toc, offset = {}, 0
+        for name, array in sections.items():
+            array = np.ascontiguousarray(array)
+            sections[name] = array
+            toc[name] = {"offset": offset, "bytes": int(array.nbytes), "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset = align(offset + array.nbytes)
+        header = json.dumps({"meta": meta, "sections": toc}, ensure_ascii=False).encode("utf-8")
+        data_start = align(len(cls.MAGIC) + 8 + len(header))
+        with open(path, "wb") as f:
+            f.write(cls.MAGIC + len(header).to_bytes(8, "little") + header)
+            for name, array in sections.items():
+                f.seek(data_start + toc[name]["offset"])
+                f.write(array.tobytes())
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+    
+    # --- 読み込み ---
+    
+    def load(self) -> bool:
+        """インデックスファイルを読み取り専用でメモリマップする（ファイルが差し替えられていれば開き直す）"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        key = (stat.st_ino, stat.st_mtime_ns)
+        if self._loaded_stat == key:
+            return True
+        with self._lock:
+            if self._loaded_stat == key:
+                return True
+            try:
+                buffer = np.memmap(self.path, dtype=np.uint8, mode="r")
+                if bytes(buffer[:len(self.MAGIC)]) != self.MAGIC:
+                    raise ValueError("インデックスファイルの形式が不正です")
+                header_length = int.from_bytes(bytes(buffer[len(self.MAGIC):len(self.MAGIC) + 8]), "little")
+                header_end = len(self.MAGIC) + 8 + header_length
+                header = json.loads(bytes(buffer[len(self.MAGIC) + 8:header_end]).decode("utf-8"))
+                data_start = -(-header_end // self.ALIGNMENT) * self.ALIGNMENT
+                sections = {}
+                for name, info in header["sections"].items():
+                    start = data_start + info["offset"]
+                    sections[name] = buffer[start:start + info["bytes"]].view(np.dtype(info["dtype"])).reshape(info["shape"])
+            except Exception as e:
+                print(f"ベクトルインデックス読み込みエラー: {e}")
+                return False
+            # 差し替え前のマッピングは参照が残っている間は有効なため、処理中の検索には影響しない
+            self._sections, self.meta, self._loaded_stat = sections, header["meta"], key
+            print(f"ベクトルインデックス読み込み完了: {self.meta['documents']}件, {self.meta['dimensions']}次元")
+            return True
+    
+    @property
+    def available(self) -> bool:
+        return self.load()
+    
+    @property
+    def matrix(self) -> Optional[np.ndarray]:
+        return self._sections.get("vectors")
+    
+    def record(self, index: int, sections: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, Any]:
+        sections = sections or self._sections
+        offsets = sections["record_offsets"]
+        return json.loads(bytes(sections["records"][int(offsets[index]):int(offsets[index + 1])]).decode("utf-8"))
+    
+    def _term_index(self, term: str, sections: Dict[str, np.ndarray]) -> int:
+        """語彙（文字列順）を二分探索して列番号を返す（なければ-1）"""
+        target = term.encode("utf-8")
+        offsets, terms = sections["term_offsets"], sections["terms"]
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            candidate = bytes(terms[int(offsets[middle]):int(offsets[middle + 1])])
+            if candidate < target:
+                low = middle + 1
+            elif candidate > target:
+                high = middle
+            else:
+                return middle
+        return -1
+    
+    def _query_terms(self, text: str, sections: Dict[str, np.ndarray]) -> Dict[int, int]:
+        """クエリの文字n-gramを列番号ごとの出現回数にする"""
+        counts: Dict[int, int] = {}
+        for ngram in self.analyze(text):
+            column = self._term_index(ngram, sections)
+            if column >= 0:
+                counts[column] = counts.get(column, 0) + 1
+        return counts
+    
+    def embed(self, text: str, sections: Optional[Dict[str, np.ndarray]] = None) -> np.ndarray:
+        """クエリをインデックスと同じ空間の正規化ベクトルに変換（TF-IDF → LSA射影）"""
+        sections = sections or self._sections
+        counts = self._query_terms(text, sections)
+        columns = np.fromiter(counts, dtype=np.int64, count=len(counts))
+        weights = (1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * sections["idf"][columns]
+        norm = np.linalg.norm(weights)
+        if norm > 0:
+            weights /= norm
+        if "components" in sections:
+            vector = (sections["components"][:, columns] @ weights).astype(np.float32)
+        else:
+            vector = np.zeros(len(sections["idf"]), dtype=np.float32)
+            vector[columns] = weights
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+    
+    def search(self, query: str, k: int = 5, min_score: float = 0.0) -> List[Dict[str, Any]]:
+        """コサイン類似度の上位k件を返す"""
+        if not self.available or not query.strip():
+            return []
+        sections = self._sections
+        scores = sections["vectors"] @ self.embed(query, sections)
+        return self._top(scores, k, min_score, sections)
+    
+    def keyword_search(self, query: str, k: int = 5, min_score: float = 0.0) -> List[Dict[str, Any]]:
+        """転置インデックスで、クエリの文字n-gramを含むデータセットをIDFの合計（クエリ全体に対する割合）で順位付け"""
+        if not self.available or not query.strip():
+            return []
+        sections = self._sections
+        columns = list(self._query_terms(query, sections))
+        if not columns:
+            return []
+        offsets, postings, idf = sections["postings_offsets"], sections["postings"], sections["idf"]
+        scores = np.zeros(len(sections["record_offsets"]) - 1, dtype=np.float32)
+        for column in columns:
+            scores[postings[int(offsets[column]):int(offsets[column + 1])]] += idf[column]
+        scores /= float(idf[columns].sum())
+        return self._top(scores, k, min_score, sections)
+    
+    def _top(self, scores: np.ndarray, k: int, min_score: float, sections: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [
+            {"score": round(float(scores[i]), 4), **self.record(int(i), sections)}
+            for i in top if scores[i] >= min_score
+        ]
+    
+    def status(self) -> Dict[str, Any]:
+        status = {"available": self.available, **self.meta}
+        if status["available"]:
+            status["file_bytes"] = os.path.getsize(self.path)
+        return status
+
+class FacilitySpatialIndex:
+    """施設・事業所の座標（または住所）を格子状の空間インデックスに載せ、エリア×業界の件数・密度を返す"""
+    
+    CELL_DEGREES = 0.005  # 格子の1辺（緯度方向で約550m）
+    KM_PER_DEGREE_LAT = 111.0
+    LAT_RANGE = (36.3, 36.8)  # 金沢市周辺以外の座標（平面直角座標など）は除外
+    LON_RANGE = (136.4, 136.95)
+    
+    COLUMN_CANDIDATES = {
+        "lat": ("緯度", "lat", "latitude", "y"),
+        "lon": ("経度", "lon", "lng", "longitude", "x"),
+        "name": ("名称", "施設名", "事業所名", "店舗名", "店名", "name"),
+        "type": ("種別", "業種", "分類", "カテゴリ", "種類", "type", "category"),
+        "address": ("住所", "所在地", "address")
+    }
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.industries: List[str] = []
+        self.lat = np.empty(0, dtype=np.float64)
+        self.lon = np.empty(0, dtype=np.float64)
+        self.industry_codes = np.empty(0, dtype=np.int16)
+        self.address_areas: List[List[str]] = []  # 座標のない点の住所から判定したエリア
+        self._cells: Dict[Tuple[int, int], np.ndarray] = {}
+        self._area_counts: Dict[Tuple[str, Optional[str]], int] = {}
+        self.meta: Dict[str, Any] = {}
+        self._pending: List[Tuple[Optional[float], Optional[float], str, List[str]]] = []
+        self._address_only: List[Tuple[int, List[str]]] = []
+    
+    @property
+    def available(self) -> bool:
+        return bool(self._area_counts)
+    
+    # --- 取り込み ---
+    
+    @classmethod
+    def _find_column(cls, header: List[str], kind: str) -> Optional[int]:
+        normalized = [column.strip().lower() for column in header]
+        for candidate in cls.COLUMN_CANDIDATES[kind]:
+            for index, column in enumerate(normalized):
+                if column == candidate or (len(candidate) > 1 and not candidate.isascii() and candidate in column):
+                    return index
+        return None
+    
+    @staticmethod
+    def classify_industry(text: str) -> str:
+        """施設名・種別・データセット名から業界を判定"""
+        for industry, keywords in FACILITY_INDUSTRY_KEYWORDS.items():
+            if any(keyword in text for keyword in keywords):
+                return industry
+        return "その他"
+    
+    def ingest_csv(self, text: str, source_title: str = "") -> int:
+        """CSVテキストから施設を取り込む。取り込んだ件数を返す"""
+        return self.add_points(self.parse_csv(text, source_title))
+    
+    def add_points(self, points: List[Tuple[Optional[float], Optional[float], str, List[str]]]) -> int:
+        self._pending.extend(points)
+        return len(points)
+    
+    @classmethod
+    def parse_csv(cls, text: str, source_title: str = "") -> List[Tuple[Optional[float], Optional[float], str, List[str]]]:
+        """CSVテキストから (緯度, 経度, 業界, 住所のエリア) を読み出す（座標列があれば座標、なければ住所のエリア名で位置づける）"""
+        import csv
+        import io
+        
+        rows = csv.reader(io.StringIO(text))
+        header = next(rows, None)
+        if not header:
+            return []
+        columns = {kind: cls._find_column(header, kind) for kind in cls.COLUMN_CANDIDATES}
+        if columns["address"] is None and (columns["lat"] is None or columns["lon"] is None):
+            return []
+        
+        def cell(row: List[str], kind: str) -> str:
+            index = columns[kind]
+            return row[index].strip() if index is not None and index < len(row) else ""
+        
+        points = []
+        for row in rows:
+            try:
+                lat, lon = float(cell(row, "lat")), float(cell(row, "lon"))
+                if not (cls.LAT_RANGE[0] <= lat <= cls.LAT_RANGE[1] and cls.LON_RANGE[0] <= lon <= cls.LON_RANGE[1]):
+                    lat = lon = None
+            except ValueError:
+                lat = lon = None
+            address = cell(row, "address")
+            areas = [area for area in AREA_KEYWORDS if area != "金沢" and area in address] if lat is None else []
+            if lat is None and not areas and "金沢" not in address:
+                continue
+            industry = cls.classify_industry(f"{cell(row, 'type')} {cell(row, 'name')}")
+            if industry == "その他":
+                industry = cls.classify_industry(source_title)
+            points.append((lat, lon, industry, areas))
+        return points
+    
+    def finalize(self, sources: Optional[List[str]] = None) -> Dict[str, Any]:
+        """取り込んだ点から格子インデックスとエリア×業界の件数表を作る"""
+        points = self._pending
+        self._pending = []
+        self.industries = sorted({industry for _, _, industry, _ in points})
+        codes = {industry: code for code, industry in enumerate(self.industries)}
+        located = [(lat, lon, codes[industry]) for lat, lon, industry, _ in points if lat is not None]
+        self.lat = np.array([p[0] for p in located], dtype=np.float64)
+        self.lon = np.array([p[1] for p in located], dtype=np.float64)
+        self.industry_codes = np.array([p[2] for p in located], dtype=np.int16)
+        address_only = [(codes[industry], areas) for lat, _, industry, areas in points if lat is None]
+        self._build_cells()
+        self._build_area_counts(address_only)
+        self.meta = {
+            "built_at": datetime.now().isoformat(),
+            "points": len(points),
+            "points_with_coordinates": len(located),
+            "points_with_address_only": len(address_only),
+            "industries": self.industries,
+            "sources": sources or self.meta.get("sources", [])
+        }
+        self._address_only = address_only
+        return self.meta
+    
+    def _build_cells(self) -> None:
+        cells: Dict[Tuple[int, int], List[int]] = {}
+        for index, (lat, lon) in enumerate(zip(self.lat, self.lon)):
+            cells.setdefault((int(lat // self.CELL_DEGREES), int(lon // self.CELL_DEGREES)), []).append(index)
+        self._cells = {key: np.array(indices, dtype=np.int32) for key, indices in cells.items()}
+    
+    def _build_area_counts(self, address_only: List[Tuple[int, List[str]]]) -> None:
+        """各エリアの件数を格子インデックスで数えて保持（問い合わせ時は辞書を引くだけ）"""
+        counts: Dict[Tuple[str, Optional[str]], int] = {}
+        for area in AREA_KEYWORDS:
+            if area == "金沢":
+                continue
+            lat, lon, radius_km = AREA_GEOMETRY[area]
+            matched = self.query_radius(lat, lon, radius_km)
+            codes = list(self.industry_codes[matched])
+            codes += [code for code, areas in address_only if area in areas]
+            counts[(area, None)] = len(codes)
+            for code in set(codes):
+                counts[(area, self.industries[code])] = codes.count(code)
+        # 金沢市全域
+        all_codes = list(self.industry_codes) + [code for code, _ in address_only]
+        for area in ("", "金沢"):
+            counts[(area, None)] = len(all_codes)
+            for code in set(all_codes):
+                counts[(area, self.industries[code])] = all_codes.count(code)
+        self._area_counts = counts
+    
+    # --- 問い合わせ ---
+    
+    def query_radius(self, lat: float, lon: float, radius_km: float) -> np.ndarray:
+        """中心から半径radius_km以内の点のインデックス（格子で候補を絞ってから距離を計算）"""
+        if not len(self.lat):
+            return np.empty(0, dtype=np.int32)
+        lat_span = radius_km / self.KM_PER_DEGREE_LAT
+        lon_span = radius_km / (self.KM_PER_DEGREE_LAT * math.cos(math.radians(lat)))
+        candidates = [
+            self._cells[key]
+            for key in (
+                (i, j)
+                for i in range(int((lat - lat_span) // self.CELL_DEGREES), int((lat + lat_span) // self.CELL_DEGREES) + 1)
+                for j in range(int((lon - lon_span) // self.CELL_DEGREES), int((lon + lon_span) // self.CELL_DEGREES) + 1)
+            )
+            if key in self._cells
+        ]
+        if not candidates:
+            return np.empty(0, dtype=np.int32)
+        indices = np.concatenate(candidates)
+        dy = (self.lat[indices] - lat) * self.KM_PER_DEGREE_LAT
+        dx = (self.lon[indices] - lon) * self.KM_PER_DEGREE_LAT * math.cos(math.radians(lat))
+        return indices[dx * dx + dy * dy <= radius_km * radius_km]
+    
+    def count(self, area: str, industry: Optional[str] = None) -> int:
+        """エリア（空文字は市全域）・業界ごとの施設数"""
+        return self._area_counts.get((area or "", industry), 0)
+    
+    @staticmethod
+    def area_km2(area: str) -> float:
+        if not area or area == "金沢":
+            return KANAZAWA_CITY_AREA_KM2
+        radius_km = AREA_GEOMETRY[area][2]
+        return math.pi * radius_km * radius_km
+    
+    def density(self, area: str, industry: Optional[str] = None) -> float:
+        """1km²あたりの施設数"""
+        return self.count(area, industry) / self.area_km2(area)
+    
+    def urban_average_density(self, industry: Optional[str] = None) -> float:
+        """AREA_GEOMETRYの各エリアの密度の平均（市全域は山間部を含むため比較の基準には使わない）"""
+        return sum(self.density(area, industry) for area in AREA_GEOMETRY) / len(AREA_GEOMETRY)
+    
+    # --- 保存・読み込み ---
+    
+    def save(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        meta = {**self.meta, "address_only": [[code, areas] for code, areas in self._address_only]}
+        tmp_path = f"{self.path}.tmp-{os.getpid()}.npz"
+        np.savez_compressed(tmp_path, lat=self.lat, lon=self.lon, industry=self.industry_codes,
+                            meta=np.array(json.dumps(meta, ensure_ascii=False)))
+        os.replace(tmp_path, self.path)
+    
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as data:
+                meta = json.loads(str(data["meta"]))
+                self.lat, self.lon, self.industry_codes = data["lat"], data["lon"], data["industry"]
+        except Exception as e:
+            print(f"施設空間インデックス読み込みエラー: {e}")
+            return False
+        self._address_only = [(code, areas) for code, areas in meta.pop("address_only", [])]
+        self.meta = meta
+        self.industries = meta.get("industries", [])
+        self._build_cells()
+        self._build_area_counts(self._address_only)
+        print(f"施設空間インデックス読み込み完了: {meta.get('points', 0)}件")
+        return True
+    
+    def status(self) -> Dict[str, Any]:
+        return {"available": self.available, **self.meta}
+
+class TimeSeriesTrendEngine:
+    """カタログのCSVリソースから年次・月次の時系列を抽出し、成長率・季節性・予測をまとめて計算する"""
+    
+    ERA_BASE_YEARS = {"令和": 2018, "R": 2018, "平成": 1988, "H": 1988, "昭和": 1925, "S": 1925}
+    WESTERN_PERIOD = re.compile(r"((?:19|20)\d{2})\s*(?:年度|年)?\s*(?:[/\-.]?\s*(\d{1,2})\s*月?)?")
+    ERA_PERIOD = re.compile(r"(令和|平成|昭和|R|H|S)\s*(元|\d{1,2})\s*(?:年度|年)?\s*(?:(\d{1,2})\s*月)?")
+    PERIOD_COLUMN_HINTS = ("年月", "年度", "年", "時点", "期間", "year", "date")
+    STOCK_METRICS = ("人口", "事業所数")  # 月次→年次の集約で平均を使う指標（それ以外は合計）
+    TREND_WINDOW_YEARS = 5  # 成長率の回帰に使う直近の年数
+    
+    def __init__(self, path: str):
+        self.path = path
+        # series_id -> {"metric", "label", "source", "resource", "frequency", "periods": np.ndarray, "values": np.ndarray}
+        self.series: Dict[str, Dict[str, Any]] = {}
+        self.resource_versions: Dict[str, str] = {}  # リソースURL -> last_modified（増分更新の判定用）
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self.refreshed_at: Optional[str] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def available(self) -> bool:
+        return bool(self.stats)
+    
+    # --- 抽出 ---
+    
+    @classmethod
+    def parse_period(cls, text: str) -> Optional[Tuple[int, Optional[int]]]:
+        """「2019年」「令和元年度」「H30年4月」「2021/04」などを (年, 月) に変換"""
+        text = (text or "").strip().translate(FULLWIDTH_DIGITS)
+        if not text:
+            return None
+        match = cls.WESTERN_PERIOD.fullmatch(text)
+        if match:
+            year = int(match.group(1))
+            month = int(match.group(2)) if match.group(2) else None
+        else:
+            match = cls.ERA_PERIOD.fullmatch(text)
+            if not match:
+                return None
+            year = cls.ERA_BASE_YEARS[match.group(1)] + (1 if match.group(2) == "元" else int(match.group(2)))
+            month = int(match.group(3)) if match.group(3) else None
+        if month is not None and not 1 <= month <= 12:
+            return None
+        return year, month
+    
+    @staticmethod
+    def parse_number(text: str) -> Optional[float]:
+        cleaned = (text or "").strip().translate(FULLWIDTH_DIGITS).replace(",", "")
+        cleaned = re.sub(r"[人件社所泊%％\s]+$", "", cleaned)
+        try:
+            value = float(cleaned)
+        except ValueError:
+            return None
+        return value if math.isfinite(value) else None
+    
+    @staticmethod
+    def classify_metric(text: str) -> Optional[str]:
+        for metric, keywords in TREND_SERIES_METRICS.items():
+            if any(keyword in text for keyword in keywords):
+                return metric
+        return None
+    
+    @classmethod
+    def extract_series(cls, text: str, source_title: str) -> List[Dict[str, Any]]:
+        """CSVテキストから時系列を抽出（期間が列見出しに並ぶ横持ちと、期間列がある縦持ちの両方に対応）"""
+        import csv
+        import io
+        
+        rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+        if len(rows) < 2:
+            return []
+        header, body = [cell.strip() for cell in rows[0]], rows[1:]
+        raw_series: List[Tuple[str, List[Tuple[Tuple[int, Optional[int]], float]]]] = []
+        
+        period_columns = [(index, cls.parse_period(name)) for index, name in enumerate(header)]
+        period_columns = [(index, period) for index, period in period_columns if period]
+        if len(period_columns) >= 3:
+            # 横持ち: 各行が1系列（先頭の期間以外の列をラベルにする）
+            label_columns = [index for index in range(len(header)) if index not in dict(period_columns)]
+            for row in body:
+                label = " ".join(row[index].strip() for index in label_columns if index < len(row) and row[index].strip())
+                points = [
+                    (period, value) for index, period in period_columns
+                    if index < len(row) and (value := cls.parse_number(row[index])) is not None
+                ]
+                raw_series.append((label, points))
+        else:
+            # 縦持ち: 期間列 + 数値列（分類列があれば分類ごとに別系列）
+            period_index = next(
+                (index for index, name in enumerate(header)
+                 if any(hint in name.lower() for hint in cls.PERIOD_COLUMN_HINTS)
+                 and sum(1 for row in body if index < len(row) and cls.parse_period(row[index])) >= len(body) * 0.8),
+                None
+            )
+            if period_index is None:
+                return []
+            month_index = next((index for index, name in enumerate(header) if name == "月"), None)
+            numeric_columns, category_columns = [], []
+            for index, name in enumerate(header):
+                if index in (period_index, month_index):
+                    continue
+                values = [row[index] for row in body if index < len(row)]
+                if values and sum(1 for value in values if cls.parse_number(value) is not None) >= len(values) * 0.8:
+                    numeric_columns.append(index)
+                elif 1 < len(set(values)) <= 50:
+                    category_columns.append(index)
+            grouped: Dict[str, Dict[Tuple[int, Optional[int]], float]] = {}
+            for row in body:
+                period = cls.parse_period(row[period_index]) if period_index < len(row) else None
+                if not period:
+                    continue
+                if month_index is not None and month_index < len(row):
+                    month = cls.parse_number(row[month_index])
+                    if month and 1 <= month <= 12:
+                        period = (period[0], int(month))
+                category = " ".join(row[index].strip() for index in category_columns if index < len(row))
+                for index in numeric_columns:
+                    value = cls.parse_number(row[index]) if index < len(row) else None
+                    if value is not None:
+                        grouped.setdefault(f"{category} {header[index]}".strip(), {})[period] = value
+            raw_series = [(label, list(points.items())) for label, points in grouped.items()]
+        
+        series = []
+        for label, points in raw_series:
+            metric = cls.classify_metric(label) or cls.classify_metric(source_title)
+            if not metric or len(points) < 2:
+                continue
+            monthly = [(year * 12 + month - 1, value) for (year, month), value in points if month]
+            yearly = [(year, value) for (year, month), value in points if not month]
+            frequency, periods = ("monthly", monthly) if len(monthly) >= len(yearly) else ("yearly", yearly)
+            if len(periods) < 2:
+                continue
+            periods.sort()
+            series.append({
+                "metric": metric,
+                "label": label or metric,
+                "source": source_title,
+                "frequency": frequency,
+                "periods": np.array([period for period, _ in periods], dtype=np.int32),
+                "values": np.array([value for _, value in periods], dtype=np.float64)
+            })
+        return series
+    
+    # --- 増分更新 ---
+    
+    async def refresh(self, data_api: "KanazawaDataAPI") -> Dict[str, int]:
+        """更新日時が変わったリソースだけを取り直して系列を差し替え、統計を再計算する"""
+        seen, updated, unchanged = set(), 0, 0
+        for query in TREND_SEARCH_QUERIES:
+            for dataset in DatasetRecord.from_ckan_list(await data_api.search_datasets(query, limit=30)):
+                for resource in dataset.resources:
+                    if resource.format not in TABLE_RESOURCE_FORMATS or not resource.url or resource.url in seen:
+                        continue
+                    seen.add(resource.url)
+                    version = resource.last_modified or dataset.metadata_modified
+                    if version and self.resource_versions.get(resource.url) == version:
+                        unchanged += 1
+                        continue
+                    text = await data_api.download_table(resource)
+                    if text is None:
+                        continue
+                    series = await cpu_pool.run(self.extract_series, text, f"{dataset.title} {resource.name}".strip(), size=len(text))
+                    self.replace_resource(resource.url, version, series)
+                    updated += 1
+        if updated:
+            self.recompute()
+            self.save()
+        print(f"時系列トレンド更新: 更新{updated}件, 変更なし{unchanged}件, 系列{len(self.series)}件")
+        return {"updated_resources": updated, "unchanged_resources": unchanged, "series": len(self.series)}
+    
+    def replace_resource(self, resource_url: str, version: str, series: List[Dict[str, Any]]) -> None:
+        """リソース由来の系列を丸ごと差し替える"""
+        with self._lock:
+            self.series = {key: value for key, value in self.series.items() if value["resource"] != resource_url}
+            for index, item in enumerate(series):
+                series_id = hashlib.sha1(f"{resource_url}#{index}#{item['label']}".encode("utf-8")).hexdigest()[:12]
+                self.series[series_id] = {**item, "resource": resource_url}
+            self.resource_versions[resource_url] = version
+    
+    # --- 一括計算 ---
+    
+    @staticmethod
+    def _to_matrix(series: List[Dict[str, Any]]) -> Tuple[np.ndarray, int]:
+        """系列を共通の期間軸に並べた行列（欠損はNaN）と先頭期間を返す"""
+        start = min(int(item["periods"][0]) for item in series)
+        end = max(int(item["periods"][-1]) for item in series)
+        matrix = np.full((len(series), end - start + 1), np.nan)
+        for row, item in enumerate(series):
+            matrix[row, item["periods"] - start] = item["values"]
+        return matrix, start
+    
+    def _yearly_matrix(self, ids: List[str]) -> Tuple[np.ndarray, int, List[str]]:
+        """全系列を年次の行列にする（月次系列は12か月そろった年だけ合計、ストック指標は平均）"""
+        yearly_ids = [series_id for series_id in ids if self.series[series_id]["frequency"] == "yearly"]
+        monthly_ids = [series_id for series_id in ids if self.series[series_id]["frequency"] == "monthly"]
+        blocks: List[Tuple[List[str], np.ndarray, int]] = []
+        if yearly_ids:
+            matrix, start = self._to_matrix([self.series[series_id] for series_id in yearly_ids])
+            blocks.append((yearly_ids, matrix, start))
+        if monthly_ids:
+            monthly, start = self._to_matrix([self.series[series_id] for series_id in monthly_ids])
+            # 1月始まり・12か月単位にそろえて (系列, 年, 月) に変形
+            lead = start % 12
+            width = -(-(lead + monthly.shape[1]) // 12) * 12
+            padded = np.full((len(monthly_ids), width), np.nan)
+            padded[:, lead:lead + monthly.shape[1]] = monthly
+            cube = padded.reshape(len(monthly_ids), -1, 12)
+            counts = np.sum(~np.isnan(cube), axis=2)
+            with np.errstate(invalid="ignore"), warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                sums = np.nansum(cube, axis=2)
+                means = np.nanmean(cube, axis=2)
+            stock = np.array([self.series[series_id]["metric"] in self.STOCK_METRICS for series_id in monthly_ids])[:, None]
+            yearly = np.where(stock, np.where(counts >= 1, means, np.nan), np.where(counts == 12, sums, np.nan))
+            blocks.append((monthly_ids, yearly, start // 12))
+        start = min(block_start for _, _, block_start in blocks)
+        end = max(block_start + matrix.shape[1] for _, matrix, block_start in blocks)
+        combined = np.full((len(ids), end - start), np.nan)
+        order = []
+        row = 0
+        for block_ids, matrix, block_start in blocks:
+            combined[row:row + len(block_ids), block_start - start:block_start - start + matrix.shape[1]] = matrix
+            order.extend(block_ids)
+            row += len(block_ids)
+        return combined, start, order
+    
+    def recompute(self) -> None:
+        """全系列の成長率・前年比・翌年予測・季節性をベクトル演算でまとめて計算"""
+        with self._lock:
+            ids = list(self.series)
+            if not ids:
+                self.stats = {}
+                return
+            matrix, start, order = self._yearly_matrix(ids)
+            years = np.arange(start, start + matrix.shape[1], dtype=np.float64)
+            valid = ~np.isnan(matrix) & (np.nan_to_num(matrix) > 0)
+            has_data = valid.any(axis=1)
+            last_index = matrix.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+            last_year = years[last_index]
+            
+            # 直近TREND_WINDOW_YEARS年の対数値に回帰直線を当てて年平均成長率と翌年予測を出す
+            weights = valid & (years[None, :] > (last_year - self.TREND_WINDOW_YEARS)[:, None])
+            log_values = np.log(np.where(weights, matrix, 1.0))
+            points = weights.sum(axis=1)
+            safe_points = np.maximum(points, 1)
+            x_mean = (weights * years).sum(axis=1) / safe_points
+            y_mean = (weights * log_values).sum(axis=1) / safe_points
+            dx = np.where(weights, years[None, :] - x_mean[:, None], 0.0)
+            denominator = (dx * dx).sum(axis=1)
+            slope = np.divide((dx * (log_values - y_mean[:, None])).sum(axis=1), denominator,
+                              out=np.zeros_like(denominator), where=denominator > 0)
+            growth_rate = np.expm1(slope)
+            forecast = np.exp(y_mean + slope * (last_year + 1 - x_mean))
+            last_value = matrix[np.arange(len(order)), last_index]
+            previous_index = np.maximum(last_index - 1, 0)
+            previous_value = matrix[np.arange(len(order)), previous_index]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                yoy = np.where((last_index > 0) & (previous_value > 0), last_value / previous_value - 1, np.nan)
+            
+            seasonality = self._seasonality([series_id for series_id in order if self.series[series_id]["frequency"] == "monthly"])
+            
+            stats = {}
+            for row, series_id in enumerate(order):
+                if not has_data[row] or points[row] < 2:
+                    continue
+                item = self.series[series_id]
+                stats[series_id] = {
+                    "id": series_id,
+                    "metric": item["metric"],
+                    "label": item["label"],
+                    "source": item["source"],
+                    "frequency": item["frequency"],
+                    "last_year": int(last_year[row]),
+                    "last_value": round(float(last_value[row]), 2),
+                    "annual_growth_rate": round(float(growth_rate[row]) * 100, 2),
+                    "yoy_change": None if np.isnan(yoy[row]) else round(float(yoy[row]) * 100, 2),
+                    "forecast_year": int(last_year[row]) + 1,
+                    "forecast_value": round(float(forecast[row]), 2),
+                    "points": int(points[row]),
+                    "seasonality": seasonality.get(series_id)
+                }
+            self.stats = stats
+            self.refreshed_at = datetime.now().isoformat()
+    
+    def _seasonality(self, monthly_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """月次系列の季節指数（各月の値 ÷ その年の月平均）を暦月ごとに平均"""
+        if not monthly_ids:
+            return {}
+        matrix, start = self._to_matrix([self.series[series_id] for series_id in monthly_ids])
+        lead = start % 12
+        width = -(-(lead + matrix.shape[1]) // 12) * 12
+        padded = np.full((len(monthly_ids), width), np.nan)
+        padded[:, lead:lead + matrix.shape[1]] = matrix
+        cube = padded.reshape(len(monthly_ids), -1, 12)
+        with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            ratios = cube / np.nanmean(cube, axis=2, keepdims=True)
+            index = np.nanmean(ratios, axis=1)  # (系列, 12)
+        result = {}
+        for row, series_id in enumerate(monthly_ids):
+            if np.sum(~np.isnan(index[row])) < 12:
+                continue
+            result[series_id] = {
+                "peak_month": int(np.nanargmax(index[row])) + 1,
+                "trough_month": int(np.nanargmin(index[row])) + 1,
+                "amplitude": round(float(np.nanmax(index[row]) - np.nanmin(index[row])), 3),
+                "monthly_index": [round(float(value), 3) for value in index[row]]
+            }
+        return result
+    
+    # --- 問い合わせ ---
+    
+    def trends_for(self, metrics: List[str], per_metric: int = 2) -> List[Dict[str, Any]]:
+        """指標ごとに代表系列（値が最大＝総数に近い系列）と、最も伸びている内訳系列を返す"""
+        selected = []
+        for metric in metrics:
+            candidates = [stat for stat in self.stats.values() if stat["metric"] == metric]
+            if not candidates:
+                continue
+            main = max(candidates, key=lambda stat: stat["last_value"])
+            selected.append(main)
+            others = sorted((stat for stat in candidates if stat is not main),
+                            key=lambda stat: stat["annual_growth_rate"], reverse=True)
+            selected.extend(others[:per_metric - 1])
+        return selected
+    
+    # --- 保存・読み込み ---
+    
+    def save(self) -> None:
+        with self._lock:
+            ids = list(self.series)
+            meta = {
+                "refreshed_at": self.refreshed_at,
+                "resource_versions": self.resource_versions,
+                "series": [
+                    {key: value for key, value in self.series[series_id].items() if key not in ("periods", "values")}
+                    | {"id": series_id, "length": len(self.series[series_id]["periods"])}
+                    for series_id in ids
+                ]
+            }
+            periods = np.concatenate([self.series[series_id]["periods"] for series_id in ids]) if ids else np.empty(0, np.int32)
+            values = np.concatenate([self.series[series_id]["values"] for series_id in ids]) if ids else np.empty(0)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}.npz"
+        np.savez_compressed(tmp_path, periods=periods, values=values,
+                            meta=np.array(json.dumps(meta, ensure_ascii=False)))
+        os.replace(tmp_path, self.path)
+    
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as data:
+                meta = json.loads(str(data["meta"]))
+                periods, values = data["periods"], data["values"]
+        except Exception as e:
+            print(f"時系列トレンド読み込みエラー: {e}")
+            return False
+        series, offset = {}, 0
+        for item in meta["series"]:
+            length = item.pop("length")
+            series_id = item.pop("id")
+            series[series_id] = {**item, "periods": periods[offset:offset + length], "values": values[offset:offset + length]}
+            offset += length
+        self.series = series
+        self.resource_versions = meta.get("resource_versions", {})
+        self.recompute()
+        print(f"時系列トレンド読み込み完了: {len(self.series)}系列")
+        return True
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            "available": self.available,
+            "series": len(self.series),
+            "resources": len(self.resource_versions),
+            "refreshed_at": self.refreshed_at
+        }
+
+class AreaSegmentationModel:
+    """町丁・地区ごとの年齢構成と施設集積を特徴量にKMeansでクラスタリングし、エリア別のセグメント構成を保持する"""
+    
+    MODEL_FILE = "model.joblib"
+    SEGMENTS_FILE = "segments.json"
+    FEATURES = ["children_share", "young_adult_share", "elderly_share", "facility_density", "tourism_share"]
+    AGE_BINS = {"children": (0, 14), "young_adult": (20, 39), "working_age": (15, 64), "elderly": (65, 99)}
+    CLUSTER_LABELS = {
+        "children_share": "ファミリー層中心",
+        "young_adult_share": "若年層中心",
+        "elderly_share": "高齢者中心",
+        "facility_density": "商業集積",
+        "tourism_share": "観光集積"
+    }
+    AGE_RANGE = re.compile(r"(\d+)\s*[～〜~\-－ー]\s*(\d+)\s*歳")
+    AGE_OVER = re.compile(r"(\d+)\s*歳\s*以上")
+    AGE_SINGLE = re.compile(r"(\d+)\s*歳")
+    AGE_GROUP_NAMES = {"年少人口": (0, 14), "生産年齢人口": (15, 64), "老年人口": (65, 99)}
+    UNIT_COLUMN_HINTS = ("町", "地区", "地域", "校下", "名称", "区分")
+    
+    def __init__(self, directory: str, clusters: int = 4):
+        self.directory = directory
+        self.clusters = clusters
+        self.model: Optional[Dict[str, Any]] = None
+        self.profiles: Dict[str, Dict[str, Any]] = {}
+        self.assignments: Dict[str, int] = {}
+        self.meta: Dict[str, Any] = {}
+    
+    @property
+    def available(self) -> bool:
+        return bool(self.profiles)
+    
+    # --- 特徴量の抽出 ---
+    
+    @classmethod
+    def parse_age_column(cls, name: str) -> Optional[Tuple[int, int]]:
+        """「0～4歳」「65歳以上」「老年人口」などの列名を年齢の範囲に変換"""
+        name = name.translate(FULLWIDTH_DIGITS)
+        for group, age_range in cls.AGE_GROUP_NAMES.items():
+            if group in name:
+                return age_range
+        match = cls.AGE_RANGE.search(name)
+        if match:
+            return int(match.group(1)), int(match.group(2))
+        match = cls.AGE_OVER.search(name)
+        if match:
+            return int(match.group(1)), 99
+        match = cls.AGE_SINGLE.search(name)
+        if match:
+            return int(match.group(1)), int(match.group(1))
+        return None
+    
+    @classmethod
+    def extract_age_table(cls, text: str) -> Dict[str, Dict[str, float]]:
+        """町丁別・年齢別人口のCSVから単位（町丁・地区）ごとの年齢区分別人口を集計"""
+        import csv
+        import io
+        
+        rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+        if len(rows) < 3:
+            return {}
+        header, body = [cell.strip() for cell in rows[0]], rows[1:]
+        age_columns = {index: age_range for index, name in enumerate(header) if (age_range := cls.parse_age_column(name))}
+        # 他の列の範囲を含む集計列（「0～14歳」と「0～4歳」が両方ある場合の前者など）は二重計上になるので除く
+        age_columns = {
+            index: (low, high) for index, (low, high) in age_columns.items()
+            if not any(other != index and low <= other_low and other_high <= high and (other_low, other_high) != (low, high)
+                       for other, (other_low, other_high) in age_columns.items())
+        }
+        if len(age_columns) < 3:
+            return {}
+        unit_index = next(
+            (index for index, name in enumerate(header)
+             if index not in age_columns and any(hint in name for hint in cls.UNIT_COLUMN_HINTS)),
+            next((index for index in range(len(header)) if index not in age_columns), None)
+        )
+        if unit_index is None:
+            return {}
+        
+        units: Dict[str, Dict[str, float]] = {}
+        for row in body:
+            unit = row[unit_index].strip() if unit_index < len(row) else ""
+            if not unit or any(word in unit for word in ("合計", "総数", "総計")) or unit == "計":
+                continue
+            bins = units.setdefault(unit, {name: 0.0 for name in [*cls.AGE_BINS, "total"]})
+            for index, (low, high) in age_columns.items():
+                value = TimeSeriesTrendEngine.parse_number(row[index]) if index < len(row) else None
+                if not value:
+                    continue
+                bins["total"] += value
+                # 区分の境界をまたぐ列は年齢幅の重なりに応じて按分
+                for name, (bin_low, bin_high) in cls.AGE_BINS.items():
+                    overlap = min(high, bin_high) - max(low, bin_low) + 1
+                    if overlap > 0:
+                        bins[name] += value * overlap / (high - low + 1)
+        return {unit: bins for unit, bins in units.items() if bins["total"] > 0}
+    
+    @staticmethod
+    def area_of(unit: str) -> Optional[str]:
+        """町丁名に含まれるエリア名（香林坊・東山など）からエリアを判定"""
+        return next((area for area in AREA_GEOMETRY if area in unit), None)
+    
+    def feature_matrix(self, units: Dict[str, Dict[str, float]]) -> Tuple[List[str], np.ndarray]:
+        """単位ごとの特徴量行列（年齢構成比＋所属エリアの施設密度・観光施設の比率）"""
+        names = sorted(units)
+        rows = []
+        for unit in names:
+            bins = units[unit]
+            area = self.area_of(unit) or ""
+            facilities = facility_index.count(area) if facility_index.available else 0
+            rows.append([
+                bins["children"] / bins["total"],
+                bins["young_adult"] / bins["total"],
+                bins["elderly"] / bins["total"],
+                facility_index.density(area) if facility_index.available else 0.0,
+                facility_index.count(area, "観光業") / facilities if facilities else 0.0
+            ])
+        return names, np.array(rows, dtype=np.float64)
+    
+    # --- 構築 ---
+    
+    def build(self, units: Dict[str, Dict[str, float]]) -> Dict[str, Any]:
+        """クラスタリングしてモデル・割り当て・エリア別プロファイルを保存"""
+        import joblib
+        
+        if len(units) < 2:
+            raise ValueError("クラスタリングに必要な町丁・地区のデータがありません")
+        started = time.perf_counter()
+        names, features = self.feature_matrix(units)
+        scaler = StandardScaler()
+        scaled = scaler.fit_transform(features)
+        clusters = min(self.clusters, len(names))
+        kmeans = KMeans(n_clusters=clusters, n_init=10, random_state=0)
+        assignments = kmeans.fit_predict(scaled)
+        labels = self._label_clusters(kmeans.cluster_centers_)
+        
+        profiles = {}
+        for area in ["", *AREA_GEOMETRY]:
+            members = [i for i, unit in enumerate(names) if not area or self.area_of(unit) == area]
+            if members:
+                profiles[area] = self._profile([names[i] for i in members], [int(assignments[i]) for i in members], units, labels)
+        
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {
+            "built_at": datetime.now().isoformat(),
+            "units": len(names),
+            "clusters": clusters,
+            "features": self.FEATURES,
+            "cluster_labels": labels,
+            "inertia": round(float(kmeans.inertia_), 3)
+        }
+        document = {
+            **meta,
+            "assignments": {unit: int(cluster) for unit, cluster in zip(names, assignments)},
+            "profiles": profiles
+        }
+        self._write_atomic(self.MODEL_FILE, lambda f: joblib.dump({"scaler": scaler, "kmeans": kmeans}, f))
+        self._write_atomic(self.SEGMENTS_FILE, lambda f: f.write(json.dumps(document, ensure_ascii=False).encode("utf-8")))
+        self.load()
+        return {**meta, "build_seconds": round(time.perf_counter() - started, 2)}
+    
+    def _label_clusters(self, centers: np.ndarray) -> List[str]:
+        """標準化後の重心で最も大きい特徴量からクラスタ名を付ける"""
+        labels = []
+        for center in centers:
+            label = self.CLUSTER_LABELS[self.FEATURES[int(np.argmax(center))]]
+            count = sum(1 for existing in labels if existing.startswith(label))
+            labels.append(f"{label}（{count + 1}）" if count else label)
+        return labels
+    
+    def _profile(self, members: List[str], clusters: List[int], units: Dict[str, Dict[str, float]],
+                 labels: List[str]) -> Dict[str, Any]:
+        """エリア内の人口で重み付けしたセグメント構成と年齢構成"""
+        population = sum(units[unit]["total"] for unit in members)
+        segment_population: Dict[str, float] = {}
+        for unit, cluster in zip(members, clusters):
+            segment_population[labels[cluster]] = segment_population.get(labels[cluster], 0.0) + units[unit]["total"]
+        shares = {label: round(value / population * 100, 1)
+                  for label, value in sorted(segment_population.items(), key=lambda item: -item[1])}
+        return {
+            "population": int(population),
+            "units": len(members),
+            "dominant_segment": next(iter(shares)),
+            "segment_shares": shares,
+            "age_shares": {
+                name: round(sum(units[unit][name] for unit in members) / population * 100, 1)
+                for name in self.AGE_BINS
+            }
+        }
+    
+    def _write_atomic(self, name: str, write) -> None:
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    
+    def load(self) -> bool:
+        """保存済みのモデルとエリア別プロファイルを読み込む"""
+        import joblib
+        
+        try:
+            with open(os.path.join(self.directory, self.SEGMENTS_FILE), encoding="utf-8") as f:
+                document = json.load(f)
+            self.model = joblib.load(os.path.join(self.directory, self.MODEL_FILE))
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"エリアセグメント読み込みエラー: {e}")
+            return False
+        self.profiles = document.pop("profiles")
+        self.assignments = document.pop("assignments")
+        self.meta = document
+        print(f"エリアセグメント読み込み完了: {document['units']}地区, {document['clusters']}クラスタ")
+        return True
+    
+    # --- 問い合わせ ---
+    
+    def profile(self, area: str) -> Optional[Dict[str, Any]]:
+        """エリアのプロファイル（町丁データがないエリアは市全体）"""
+        if area in self.profiles:
+            return {"area": area or "金沢市全域", **self.profiles[area]}
+        if "" in self.profiles:
+            return {"area": "金沢市全域", **self.profiles[""]}
+        return None
+    
+    def status(self) -> Dict[str, Any]:
+        return {"available": self.available, **self.meta}
+
+def _warm_up_worker(index: int) -> int:
+    """ワーカープロセスを起動させるための空タスク"""
+    return index
+
+def default_cpu_pool_start_method() -> str:
+    """ワーカーの起動方式の既定値（スレッドやロックを持つ親をforkしないよう、forkserverかspawnを使う）"""
+    import multiprocessing
+    return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def xlsx_to_csv_text(raw: bytes) -> Optional[str]:
+    """XLSXの先頭シートをCSVテキストに変換（openpyxlがなければNone）"""
+    import io
+    try:
+        frame = pd.read_excel(io.BytesIO(raw), sheet_name=0, header=None, dtype=str)
+    except ImportError:
+        print("XLSXの解析にはopenpyxlが必要です")
+        return None
+    except Exception as e:
+        print(f"XLSX解析エラー: {e}")
+        return None
+    return frame.dropna(how="all").fillna("").to_csv(index=False, header=False)
+
+class CPUWorkPool:
+    """CSV/XLSXの解析や数値抽出などCPU負荷の高い処理をプロセスプールで実行し、イベントループを止めないようにする
+
+    プロセス間の受け渡しが処理より高くつく小さな入力（min_pool_bytes未満）とプール無効時はスレッドで実行する。
+    リクエストごとにイベントループが異なるため、投入数の上限はループをまたいで共有する待ち行列で管理する。
+    """
+    
+    def __init__(self, workers: int = 0, max_pending: int = 64, queue_timeout: float = 30.0,
+                 start_method: Optional[str] = None, min_pool_bytes: int = 65536):
+        self.workers = max(0, workers)
+        self.max_pending = max(1, max_pending)
+        self.queue_timeout = queue_timeout
+        self.start_method = start_method or default_cpu_pool_start_method()
+        self.min_pool_bytes = max(0, min_pool_bytes)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._waiters: deque = deque()  # 空きを待つ(ループ, Future)
+        self.completed = 0
+        self.inline = 0
+        self.queue_waits = 0
+        self.failures = 0
+        self.restarts = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+    
+    def _get_executor(self):
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context(self.start_method))
+            return self._executor
+    
+    def warm_up(self) -> None:
+        """全ワーカーを起動しておく（最初の解析処理でプロセス起動を待たないように）
+        
+        ワーカーはこのモジュールを読み込んで起動するため、モジュールの読み込み中には呼ばず、
+        読み込みが終わってから（起動時または最初のリクエストで）呼び出す。
+        """
+        import multiprocessing
+        
+        if not self.enabled or multiprocessing.parent_process() is not None:
+            return
+        started = time.perf_counter()
+        list(self._get_executor().map(_warm_up_worker, range(self.workers)))
+        print(f"CPUワーカープールを起動: {self.workers}プロセス, {time.perf_counter() - started:.2f}秒")
+    
+    async def run(self, func, *args, size: Optional[int] = None):
+        """funcをワーカープロセスで実行（sizeは入力の大きさで、min_pool_bytes未満ならスレッドで実行）
+
+        待ち行列が上限に達している間は空きを待ち、待ちきれなければ別スレッドで実行する。
+        """
+        with trace_span(f"cpu.{getattr(func, '__name__', 'task')}", {"cpu_pool.workers": self.workers, "cpu_pool.input_size": size}):
+            return await self._run(func, *args, size=size)
+    
+    async def _run(self, func, *args, size: Optional[int] = None):
+        if not self.enabled or (size is not None and size < self.min_pool_bytes):
+            self.inline += 1
+            with profile_stage(f"cpu.{getattr(func, '__name__', 'task')}"):
+                return await asyncio.to_thread(func, *args)
+        if not await self._reserve():
+            # プールが詰まっている場合は別スレッドで実行（イベントループは止めない）
+            self.inline += 1
+            return await asyncio.to_thread(func, *args)
+        from concurrent.futures.process import BrokenProcessPool
+        
+        try:
+            executor = self._get_executor()
+            with profile_stage(f"cpu.{getattr(func, '__name__', 'task')}"):
+                return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool as e:
+            # ワーカーが異常終了したプールは使えないので、次の呼び出しで作り直し、この処理は別スレッドで実行する
+            self.failures += 1
+            self._discard_executor(executor)
+            print(f"CPUワーカープールが異常終了したため再作成します: {e}")
+            self.inline += 1
+            return await asyncio.to_thread(func, *args)
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            with self._lock:
+                self.completed += 1
+            self._release()
+    
+    async def _reserve(self) -> bool:
+        """投入枠を確保する（空くまで最大queue_timeout秒待ち、確保できなければFalse）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._pending < self.max_pending:
+                self._pending += 1
+                return True
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+            self.queue_waits += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            return True
+        except BaseException as e:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, waiter))
+                    handed_over = False
+                except ValueError:
+                    handed_over = True  # 枠は既に渡されている（または渡す途中）
+            if handed_over:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()
+                else:
+                    waiter.cancel()  # 渡す途中の枠は_handoverが返却する
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+    
+    def _release(self) -> None:
+        """投入枠を返す（待っている呼び出しがあれば、そのまま枠を引き継ぐ）"""
+        with self._lock:
+            while self._waiters:
+                loop, waiter = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._handover, waiter)
+                    return
+                except RuntimeError:
+                    continue  # 待っていたループが既に閉じている
+            self._pending -= 1
+    
+    def _handover(self, waiter: asyncio.Future) -> None:
+        if waiter.done():
+            self._release()  # 待ち手がタイムアウト・キャンセル済みなら次へ回す
+        else:
+            waiter.set_result(None)
+    
+    def _discard_executor(self, executor) -> None:
+        """壊れたプールを破棄する（他の呼び出しが作り直した新しいプールは残す）"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self.restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def ensure_warm(self) -> None:
+        """まだ起動していなければワーカーを起動（最初のリクエストから呼ばれる）"""
+        if self.enabled and self._executor is None:
+            self.warm_up()
+    
+    def shutdown(self, wait: bool = False) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait, cancel_futures=True)
+                self._executor = None
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "pending": self._pending,
+            "waiting": len(self._waiters),
+            "max_pending": self.max_pending,
+            "min_pool_bytes": self.min_pool_bytes,
+            "completed": self.completed,
+            "inline": self.inline,
+            "queue_waits": self.queue_waits,
+            "failures": self.failures,
+            "restarts": self.restarts
+        }
+
+# CPU負荷の高い解析処理のプロセスプール（0でプールを使わずその場で実行）
+cpu_pool = CPUWorkPool(
+    workers=int(os.getenv("CPU_POOL_WORKERS", "0")),
+    max_pending=int(os.getenv("CPU_POOL_MAX_PENDING", "64")),
+    queue_timeout=float(os.getenv("CPU_POOL_QUEUE_TIMEOUT_SECONDS", "30")),
+    start_method=os.getenv("CPU_POOL_START_METHOD") or None,
+    min_pool_bytes=int(os.getenv("CPU_POOL_MIN_BYTES", "65536"))
+)
+# 解析対象にする表形式リソースの形式
+TABLE_RESOURCE_FORMATS = ("csv", "xlsx", "xls")
+
+def extract_numbers_from_text(text: str, context: str) -> List[Dict[str, Any]]:
+    """テキストから数値を抽出（プロセスプールのワーカーでも実行されるためモジュール関数にしている）"""
+    extracted = []
+    
+    # 人口関連の数値パターン
+    population_patterns = [
+        r'人口[：:\s]*([0-9,]+)人?',
+        r'総人口[：:\s]*([0-9,]+)人?',
+        r'([0-9,]+)人',
+        r'人口密度[：:\s]*([0-9,]+\.?[0-9]*)',
+    ]
     
-    # 行の先頭と末尾の空白を除去
-    lines = [line.strip() for line in text.split('\n')]
+    # 事業所・企業関連の数値パターン
+    business_patterns = [
+        r'事業所数[：:\s]*([0-9,]+)',
+        r'企業数[：:\s]*([0-9,]+)',
+        r'店舗数[：:\s]*([0-9,]+)',
+        r'従業員数[：:\s]*([0-9,]+)',
+    ]
     
-    # 空行を適切に配置し、段落構造を改善
-    formatted_lines = []
-    for i, line in enumerate(lines):
-        if line:  # 空行でない場合
-            # 見出し行の前後に空行を追加
-            if ('■' in line or '◆' in line or '★' in line or '━' in line):
-                if formatted_lines and formatted_lines[-1]:
-                    formatted_lines.append('')
-                formatted_lines.append(line)
-                formatted_lines.append('')
-            # リスト項目の場合
-            elif line.startswith('  ▶') or line.startswith('  【'):
-                formatted_lines.append(line)
-            # 通常の文章の場合
-            else:
-                formatted_lines.append(line)
-        elif i > 0 and formatted_lines and formatted_lines[-1]:  # 前の行が空行でない場合のみ空行を追加
-            formatted_lines.append('')
+    # 経済関連の数値パターン
+    economic_patterns = [
+        r'売上[：:\s]*([0-9,]+)万?円',
+        r'収入[：:\s]*([0-9,]+)万?円',
+        r'GDP[：:\s]*([0-9,]+)',
+        r'([0-9,]+)億円',
+        r'([0-9,]+)万円',
+    ]
     
-    # 最終的な整形
-    result = '\n'.join(formatted_lines)
+    # 観光関連の数値パターン
+    tourism_patterns = [
+        r'観光客数[：:\s]*([0-9,]+)',
+        r'宿泊者数[：:\s]*([0-9,]+)',
+        r'入込客数[：:\s]*([0-9,]+)',
+    ]
     
-    # 先頭と末尾の余分な改行を除去
-    result = result.strip()
+    all_patterns = [
+        ("population", population_patterns),
+        ("business", business_patterns),
+        ("economic", economic_patterns),
+        ("tourism", tourism_patterns)
+    ]
     
-    # 最後に全体の構造を整える
-    result = re.sub(r'\n\n\n+', '\n\n', result)  # 3つ以上の連続改行を2つに
+    for category, patterns in all_patterns:
+        for pattern in patterns:
+            matches = re.finditer(pattern, text, re.IGNORECASE)
+            for match in matches:
+                try:
+                    value_str = match.group(1).replace(',', '')
+                    value = float(value_str)
+                    
+                    extracted.append({
+                        "category": category,
+                        "value": value,
+                        "unit": determine_unit(match.group(0)),
+                        "context": context,
+                        "raw_match": match.group(0)
+                    })
+                except (ValueError, IndexError):
+                    continue
     
-    return result
+    return extracted
+
+def determine_unit(match_text: str) -> str:
+    """マッチしたテキストから単位を判定"""
+    if "人" in match_text:
+        return "人"
+    elif "万円" in match_text:
+        return "万円"
+    elif "億円" in match_text:
+        return "億円"
+    elif "円" in match_text:
+        return "円"
+    elif "%" in match_text:
+        return "%"
+    elif "密度" in match_text:
+        return "人/km²"
+    else:
+        return "件"
+
+# カタログのベクトルインデックス（flask --app app build-vector-index で構築）
+vector_index = CatalogVectorIndex(os.getenv(
+    "VECTOR_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_index")
+))
+# チャットのコンテキスト取得方法（ckan: CKANのキーワード検索 / vector: ベクトルインデックス）
+CHAT_RETRIEVAL_MODE = os.getenv("CHAT_RETRIEVAL_MODE", "ckan").lower()
+VECTOR_MIN_SCORE = float(os.getenv("VECTOR_MIN_SCORE", "0.1"))
 
 class KanazawaDataAPI:
     """金沢市オープンデータAPIクライアント"""
     
     def __init__(self):
         self.base_url = "https://catalog-data.city.kanazawa.ishikawa.jp/api/3"
-        self.timeout = 10.0
+        self.circuit = ckan_circuit
+        self.cache = shared_cache
+        self.latency = ckan_latency
+        self.hedging = os.getenv("CKAN_HEDGED_REQUESTS", "true").lower() != "false"
     
-    async def search_datasets(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
-        """データセットを検索"""
+    async def _fetch_adaptive(self, action: str, fetch) -> Any:
+        """アクション別の適応タイムアウトで取得し、遅い呼び出しはp95経過後に重複リクエストでヘッジする"""
+        timeout = self.latency.timeout_for(action)
+        delay = self.latency.hedge_delay(action) if self.hedging and action in CKAN_HEDGED_ACTIONS else None
+        
+        async def timed(call_timeout: float, record_timeout: bool = True) -> Tuple[Any, float]:
+            started = time.monotonic()
+            try:
+                return await fetch(call_timeout), time.monotonic() - started
+            except httpx.TimeoutException:
+                # タイムアウトも分布に含め、上流が遅くなったらタイムアウトが伸びるようにする
+                # （ヘッジは短縮したタイムアウトで打ち切るため、分布を実際より短く偏らせないよう記録しない）
+                if record_timeout:
+                    self.latency.record(action, call_timeout)
+                raise
+        
+        if delay is None or delay >= timeout:
+            value, elapsed = await timed(timeout)
+            self.latency.record(action, elapsed)
+            return value
+        
+        tasks: List[asyncio.Future] = []
+        hedge = None
+        error: Optional[BaseException] = None
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(
-                    f"{self.base_url}/action/package_search",
-                    params={
-                        "q": query,
-                        "rows": limit,
-                        "sort": "score desc"
-                    }
-                )
+            primary = asyncio.ensure_future(timed(timeout))
+            tasks.append(primary)
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done:
+                hedge = asyncio.ensure_future(timed(max(timeout - delay, 0.1), record_timeout=False))
+                tasks.append(hedge)
+                self.latency.hedges["issued"] += 1
+                pending = {primary, hedge}
+            else:
+                pending = set()
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        value, elapsed = task.result()
+                        self.latency.record(action, elapsed)
+                        if task is hedge:
+                            self.latency.hedges["won"] += 1
+                        return value
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # 負けた呼び出しや、呼び出し側がキャンセルされた場合の実行中の呼び出しを残さない
+            unfinished = [task for task in tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.wait(unfinished)
+    
+    async def _call_upstream(self, cache_key: Tuple[Any, ...], fetch) -> Any:
+        """上流呼び出し。バッチ処理のスコープ内では同じ呼び出しを1回にまとめて結果を共有する"""
+        scope = _upstream_fetch_scope.get()
+        if scope is None:
+            return await self._load_upstream(cache_key, fetch)
+        task = scope["tasks"].get(cache_key)
+        if task is None:
+            task = scope["tasks"][cache_key] = asyncio.ensure_future(self._load_upstream(cache_key, fetch))
+        else:
+            scope["shared"] += 1
+        return await task
+    
+    async def _load_upstream(self, cache_key: Tuple[Any, ...], fetch) -> Any:
+        """共有キャッシュ→サーキットブレーカー経由の上流の順に取得し、失敗・遮断中は最後に成功した結果で代替する"""
+        action = cache_key[0]
+        attributes = {"ckan.action": action, "ckan.circuit_state": self.circuit.state}
+        if action == "package_search":
+            attributes.update({"ckan.query": cache_key[1], "ckan.rows": cache_key[2]})
+        elif action == "resource":
+            attributes["url.full"] = cache_key[1]
+        else:
+            attributes["ckan.dataset_id"] = cache_key[1]
+        with trace_span(f"ckan.{action}", attributes, kind="client") as span, profile_stage(f"ckan.{action}"):
+            value = await self._load_upstream_uncached(cache_key, fetch)
+            if isinstance(value, list):
+                span.set_attribute("ckan.result_count", len(value))
+            return value
+    
+    async def _load_upstream_uncached(self, cache_key: Tuple[Any, ...], fetch) -> Any:
+        cached = await self.cache.aget("ckan", cache_key)
+        if cached is not None and time.time() - cached["stored_at"] < CKAN_CACHE_TTL_SECONDS:
+            current_span().set_attribute("cache.hit", True)
+            return cached["value"]
+        current_span().set_attribute("cache.hit", False)
+        
+        if self.circuit.allow_request():
+            started = time.monotonic()
+            try:
+                value = await self._fetch_adaptive(cache_key[0], fetch)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500:
+                    # 4xxはリクエスト側の問題なので上流は正常とみなす
+                    self.circuit.record_success(time.monotonic() - started)
+                    raise
+                self.circuit.record_failure()
+                print(f"上流エラー ({cache_key[0]}): {e}")
+            except (httpx.HTTPError, ValueError) as e:
+                # TransportError以外のRequestError（DecodingError・TooManyRedirects）も上流の異常として扱う
+                self.circuit.record_failure()
+                print(f"上流エラー ({cache_key[0]}): {e}")
+            except asyncio.CancelledError:
+                # ヘッジやバッチのキャンセルは上流の成否ではないので、試行枠だけ返す
+                self.circuit.release()
+                raise
+            except BaseException:
+                # 想定外の例外でもhalf-openの試行枠を占有したままにしない
+                self.circuit.record_failure()
+                raise
+            else:
+                self.circuit.record_success(time.monotonic() - started)
+                await self.cache.aset("ckan", cache_key, {"value": value, "stored_at": time.time()}, ttl=CKAN_STALE_TTL_SECONDS)
+                return value
+        
+        if cached is None:
+            _record_upstream_status(unavailable=True)
+            raise UpstreamUnavailableError(f"上流APIを利用できません (circuit: {self.circuit.state})")
+        stored_at = datetime.fromtimestamp(cached["stored_at"])
+        print(f"最後に取得できた結果で代替: {cache_key[0]} ({stored_at.isoformat()}時点)")
+        current_span().set_attributes({"ckan.stale": True, "ckan.stale_since": stored_at.isoformat()})
+        _record_upstream_status(stale_since=stored_at)
+        return cached["value"]
+    
+    async def search_datasets(self, query: str, limit: int = 10,
+                              fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """データセットを検索（fieldsを指定するとCKAN側で返却フィールドを絞り込む）"""
+        async def fetch(timeout: float) -> List[Dict[str, Any]]:
+            params = {
+                "q": query,
+                "rows": limit,
+                "sort": "score desc"
+            }
+            if fields:
+                params["fl"] = ",".join(fields)
+            
+            async with httpx.AsyncClient(timeout=timeout, headers=trace_headers()) as client:
+                response = await client.get(f"{self.base_url}/action/package_search", params=params)
+                if fields and response.status_code >= 400:
+                    # fl非対応のCKANでは全フィールドで再検索
+                    print(f"フィールド指定検索に失敗したため全フィールドで再検索: {response.status_code}")
+                    params.pop("fl")
+                    response = await client.get(f"{self.base_url}/action/package_search", params=params)
                 response.raise_for_status()
+                current_span().set_attribute("http.response.body.size", len(response.content))
                 data = response.json()
                 
                 # dataがNoneまたは空の場合の処理
@@ -145,39 +3174,118 @@ class KanazawaDataAPI:
                 results = result.get("results", [])
                 print(f"データセット検索成功: {len(results)}件 (query: {query})")
                 return results
-                
+        
+        try:
+            return await self._call_upstream(
+                ("package_search", query, limit, tuple(fields) if fields else None), fetch
+            )
         except Exception as e:
             print(f"データセット検索エラー: {e}")
             return []
     
     async def get_dataset_detail(self, dataset_id: str) -> Optional[Dict[str, Any]]:
         """データセットの詳細情報を取得"""
-        try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
+        async def fetch(timeout: float) -> Optional[Dict[str, Any]]:
+            async with httpx.AsyncClient(timeout=timeout, headers=trace_headers()) as client:
                 response = await client.get(
                     f"{self.base_url}/action/package_show",
                     params={"id": dataset_id}
                 )
                 response.raise_for_status()
+                current_span().set_attribute("http.response.body.size", len(response.content))
                 data = response.json()
                 return data.get("result")
+        
+        try:
+            return await self._call_upstream(("package_show", dataset_id), fetch)
         except Exception as e:
             print(f"データセット詳細取得エラー: {e}")
             return None
     
+    async def fetch_catalog(self, page_size: int = 500, max_datasets: int = 20000) -> List[Dict[str, Any]]:
+        """カタログ全体のデータセットをページングして取得（インデックス構築用）"""
+        datasets: List[Dict[str, Any]] = []
+        async with httpx.AsyncClient(timeout=ckan_latency.bounds["resource"][1]) as client:
+            while len(datasets) < max_datasets:
+                response = await client.get(
+                    f"{self.base_url}/action/package_search",
+                    params={"q": "*:*", "rows": page_size, "start": len(datasets), "sort": "id asc"}
+                )
+                response.raise_for_status()
+                result = (response.json() or {}).get("result") or {}
+                page = result.get("results", [])
+                datasets.extend(page)
+                print(f"カタログ取得中: {len(datasets)}/{result.get('count', '?')}件")
+                if len(page) < page_size:
+                    break
+        return datasets
+    
     async def get_resource_data(self, resource_url: str) -> Optional[str]:
         """リソースデータを取得（CSV/JSONなど）"""
-        try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
+        async def fetch(timeout: float) -> str:
+            async with httpx.AsyncClient(timeout=timeout, headers=trace_headers()) as client:
                 response = await client.get(resource_url)
                 response.raise_for_status()
+                current_span().set_attribute("http.response.body.size", len(response.content))
                 return response.text[:5000]  # 最初の5000文字のみ
+        
+        try:
+            if resource_url.startswith(self.base_url.rsplit("/api/", 1)[0]):
+                # カタログサイト上のリソースはCKANと同じブレーカーで保護
+                return await self._call_upstream(("resource", resource_url), fetch)
+            return await self._fetch_adaptive("resource", fetch)
         except Exception as e:
             print(f"リソースデータ取得エラー: {e}")
             return None
     
-    async def extract_numerical_data(self, datasets: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """データセットから具体的な数値データを抽出"""
+    async def download_resource(self, resource_url: str, max_bytes: int = 20 * 1024 * 1024) -> Optional[str]:
+        """リソース全体をダウンロードしてテキストで返す（インデックス構築用。Shift_JISのCSVにも対応）"""
+        raw = await self.download_resource_bytes(resource_url, max_bytes)
+        if raw is None:
+            return None
+        for encoding in ("utf-8-sig", "cp932"):
+            try:
+                return raw.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+        return raw.decode("utf-8", errors="replace")
+    
+    async def download_table(self, resource: ResourceSummary) -> Optional[str]:
+        """CSV/XLSXリソースをCSVテキストとして取得（XLSXの解析はCPUワーカープールで実行）"""
+        if resource.format in ("xlsx", "xls"):
+            raw = await self.download_resource_bytes(resource.url)
+            return await cpu_pool.run(xlsx_to_csv_text, raw, size=len(raw)) if raw else None
+        return await self.download_resource(resource.url)
+    
+    async def download_resource_bytes(self, resource_url: str, max_bytes: int = 20 * 1024 * 1024) -> Optional[bytes]:
+        """リソース全体をバイト列で取得（上限を超えたらNone）"""
+        with trace_span("ckan.download", {"url.full": resource_url}, kind="client") as span:
+            raw = await self._download_resource_bytes(resource_url, max_bytes)
+            span.set_attribute("http.response.body.size", len(raw) if raw is not None else 0)
+            return raw
+    
+    async def _download_resource_bytes(self, resource_url: str, max_bytes: int) -> Optional[bytes]:
+        try:
+            async with httpx.AsyncClient(timeout=ckan_latency.bounds["resource"][1], follow_redirects=True,
+                                         headers=trace_headers()) as client:
+                async with client.stream("GET", resource_url) as response:
+                    response.raise_for_status()
+                    chunks = []
+                    size = 0
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > max_bytes:
+                            print(f"リソースが大きすぎるためスキップ: {resource_url}")
+                            return None
+                        chunks.append(chunk)
+            return b"".join(chunks)
+        except Exception as e:
+            print(f"リソースダウンロードエラー: {e}")
+            return None
+    
+    @traced("data.extract_numerical", lambda self, datasets: {"datasets.count": len(datasets)})
+    async def extract_numerical_data(self, datasets: List[Any]) -> Dict[str, Any]:
+        """データセット（CKAN辞書またはDatasetRecord）から具体的な数値データを抽出"""
         try:
             numerical_insights = {
                 "population_data": {},
@@ -187,32 +3295,26 @@ class KanazawaDataAPI:
                 "extracted_values": []
             }
             
-            for dataset in datasets[:5]:  # 上位5件のデータセットを詳細分析
-                if not dataset:
-                    continue
-                
-                dataset_id = dataset.get("id", "")
-                title = dataset.get("title", "")
+            for record in DatasetRecord.from_ckan_list(datasets[:5]):  # 上位5件のデータセットを詳細分析
+                title = record.title
                 
                 print(f"数値データ抽出中: {title}")
                 
-                # データセット詳細を取得
-                detail = await self.get_dataset_detail(dataset_id)
-                if not detail:
-                    continue
-                
-                resources = detail.get("resources", [])
+                # 検索結果にリソース情報がなければデータセット詳細を取得
+                resources = record.resources
+                if not resources:
+                    detail = await self.get_dataset_detail(record.id)
+                    if not detail:
+                        continue
+                    resources = DatasetRecord.from_ckan(detail).resources
                 
                 for resource in resources[:2]:  # 各データセットの上位2リソース
-                    resource_url = resource.get("url", "")
-                    resource_format = resource.get("format", "").lower()
-                    
-                    if resource_format in ["csv", "json", "xlsx"]:
+                    if resource.format in ["csv", "json", "xlsx"]:
                         # リソースデータを取得
-                        raw_data = await self.get_resource_data(resource_url)
+                        raw_data = await self.get_resource_data(resource.url)
                         if raw_data:
                             # 数値を抽出
-                            extracted_numbers = self._extract_numbers_from_text(raw_data, title)
+                            extracted_numbers = await cpu_pool.run(extract_numbers_from_text, raw_data, title, size=len(raw_data))
                             if extracted_numbers:
                                 numerical_insights["extracted_values"].extend(extracted_numbers)
                                 
@@ -228,88 +3330,6 @@ class KanazawaDataAPI:
             print(f"数値データ抽出エラー: {e}")
             return {"error": str(e)}
     
-    def _extract_numbers_from_text(self, text: str, context: str) -> List[Dict[str, Any]]:
-        """テキストから数値を抽出"""
-        import re
-        
-        extracted = []
-        
-        # 人口関連の数値パターン
-        population_patterns = [
-            r'人口[：:\s]*([0-9,]+)人?',
-            r'総人口[：:\s]*([0-9,]+)人?',
-            r'([0-9,]+)人',
-            r'人口密度[：:\s]*([0-9,]+\.?[0-9]*)',
-        ]
-        
-        # 事業所・企業関連の数値パターン
-        business_patterns = [
-            r'事業所数[：:\s]*([0-9,]+)',
-            r'企業数[：:\s]*([0-9,]+)',
-            r'店舗数[：:\s]*([0-9,]+)',
-            r'従業員数[：:\s]*([0-9,]+)',
-        ]
-        
-        # 経済関連の数値パターン
-        economic_patterns = [
-            r'売上[：:\s]*([0-9,]+)万?円',
-            r'収入[：:\s]*([0-9,]+)万?円',
-            r'GDP[：:\s]*([0-9,]+)',
-            r'([0-9,]+)億円',
-            r'([0-9,]+)万円',
-        ]
-        
-        # 観光関連の数値パターン
-        tourism_patterns = [
-            r'観光客数[：:\s]*([0-9,]+)',
-            r'宿泊者数[：:\s]*([0-9,]+)',
-            r'入込客数[：:\s]*([0-9,]+)',
-        ]
-        
-        all_patterns = [
-            ("population", population_patterns),
-            ("business", business_patterns),
-            ("economic", economic_patterns),
-            ("tourism", tourism_patterns)
-        ]
-        
-        for category, patterns in all_patterns:
-            for pattern in patterns:
-                matches = re.finditer(pattern, text, re.IGNORECASE)
-                for match in matches:
-                    try:
-                        value_str = match.group(1).replace(',', '')
-                        value = float(value_str)
-                        
-                        extracted.append({
-                            "category": category,
-                            "value": value,
-                            "unit": self._determine_unit(match.group(0)),
-                            "context": context,
-                            "raw_match": match.group(0)
-                        })
-                    except (ValueError, IndexError):
-                        continue
-        
-        return extracted
-    
-    def _determine_unit(self, match_text: str) -> str:
-        """マッチしたテキストから単位を判定"""
-        if "人" in match_text:
-            return "人"
-        elif "万円" in match_text:
-            return "万円"
-        elif "億円" in match_text:
-            return "億円"
-        elif "円" in match_text:
-            return "円"
-        elif "%" in match_text:
-            return "%"
-        elif "密度" in match_text:
-            return "人/km²"
-        else:
-            return "件"
-    
     def _categorize_numerical_data(self, extracted_numbers: List[Dict], title: str, insights: Dict):
         """抽出した数値をカテゴリ別に分類"""
         for item in extracted_numbers:
@@ -370,61 +3390,318 @@ class KanazawaDataAPI:
         
         return summary
 
+# ビジネスアイデア生成用のJSONスキーマ（Structured Outputs）
+BUSINESS_IDEA_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "concept": {"type": "string"},
+        "services": {"type": "string"},
+        "target_persona": {"type": "string"},
+        "revenue_model": {"type": "string"},
+        "success_keys": {"type": "string"},
+        "feasibility_score": {"type": "number"},
+        "expected_roi": {"type": "number"},
+        "market_potential": {"type": "string"},
+        "swot": {
+            "type": "object",
+            "properties": {
+                "strengths": {"type": "string"},
+                "weaknesses": {"type": "string"},
+                "opportunities": {"type": "string"},
+                "threats": {"type": "string"}
+            },
+            "required": ["strengths", "weaknesses", "opportunities", "threats"],
+            "additionalProperties": False
+        }
+    },
+    "required": [
+        "name", "concept", "services", "target_persona", "revenue_model",
+        "success_keys", "feasibility_score", "expected_roi", "market_potential", "swot"
+    ],
+    "additionalProperties": False
+}
+
+BUSINESS_IDEAS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "business_ideas",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "ideas": {"type": "array", "items": BUSINESS_IDEA_SCHEMA}
+            },
+            "required": ["ideas"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# 並列生成（BUSINESS_IDEAS_MODE=parallel）で1呼び出し1件のアイデアを返させるためのスキーマ
+BUSINESS_IDEA_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "business_idea", "strict": True, "schema": BUSINESS_IDEA_SCHEMA}
+}
+
+BUSINESS_IDEAS_SYSTEM_MESSAGE = "あなたは、金沢の地域資源と最新トレンドを融合させ、ユーザーを感動させる革新的なビジネスアイデアを生み出すAIです。"
+
+# ビジネスアイデアの生成方式（single: 1回の呼び出しで全件をストリーミング / parallel: 切り口ごとに1件ずつ並行生成）
+BUSINESS_IDEAS_MODE = os.getenv("BUSINESS_IDEAS_MODE", "single").lower()
+BUSINESS_IDEA_MAX_TOKENS = int(os.getenv("BUSINESS_IDEA_MAX_TOKENS", "900"))
+BUSINESS_IDEA_ANGLES = [
+    angle.strip() for angle in os.getenv(
+        "BUSINESS_IDEA_ANGLES", "伝統工芸・文化体験,観光客・インバウンド,地域住民の日常・子育て・シニア"
+    ).split(",") if angle.strip()
+]
+
+class IncrementalJSONArrayParser:
+    """ストリーミング中のJSON {"key": [ {...}, {...} ]} から、完成した配列要素を逐次取り出すパーサー"""
+    
+    def __init__(self):
+        self.buffer = ""
+        self._position = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escaped = False
+        self._item_start: Optional[int] = None
+    
+    def feed(self, chunk: str) -> List[Any]:
+        """チャンクを追加し、新たに完成した配列要素のリストを返す"""
+        self.buffer += chunk
+        completed = []
+        
+        while self._position < len(self.buffer):
+            char = self.buffer[self._position]
+            
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                # ルートオブジェクト直下の配列に入った要素の開始位置を記録
+                if char == "{" and self._stack == ["{", "["]:
+                    self._item_start = self._position
+                self._stack.append(char)
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if char == "}" and self._stack == ["{", "["] and self._item_start is not None:
+                    try:
+                        completed.append(json.loads(self.buffer[self._item_start:self._position + 1]))
+                    except json.JSONDecodeError as e:
+                        print(f"ストリーム要素のJSONパースエラー: {e}")
+                    self._item_start = None
+            
+            self._position += 1
+        
+        return completed
+
 class BusinessIntelligenceEngine:
     """ビジネスインテリジェンス分析エンジン - オープンデータからビジネス機会を発見"""
     
     def __init__(self):
         self.data_api = KanazawaDataAPI()
         self.vectorizer = TfidfVectorizer(max_features=1000, stop_words=None)
-        self.scaler = StandardScaler()
+        self.analysis_grid: Optional["AnalysisGridMaterializer"] = None
         
+    @traced("business.analyze", lambda self, industry, target_area="": {"business.industry": industry, "business.area": target_area})
     async def analyze_business_opportunities(self, industry: str, target_area: str = "") -> Dict[str, Any]:
         """業界とエリアに基づいてビジネス機会を分析"""
         try:
             print(f"ビジネス機会分析開始: 業界={industry}, エリア={target_area}")
             
-            # 関連データセットを検索
-            search_queries = [
-                f"{industry} {target_area}",
-                f"人口 統計 {target_area}",
-                f"経済 産業 {industry}",
-                f"観光 {target_area}" if "観光" in industry else f"施設 {target_area}",
-                "年齢別 人口"
-            ]
-            
-            all_datasets = []
-            for query in search_queries:
-                datasets = await self.data_api.search_datasets(query, limit=5)
-                all_datasets.extend(datasets)
-            
-            # データ分析
-            market_analysis = await self._analyze_market_data(all_datasets, industry, target_area)
-            demographic_insights = await self._analyze_demographics(all_datasets)
-            competition_analysis = await self._analyze_competition(all_datasets, industry)
-            trend_predictions = await self._predict_trends(all_datasets, industry)
+            analysis, freshness = await self._get_base_analysis(industry, target_area)
             
             # ビジネスアイデア生成
             business_ideas = await self._generate_business_ideas(
-                market_analysis, demographic_insights, competition_analysis, industry, target_area
+                analysis["market_analysis"], analysis["demographic_insights"],
+                analysis["competition_analysis"], industry, target_area
             )
             
             return {
                 "success": True,
                 "industry": industry,
                 "target_area": target_area,
-                "market_analysis": market_analysis,
-                "demographic_insights": demographic_insights,
-                "competition_analysis": competition_analysis,
-                "trend_predictions": trend_predictions,
+                **analysis,
                 "business_ideas": business_ideas,
-                "datasets_analyzed": len(all_datasets)
+                "analysis_freshness": freshness
             }
             
+        except LLMOverloadedError:
+            raise
         except Exception as e:
             print(f"ビジネス機会分析エラー: {e}")
             return {"success": False, "error": str(e)}
     
-    async def _analyze_market_data(self, datasets: List[Dict], industry: str, area: str) -> Dict[str, Any]:
+    async def stream_business_opportunities(self, industry: str, target_area: str = "") -> AsyncIterator[Dict[str, Any]]:
+        """analyze_business_opportunitiesのストリーミング版。分析結果、完成したアイデア1件ずつ、集計の順にイベントを返す"""
+        started = time.perf_counter()
+        print(f"ビジネス機会分析開始（ストリーミング）: 業界={industry}, エリア={target_area}")
+        analysis, freshness = await self._get_base_analysis(industry, target_area)
+        yield {
+            "type": "analysis",
+            "success": True,
+            "industry": industry,
+            "target_area": target_area,
+            **analysis,
+            "analysis_freshness": freshness,
+            "elapsed_seconds": round(time.perf_counter() - started, 3)
+        }
+        
+        emitted = 0
+        async for idea in self.iter_business_ideas(
+            analysis["market_analysis"], analysis["demographic_insights"],
+            analysis["competition_analysis"], industry, target_area
+        ):
+            emitted += 1
+            yield {"type": "idea", "index": emitted, "idea": idea, "elapsed_seconds": round(time.perf_counter() - started, 3)}
+        
+        fallback_ideas = self._generate_fallback_ideas(industry, target_area) if emitted == 0 else []
+        for index, idea in enumerate(fallback_ideas, start=1):
+            yield {"type": "idea", "index": index, "idea": idea, "fallback": True,
+                   "elapsed_seconds": round(time.perf_counter() - started, 3)}
+        # ideasは送ったアイデアの総数（定型のアイデアを含む）、generated_ideasはLLMが生成した件数
+        yield {"type": "summary", "success": True, "ideas": emitted + len(fallback_ideas), "generated_ideas": emitted,
+               "fallback": bool(fallback_ideas), "elapsed_seconds": round(time.perf_counter() - started, 3)}
+    
+    async def _get_base_analysis(self, industry: str, target_area: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """LLM以外の分析結果と鮮度情報を返す（事前計算済みの分析があればそれを使う）"""
+        entry = self.analysis_grid.get(industry, target_area) if self.analysis_grid else None
+        if entry:
+            freshness = {
+                "source": "grid",
+                "computed_at": entry["computed_at"].isoformat(),
+                "age_seconds": round((datetime.now() - entry["computed_at"]).total_seconds(), 1)
+            }
+            print(f"事前計算済みの分析を使用: 業界={industry}, エリア={target_area} ({freshness['age_seconds']}秒前)")
+            return entry["analysis"], freshness
+        analysis = await self.compute_base_analysis(industry, target_area)
+        return analysis, {"source": "live", "computed_at": datetime.now().isoformat(), "age_seconds": 0.0}
+    
+    @traced("business.analyze_industries", lambda self, industries, target_area="", include_ideas=False: {
+        "business.industries": list(industries), "business.area": target_area, "business.include_ideas": include_ideas
+    })
+    async def analyze_industries(self, industries: List[str], target_area: str = "",
+                                 include_ideas: bool = False) -> Dict[str, Any]:
+        """同じエリアで複数の業界を比較分析（エリア共通の検索・データ取得は1回だけ行い、全業界で共有）"""
+        started = time.perf_counter()
+        print(f"複数業界の比較分析開始: {industries}, エリア={target_area}")
+        
+        async def analyze(industry: str) -> Dict[str, Any]:
+            try:
+                analysis, freshness = await self._get_base_analysis(industry, target_area)
+                result = {"success": True, "industry": industry, **analysis, "analysis_freshness": freshness}
+                if include_ideas:
+                    result["business_ideas"] = await self._generate_business_ideas(
+                        analysis["market_analysis"], analysis["demographic_insights"],
+                        analysis["competition_analysis"], industry, target_area
+                    )
+                return result
+            except LLMOverloadedError:
+                raise
+            except Exception as e:
+                print(f"業界別分析エラー ({industry}): {e}")
+                return {"success": False, "industry": industry, "error": str(e)}
+        
+        with shared_upstream_fetches() as scope:
+            analyses = await asyncio.gather(*(analyze(industry) for industry in industries))
+        
+        comparison = self._build_industry_comparison(analyses)
+        return {
+            "success": True,
+            "target_area": target_area,
+            "industries": industries,
+            "comparison": comparison,
+            "recommended_industry": comparison[0]["industry"] if comparison else None,
+            "analyses": analyses,
+            "batch_stats": {
+                "industries": len(industries),
+                "upstream_calls": len(scope["tasks"]),
+                "shared_upstream_calls": scope["shared"],
+                "elapsed_seconds": round(time.perf_counter() - started, 2)
+            }
+        }
+    
+    def _build_industry_comparison(self, analyses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """業界別の分析結果を総合スコア順の比較表にする"""
+        rows = []
+        for analysis in analyses:
+            if not analysis.get("success"):
+                continue
+            market = analysis.get("market_analysis", {})
+            competition = analysis.get("competition_analysis", {})
+            demographics = analysis.get("demographic_insights", {})
+            # 総合スコア: 市場規模40% + 成長性30% + 競合の少なさ30%
+            overall_score = (
+                market.get("market_size_score", 0) * 0.4
+                + market.get("growth_potential_score", 0) * 0.3
+                + competition.get("competitive_opportunity_score", 0) * 0.3
+            )
+            rows.append({
+                "industry": analysis["industry"],
+                "overall_score": round(overall_score, 1),
+                "market_size_score": market.get("market_size_score", 0),
+                "growth_potential_score": market.get("growth_potential_score", 0),
+                "market_potential_level": market.get("market_potential_level", "不明"),
+                "estimated_roi_percentage": market.get("estimated_roi_percentage", 0),
+                "competition_level": competition.get("competition_level", "不明"),
+                "market_entry_difficulty": competition.get("market_entry_difficulty", 0),
+                "competitive_opportunity_score": competition.get("competitive_opportunity_score", 0),
+                "recommended_strategy": competition.get("recommended_strategy", ""),
+                "primary_target": demographics.get("primary_target_recommendation", "データ不足"),
+                "analysis_confidence": market.get("analysis_confidence", "低"),
+                "datasets_analyzed": analysis.get("datasets_analyzed", 0)
+            })
+        rows.sort(key=lambda row: row["overall_score"], reverse=True)
+        for rank, row in enumerate(rows, 1):
+            row["rank"] = rank
+        return rows
+    
+    async def compute_base_analysis(self, industry: str, target_area: str = "") -> Dict[str, Any]:
+        """LLMを使わない分析（データセット検索・市場・人口統計・競合・トレンド）を実行"""
+        with trace_span("business.base_analysis", {"business.industry": industry, "business.area": target_area}), \
+                profile_stage("analysis.base"):
+            return await self._compute_base_analysis(industry, target_area)
+    
+    async def _compute_base_analysis(self, industry: str, target_area: str) -> Dict[str, Any]:
+        # 関連データセットを並行して検索（エリア共通のクエリは複数業界の分析で共有される）
+        search_queries = [
+            f"{industry} {target_area}",
+            f"人口 統計 {target_area}",
+            f"経済 産業 {industry}",
+            f"観光 {target_area}" if "観光" in industry else f"施設 {target_area}",
+            "年齢別 人口"
+        ]
+        
+        all_datasets = []
+        for datasets in await asyncio.gather(*(self.data_api.search_datasets(query, limit=5) for query in search_queries)):
+            all_datasets.extend(datasets)
+        
+        # データ分析（正規化済みレコードを各分析で共有）
+        records = DatasetRecord.from_ckan_list(all_datasets)
+        current_span().set_attribute("datasets.count", len(records))
+        return {
+            "market_analysis": await self._analyze_market_data(records, industry, target_area),
+            "demographic_insights": await self._analyze_demographics(records, target_area),
+            "competition_analysis": await self._analyze_competition(records, industry, target_area),
+            "trend_predictions": await self._predict_trends(records, industry),
+            "datasets_analyzed": len(records)
+        }
+    
+    # 各分析で使うキーワード（小文字化済み）
+    MARKET_SIZE_KEYWORDS = tuple(keyword.lower() for keyword in ["売上", "収入", "経済", "産業", "事業所", "従業員"])
+    GROWTH_KEYWORDS = tuple(keyword.lower() for keyword in ["増加", "成長", "推移", "変化", "トレンド"])
+    ECONOMIC_KEYWORDS = tuple(keyword.lower() for keyword in ["GDP", "付加価値", "生産性", "雇用", "投資"])
+    TREND_KEYWORDS = tuple((keyword, keyword.lower()) for keyword in ["デジタル", "AI", "環境", "持続可能", "高齢化", "観光", "地域活性化"])
+    
+    @traced("business.market", lambda self, datasets, industry, area: {"datasets.count": len(datasets)})
+    async def _analyze_market_data(self, datasets: List[DatasetRecord], industry: str, area: str) -> Dict[str, Any]:
         """市場データ分析 - 実際の数値データを活用した専門的な分析"""
         try:
             # 実際の数値データを抽出
@@ -455,38 +3732,32 @@ class BusinessIntelligenceEngine:
                 actual_tourists = numerical_data["tourism_data"].get("tourists")
                 print(f"観光データ取得: {actual_tourists}")
             
+            industry_lower = industry.lower()
             for dataset in datasets:
-                if not dataset:
-                    continue
-                    
-                title = dataset.get("title", "").lower()
-                notes = dataset.get("notes", "").lower()
+                title = dataset.title_lower
                 
                 # 市場規模指標の抽出
-                if any(keyword in title or keyword in notes for keyword in 
-                       ["売上", "収入", "経済", "産業", "事業所", "従業員"]):
-                    relevance_score = 90 if industry.lower() in title else 60
+                if dataset.mentions(self.MARKET_SIZE_KEYWORDS):
+                    relevance_score = 90 if industry_lower in title else 60
                     market_size_indicators.append({
-                        "title": dataset.get("title", ""),
+                        "title": dataset.title,
                         "relevance_score": relevance_score,
-                        "data_quality": "高" if len(dataset.get("resources", [])) > 2 else "中"
+                        "data_quality": "高" if dataset.resource_count > 2 else "中"
                     })
                 
                 # 成長指標の抽出
-                if any(keyword in title or keyword in notes for keyword in 
-                       ["増加", "成長", "推移", "変化", "トレンド"]):
+                if dataset.mentions(self.GROWTH_KEYWORDS):
                     trend_strength = 85 if "増加" in title or "成長" in title else 50
                     growth_indicators.append({
-                        "title": dataset.get("title", ""),
+                        "title": dataset.title,
                         "trend_strength": trend_strength,
                         "time_series": "有" if "年次" in title or "月次" in title else "無"
                     })
                 
                 # 経済指標の抽出
-                if any(keyword in title or keyword in notes for keyword in 
-                       ["GDP", "付加価値", "生産性", "雇用", "投資"]):
+                if dataset.mentions(self.ECONOMIC_KEYWORDS):
                     economic_indicators.append({
-                        "title": dataset.get("title", ""),
+                        "title": dataset.title,
                         "indicator_type": "マクロ経済"
                     })
             
@@ -604,21 +3875,50 @@ class BusinessIntelligenceEngine:
                 }
             }
     
-    async def _analyze_demographics(self, datasets: List[Dict]) -> Dict[str, Any]:
+    def _segment_demographics(self, target_area: str) -> Optional[Dict[str, Any]]:
+        """エリアセグメントの事前計算結果から実際の年齢構成に基づくターゲット層を作る（未構築ならNone）"""
+        profile = area_segments.profile(target_area if target_area in AREA_GEOMETRY else "") if area_segments.available else None
+        if not profile:
+            return None
+        city_shares = area_segments.profiles.get("", profile)["age_shares"]
+        target_segments = []
+        for key, segment in DEMOGRAPHIC_SEGMENTS.items():
+            share = profile["age_shares"][key]
+            # 市全体と同じ比率なら50点、2倍以上なら100点
+            score = min(round(share / city_shares[key] * 50), 100) if city_shares.get(key) else 0
+            target_segments.append({
+                **segment,
+                "market_potential_score": score,
+                "estimated_population_ratio": f"{share:.1f}%"
+            })
+        return {
+            "population_datasets_count": profile["units"],
+            "target_segments": target_segments,
+            "demographic_diversity_score": min(len(profile["segment_shares"]) * 25, 100),
+            "population_trend": "高齢化が進行" if profile["age_shares"]["elderly"] > city_shares["elderly"] else "安定",
+            "data_coverage_score": 100 if profile["area"] == target_area else 50,
+            "primary_target_recommendation": max(target_segments, key=lambda x: x["market_potential_score"])["segment"],
+            "area_segment": profile,
+            "demographic_data_source": "area_segments"
+        }
+    
+    @traced("business.demographics", lambda self, datasets, target_area="": {"datasets.count": len(datasets)})
+    async def _analyze_demographics(self, datasets: List[DatasetRecord], target_area: str = "") -> Dict[str, Any]:
         """人口統計分析 - より詳細で専門的な指標を生成"""
         try:
+            segmented = self._segment_demographics(target_area)
+            if segmented:
+                return segmented
+            
             age_data = []
             population_data = []
             demographic_scores = {}
             
             for dataset in datasets:
-                if not dataset:
-                    continue
-                    
-                title = dataset.get("title", "").lower()
+                title = dataset.title_lower
                 
                 if "人口" in title or "年齢" in title:
-                    population_data.append(dataset.get("title", ""))
+                    population_data.append(dataset.title)
                     
                     # 年齢層の推定と重要度スコア
                     if "高齢" in title:
@@ -673,7 +3973,8 @@ class BusinessIntelligenceEngine:
                 "demographic_diversity_score": len(set(age_data)) * 25,
                 "population_trend": population_trend,
                 "data_coverage_score": min(len(population_data) * 20, 100),
-                "primary_target_recommendation": max(target_segments, key=lambda x: x["market_potential_score"])["segment"] if target_segments else "データ不足"
+                "primary_target_recommendation": max(target_segments, key=lambda x: x["market_potential_score"])["segment"] if target_segments else "データ不足",
+                "demographic_data_source": "dataset_titles"
             }
             
         except Exception as e:
@@ -685,41 +3986,72 @@ class BusinessIntelligenceEngine:
                 "data_coverage_score": 0
             }
     
-    async def _analyze_competition(self, datasets: List[Dict], industry: str) -> Dict[str, Any]:
+    @staticmethod
+    def _spatial_competition(industry: str, target_area: str) -> Optional[Dict[str, Any]]:
+        """施設空間インデックスからエリア×業界の競合数と密度を求める（インデックス未構築ならNone）"""
+        if not facility_index.available or facility_index.count("", industry) == 0:
+            return None
+        area = target_area if target_area in AREA_GEOMETRY else ""
+        competitor_density = facility_index.density(area, industry)
+        facility_density = facility_index.density(area)
+        urban_competitor_density = facility_index.urban_average_density(industry)
+        urban_facility_density = facility_index.urban_average_density()
+        # 市街地エリアの平均密度と同じなら50点、2倍以上なら100点
+        competitor_ratio = competitor_density / urban_competitor_density if urban_competitor_density else 0.0
+        facility_ratio = facility_density / urban_facility_density if urban_facility_density else 0.0
+        return {
+            "area": area or "金沢市全域",
+            "area_km2": round(facility_index.area_km2(area), 2),
+            "competitor_count": facility_index.count(area, industry),
+            "facility_count": facility_index.count(area),
+            "competitor_density_per_km2": round(competitor_density, 2),
+            "facility_density_per_km2": round(facility_density, 2),
+            "urban_average_competitor_density_per_km2": round(urban_competitor_density, 2),
+            "density_ratio_to_urban_average": round(competitor_ratio, 2),
+            "business_density_score": round(min(competitor_ratio * 50, 100.0), 1),
+            "facility_density_score": round(min(facility_ratio * 50, 100.0), 1)
+        }
+    
+    @traced("business.competition", lambda self, datasets, industry, target_area="": {"datasets.count": len(datasets)})
+    async def _analyze_competition(self, datasets: List[DatasetRecord], industry: str,
+                                   target_area: str = "") -> Dict[str, Any]:
         """競合分析 - より詳細で専門的な指標を生成"""
         try:
             business_datasets = []
             facility_datasets = []
             competition_indicators = []
             
+            industry_lower = industry.lower()
             for dataset in datasets:
-                if not dataset:
-                    continue
-                    
-                title = dataset.get("title", "").lower()
+                title = dataset.title_lower
                 
                 if any(keyword in title for keyword in ["事業所", "企業", "店舗", "施設"]):
                     if "事業所" in title or "企業" in title:
                         business_datasets.append({
-                            "title": dataset.get("title", ""),
-                            "relevance_score": 80 if industry.lower() in title else 40
+                            "title": dataset.title,
+                            "relevance_score": 80 if industry_lower in title else 40
                         })
                     else:
                         facility_datasets.append({
-                            "title": dataset.get("title", ""),
+                            "title": dataset.title,
                             "facility_type": "商業施設" if "店舗" in title else "公共施設"
                         })
                 
                 # 競合密度指標
                 if any(keyword in title for keyword in ["密度", "分布", "立地"]):
                     competition_indicators.append({
-                        "title": dataset.get("title", ""),
+                        "title": dataset.title,
                         "indicator_type": "立地分析"
                     })
             
-            # 競合密度の詳細計算
-            business_density_score = min(len(business_datasets) * 15, 100)
-            facility_density_score = min(len(facility_datasets) * 10, 100)
+            # 競合密度の詳細計算（施設インデックスがあれば実際の施設数、なければデータセット名の件数から推定）
+            spatial = self._spatial_competition(industry, target_area)
+            if spatial:
+                business_density_score = spatial["business_density_score"]
+                facility_density_score = spatial["facility_density_score"]
+            else:
+                business_density_score = min(len(business_datasets) * 15, 100)
+                facility_density_score = min(len(facility_datasets) * 10, 100)
             
             # 競合レベルの詳細評価
             if business_density_score >= 75:
@@ -739,7 +4071,7 @@ class BusinessIntelligenceEngine:
             # 競合優位性の機会スコア
             opportunity_score = max(0, 100 - saturation_score)
             
-            return {
+            result = {
                 "competition_level": competition_level,
                 "business_density_score": business_density_score,
                 "facility_density_score": facility_density_score,
@@ -747,11 +4079,15 @@ class BusinessIntelligenceEngine:
                 "market_saturation_level": saturation_level,
                 "market_saturation_score": saturation_score,
                 "competitive_opportunity_score": opportunity_score,
-                "business_count_estimate": len(business_datasets),
-                "facility_count_estimate": len(facility_datasets),
+                "business_count_estimate": spatial["competitor_count"] if spatial else len(business_datasets),
+                "facility_count_estimate": spatial["facility_count"] if spatial else len(facility_datasets),
                 "differentiation_potential": "高" if opportunity_score >= 60 else "中" if opportunity_score >= 30 else "低",
-                "recommended_strategy": "ニッチ戦略" if competition_level == "高" else "差別化戦略" if competition_level == "中" else "市場開拓戦略"
+                "recommended_strategy": "ニッチ戦略" if competition_level == "高" else "差別化戦略" if competition_level == "中" else "市場開拓戦略",
+                "competition_data_source": "facility_index" if spatial else "dataset_titles"
             }
+            if spatial:
+                result["spatial_competition"] = spatial
+            return result
             
         except Exception as e:
             print(f"競合分析エラー: {e}")
@@ -762,21 +4098,29 @@ class BusinessIntelligenceEngine:
                 "competitive_opportunity_score": 50
             }
     
-    async def _predict_trends(self, datasets: List[Dict], industry: str) -> Dict[str, Any]:
-        """トレンド予測"""
+    @traced("business.trends", lambda self, datasets, industry: {"datasets.count": len(datasets)})
+    async def _predict_trends(self, datasets: List[DatasetRecord], industry: str) -> Dict[str, Any]:
+        """トレンド予測（時系列データがあれば成長率・予測、なければデータセット名のキーワードから推定）"""
         try:
-            trend_keywords = ["デジタル", "AI", "環境", "持続可能", "高齢化", "観光", "地域活性化"]
+            if trend_engine.available:
+                series_trends = trend_engine.trends_for(INDUSTRY_TREND_METRICS.get(industry, DEFAULT_TREND_METRICS))
+                if series_trends:
+                    ranked = sorted(series_trends, key=lambda stat: stat["annual_growth_rate"], reverse=True)
+                    return {
+                        "emerging_trends": [
+                            {"trend": f"{stat['metric']}（{stat['label']}）", "strength": stat["annual_growth_rate"]}
+                            for stat in ranked[:3]
+                        ],
+                        "series_trends": series_trends,
+                        "future_opportunities": self._generate_series_opportunities(series_trends, industry),
+                        "trend_data_source": "time_series"
+                    }
+            
             detected_trends = []
             
             for dataset in datasets:
-                if not dataset:
-                    continue
-                    
-                title = dataset.get("title", "").lower()
-                notes = dataset.get("notes", "").lower()
-                
-                for keyword in trend_keywords:
-                    if keyword.lower() in title or keyword.lower() in notes:
+                for keyword, keyword_lower in self.TREND_KEYWORDS:
+                    if keyword_lower in dataset.title_lower or keyword_lower in dataset.notes_lower:
                         detected_trends.append(keyword)
             
             # トレンドの重要度計算
@@ -788,13 +4132,34 @@ class BusinessIntelligenceEngine:
             
             return {
                 "emerging_trends": [{"trend": trend, "strength": count} for trend, count in top_trends],
-                "future_opportunities": self._generate_trend_opportunities(top_trends, industry)
+                "future_opportunities": self._generate_trend_opportunities(top_trends, industry),
+                "trend_data_source": "keywords"
             }
             
         except Exception as e:
             print(f"トレンド予測エラー: {e}")
             return {"emerging_trends": [], "future_opportunities": []}
     
+    def _generate_series_opportunities(self, series_trends: List[Dict[str, Any]], industry: str) -> List[str]:
+        """時系列の伸び・縮みから機会を生成"""
+        opportunities = []
+        for stat in series_trends:
+            growing = stat["annual_growth_rate"] > 0
+            label = stat["label"]
+            if stat["metric"] in ("入込客数", "宿泊者数"):
+                opportunities.append(f"観光客・宿泊客の増加を取り込む{industry}サービス" if growing
+                                     else f"地元客のリピートを重視した{industry}サービス")
+            elif stat["metric"] == "事業所数":
+                opportunities.append(f"事業者向け（B2B）{industry}サービス" if growing
+                                     else f"事業承継・空き店舗を活用した{industry}")
+            elif any(keyword in label for keyword in ("65", "高齢", "老年")) and growing:
+                opportunities.append(f"シニア向け{industry}サービス")
+            elif any(keyword in label for keyword in ("0～14", "0〜14", "年少", "子ども")) and growing:
+                opportunities.append(f"子育て世帯向け{industry}サービス")
+            elif not growing:
+                opportunities.append(f"人口減少に対応した省人化・デジタル化{industry}")
+        return list(dict.fromkeys(opportunities))[:3]
+    
     def _generate_trend_opportunities(self, trends: List[Tuple], industry: str) -> List[str]:
         """トレンドベースの機会生成"""
         opportunities = []
@@ -813,214 +4178,275 @@ class BusinessIntelligenceEngine:
         
         return opportunities[:3]
     
+    @traced("business.ideas")
     async def _generate_business_ideas(self, market_analysis: Dict, demographic_insights: Dict, 
                                      competition_analysis: Dict, industry: str, area: str) -> List[Dict[str, Any]]:
         """AIを使って、金沢のポテンシャルを最大限に引き出す、革新的で魅力的なビジネスアイデアを生成"""
+        current_span().set_attribute("business.ideas_mode", BUSINESS_IDEAS_MODE)
+        ideas = []
+        async for idea in self.iter_business_ideas(
+            market_analysis, demographic_insights, competition_analysis, industry, area
+        ):
+            ideas.append(idea)
+        
+        if not ideas:
+            return self._generate_fallback_ideas(industry, area)
+        
+        print(f"最終的なアイデア数: {len(ideas)}")
+        return ideas
+    
+    def iter_business_ideas(self, market_analysis: Dict, demographic_insights: Dict, competition_analysis: Dict,
+                            industry: str, area: str) -> AsyncIterator[Dict[str, Any]]:
+        """BUSINESS_IDEAS_MODEに応じたアイデア生成を、完成した順に1件ずつ返す非同期イテレータ"""
+        if BUSINESS_IDEAS_MODE == "parallel":
+            return self._parallel_business_ideas(
+                market_analysis, demographic_insights, competition_analysis, industry, area
+            )
+        return self._stream_business_ideas(
+            market_analysis, demographic_insights, competition_analysis, industry, area
+        )
+    
+    async def _parallel_business_ideas(self, market_analysis: Dict, demographic_insights: Dict,
+                                       competition_analysis: Dict, industry: str, area: str) -> AsyncIterator[Dict[str, Any]]:
+        """切り口ごとにアイデア1件の短い生成を並行して行い、重複を除いて完成した順に返す（入力は切り口の数だけ重複する）"""
+        started_at = time.perf_counter()
+        
+        async def generate(angle: str) -> Tuple[str, Any]:
+            try:
+                builder = self._idea_prompt_builder(
+                    market_analysis, demographic_insights, competition_analysis, industry, area, angle
+                )
+                response = await acreate_chat_completion(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": BUSINESS_IDEAS_SYSTEM_MESSAGE},
+                        {"role": "user", "content": builder.build()}
+                    ],
+                    max_tokens=BUSINESS_IDEA_MAX_TOKENS,
+                    temperature=0.85,
+                    response_format=BUSINESS_IDEA_RESPONSE_FORMAT
+                )
+                idea = json.loads(response.choices[0].message.content)
+            except Exception as e:
+                return angle, e
+            print(f"アイデア生成完了 ({time.perf_counter() - started_at:.1f}秒, 切り口: {angle}): {idea.get('name', '')}")
+            return angle, idea
+        
+        tasks = [asyncio.ensure_future(generate(angle)) for angle in BUSINESS_IDEA_ANGLES]
+        seen = set()
+        overloaded = None
         try:
-            # コンテキスト情報の準備 (より詳細に)
-            context = f"""
-【ターゲットエリア】: {area if area else '金沢市全域'}
-【対象業界】: {industry}
-
-【市場分析サマリー】:
-  - 市場規模スコア: {market_analysis.get('market_size_score', 0)}/100点
-  - 成長ポテンシャルスコア: {market_analysis.get('growth_potential_score', 0)}/100点
-  - 競合レベル: {competition_analysis.get('competition_level', '不明')}
-  - 市場参入難易度: {competition_analysis.get('market_entry_difficulty', 0)}/10点
-  - 推定ROI: {market_analysis.get('estimated_roi_percentage', 0)}%
-  - 分析信頼度: {market_analysis.get('analysis_confidence', '不明')}
-
-【実際の数値データ】:
-  - 人口: {market_analysis.get('actual_metrics', {}).get('population', 'N/A')}
-  - 事業所数: {market_analysis.get('actual_metrics', {}).get('business_establishments', 'N/A')}
-  - 推定市場規模(ターゲット): {market_analysis.get('actual_metrics', {}).get('estimated_market_size', 'N/A')}
-  - 競合密度: {market_analysis.get('actual_metrics', {}).get('competition_density', 'N/A')}
-
-【人口統計インサイト】:
-  - 主要ターゲット層: {demographic_insights.get('primary_target_recommendation', '不明')}
-  - 人口動態トレンド: {demographic_insights.get('population_trend', '不明')}
-
-【競合分析インサイト】:
-  - 推奨戦略: {competition_analysis.get('recommended_strategy', '標準戦略')}
-  - 差別化ポテンシャル: {competition_analysis.get('differentiation_potential', '中')}
-"""
-            
-            prompt = f"""
-あなたは、金沢の伝統と革新を知り尽くした、超一流のビジネスプロデューサーです。
+            for next_done in asyncio.as_completed(tasks):
+                angle, result = await next_done
+                if isinstance(result, Exception):
+                    print(f"ビジネスアイデア生成エラー (切り口: {angle}): {result}")
+                    if isinstance(result, LLMOverloadedError) and overloaded is None:
+                        overloaded = result
+                    continue
+                if not isinstance(result, dict):
+                    continue
+                # 名前の表記ゆれ（空白・記号・全角半角）を無視して重複を除く
+                key = re.sub(r"[\W_]+", "", unicodedata.normalize("NFKC", str(result.get("name", ""))).lower())
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield self._normalize_business_idea(result)
+        finally:
+            # 呼び出し側が途中で読むのをやめた場合、まだ送信していない生成は取り消す
+            # （送信済みの呼び出しは止められず、応答が戻った時点で実行枠が返る）
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if not seen and overloaded is not None:
+            raise overloaded
+    
+    def _idea_prompt_builder(self, market_analysis: Dict, demographic_insights: Dict, competition_analysis: Dict,
+                             industry: str, area: str, angle: Optional[str] = None) -> PromptBuilder:
+        """アイデア生成プロンプト（angleを指定すると、その切り口のアイデア1件を求める並列生成用のプロンプト）"""
+        metrics = market_analysis.get('actual_metrics', {})
+        
+        # コンテキスト情報の準備（予算超過時は優先度の低いインサイトから削る）
+        builder = PromptBuilder(
+            PROMPT_TOKEN_BUDGETS["business_ideas"], reserved_tokens=count_tokens(BUSINESS_IDEAS_SYSTEM_MESSAGE)
+        )
+        builder.add("intro", f"""あなたは、金沢の伝統と革新を知り尽くした、超一流のビジネスプロデューサーです。
 以下の詳細な市場データと分析結果を元に、ユーザーが「これだ！」と膝を打つような、
-金沢ならではの【革新的かつ実現可能なカフェビジネスアイデア】を3つ提案してください。
-
-{context}
-
+金沢ならではの【革新的かつ実現可能なカフェビジネスアイデア】を{1 if angle else 3}つ提案してください。
+""", priority=100, required=True)
+        if angle:
+            # 並列生成では呼び出しごとに切り口を変えてアイデアの重複を避ける
+            builder.add("angle", f"【今回の切り口】: {angle}\nほかの切り口のアイデアは別途生成するため、この切り口に絞って1つだけ提案してください。",
+                        priority=100, required=True)
+        builder.add("target", f"【ターゲットエリア】: {area if area else '金沢市全域'}\n【対象業界】: {industry}", priority=100, required=True)
+        builder.add("market_summary", f"""【市場分析サマリー】
+- 市場規模スコア: {market_analysis.get('market_size_score', 0)}/100点
+- 成長ポテンシャルスコア: {market_analysis.get('growth_potential_score', 0)}/100点
+- 競合レベル: {competition_analysis.get('competition_level', '不明')}
+- 市場参入難易度: {competition_analysis.get('market_entry_difficulty', 0)}/10点
+- 推定ROI: {market_analysis.get('estimated_roi_percentage', 0)}%
+- 分析信頼度: {market_analysis.get('analysis_confidence', '不明')}""", priority=90, truncatable=True)
+        builder.add("actual_metrics", f"""【実際の数値データ】
+- 人口: {metrics.get('population', 'N/A')}
+- 事業所数: {metrics.get('business_establishments', 'N/A')}
+- 推定市場規模(ターゲット): {metrics.get('estimated_market_size', 'N/A')}
+- 競合密度: {metrics.get('competition_density', 'N/A')}""", priority=80, truncatable=True)
+        builder.add("demographics", f"""【人口統計インサイト】
+- 主要ターゲット層: {demographic_insights.get('primary_target_recommendation', '不明')}
+- 人口動態トレンド: {demographic_insights.get('population_trend', '不明')}""", priority=60, truncatable=True)
+        builder.add("competition", f"""【競合分析インサイト】
+- 推奨戦略: {competition_analysis.get('recommended_strategy', '標準戦略')}
+- 差別化ポテンシャル: {competition_analysis.get('differentiation_potential', '中')}""", priority=50, truncatable=True)
+        builder.add("instructions", f"""
 各アイデアには、必ず以下の要素を情熱的に、かつ具体的に記述してください：
 
-1.  【エモいアイデア名】: 思わずSNSでシェアしたくなるような、キャッチーで記憶に残る名前。
-2.  【コンセプト・物語】: なぜこのアイデアが金沢で輝くのか？どんなストーリーや世界観があるのか？ユーザーの心を揺さぶる物語を語ってください。
-3.  【具体的なサービス内容】: 他店との圧倒的な違いは何か？どんなユニークな体験や価値を提供できるのか？（例：伝統工芸体験、地元アーティストとのコラボ、最新技術の活用など）
-4.  【ターゲット顧客ペルソナ】: どんなライフスタイルで、何を求めている人に刺さるのか？具体的な人物像を想像させる記述を。
-5.  【感動の収益モデル】: どうやって儲けるのか？だけでなく、顧客も地域もハッピーになるような、持続可能で創造的な収益構造を提案してください。
-6.  【成功の鍵＆実現可能性】: このビジネスを成功させるための最も重要なポイントは何か？現実的な視点からの実現可能性スコア（10点満点）とその根拠も。
-7.  【市場ポテンシャル＆期待ROI】: このアイデアが秘める市場の可能性は？具体的な期待ROI（投資収益率）とその算出ロジックも（例：市場規模 x ターゲット顧客割合 x 客単価 x 利益率など、数値的根拠を重視）。
-8.  【SWOT分析】: 各アイデアの強み(Strengths)、弱み(Weaknesses)、機会(Opportunities)、脅威(Threats)を簡潔に分析し、戦略的視点を提供してください。
-
-形式はJSONで、各要素を詳細に記述してください。
-ユーザーの期待を超える、最高にクールでエモい提案を待っています！
-
-**重要**: 必ず以下のJSON形式で回答してください：
-[
-  {
-    "name": "アイデア名",
-    "concept": "コンセプト・物語",
-    "services": "具体的なサービス内容",
-    "target_persona": "ターゲット顧客ペルソナ",
-    "revenue_model": "収益モデル",
-    "success_keys": "成功の鍵",
-    "feasibility_score": 数値,
-    "expected_roi": 数値,
-    "swot": {
-      "strengths": "強み",
-      "weaknesses": "弱み", 
-      "opportunities": "機会",
-      "threats": "脅威"
-    }
-  }
-]
-"""
-            
-            response = client.chat.completions.create(
-                model="gpt-4o-mini", # より高性能なモデルを検討しても良い
-                messages=[
-                    {"role": "system", "content": "あなたは、金沢の地域資源と最新トレンドを融合させ、ユーザーを感動させる革新的なビジネスアイデアを生み出すAIです。"},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=2500, # より多くの情報を生成できるように増量
-                temperature=0.85 # 創造性を高めるために少し高めに設定
+1.  name【エモいアイデア名】: 思わずSNSでシェアしたくなるような、キャッチーで記憶に残る名前。
+2.  concept【コンセプト・物語】: なぜこのアイデアが金沢で輝くのか？どんなストーリーや世界観があるのか？ユーザーの心を揺さぶる物語を語ってください。
+3.  services【具体的なサービス内容】: 他店との圧倒的な違いは何か？どんなユニークな体験や価値を提供できるのか？（例：伝統工芸体験、地元アーティストとのコラボ、最新技術の活用など）
+4.  target_persona【ターゲット顧客ペルソナ】: どんなライフスタイルで、何を求めている人に刺さるのか？具体的な人物像を想像させる記述を。
+5.  revenue_model【感動の収益モデル】: どうやって儲けるのか？だけでなく、顧客も地域もハッピーになるような、持続可能で創造的な収益構造を提案してください。
+6.  success_keys / feasibility_score【成功の鍵＆実現可能性】: このビジネスを成功させるための最も重要なポイントは何か？現実的な視点からの実現可能性スコア（10点満点）も。
+7.  market_potential / expected_roi【市場ポテンシャル＆期待ROI】: このアイデアが秘める市場の可能性は？具体的な期待ROI（%）とその算出ロジックも（例：市場規模 x ターゲット顧客割合 x 客単価 x 利益率など、数値的根拠を重視）。
+8.  swot【SWOT分析】: 各アイデアの強み(Strengths)、弱み(Weaknesses)、機会(Opportunities)、脅威(Threats)を簡潔に分析し、戦略的視点を提供してください。
+
+回答は指定されたJSONスキーマ（{"アイデア1件" if angle else "ideas配列"}）に従って出力してください。
+ユーザーの期待を超える、最高にクールでエモい提案を待っています！""", priority=100, required=True)
+        return builder
+    
+    async def _stream_business_ideas(self, market_analysis: Dict, demographic_insights: Dict,
+                                     competition_analysis: Dict, industry: str, area: str,
+                                     max_ideas: int = 3) -> AsyncIterator[Dict[str, Any]]:
+        """スキーマ制約付きJSONをストリーミング生成し、完成したアイデアから順に返す"""
+        try:
+            system_message = BUSINESS_IDEAS_SYSTEM_MESSAGE
+            builder = self._idea_prompt_builder(
+                market_analysis, demographic_insights, competition_analysis, industry, area
             )
+            prompt = builder.build()
+            print(f"アイデア生成プロンプト: {builder.stats['input_tokens']}トークン (予算: {builder.stats['budget_tokens']}, 削減: {builder.stats['tokens_saved']})")
             
-            # JSONレスポンスをパース
+            messages = [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": prompt}
+            ]
+            parser = IncrementalJSONArrayParser()
+            emitted = 0
+            # ストリームを読み終えるまで実行枠を保持する（待機・受信はワーカースレッドで行いイベントループを塞がない）
+            estimated_tokens = estimate_completion_tokens(messages, 2500)
+            # async generator内ではスパンを実行中のスパンにしない（呼び出し側のコンテキストに漏れるため）
+            span = start_span("openai.chat.completions.stream", "client", {
+                "gen_ai.system": "openai",
+                "gen_ai.operation.name": "chat",
+                "gen_ai.request.model": "gpt-4o-mini",
+                "gen_ai.request.max_tokens": 2500,
+                "gen_ai.usage.input_tokens": builder.stats["input_tokens"],
+                "llm.estimated_tokens": estimated_tokens
+            })
+            queued = time.perf_counter()
             try:
-                ideas_text = response.choices[0].message.content
-                print(f"AI生成レスポンス: {ideas_text[:200]}...")  # デバッグ用
-                
-                # JSONの抽出を試行（```json ... ``` 形式にも対応）
-                match = re.search(r"```json\n(.*?)\n```", ideas_text, re.DOTALL)
-                if match:
-                    json_str = match.group(1)
-                else:
-                    # 直接JSONが出力される場合も考慮
-                    json_str = ideas_text
-                
-                # JSONをパース
-                json_str = json_str.strip()
-                parsed_data = json.loads(json_str)
-                
-                # 様々なJSON形式に対応
-                ideas = []
-                if isinstance(parsed_data, list):
-                    # 配列形式の場合
-                    ideas = parsed_data
-                elif isinstance(parsed_data, dict):
-                    # オブジェクト形式の場合、配列を含むキーを探す
-                    for key, value in parsed_data.items():
-                        if isinstance(value, list) and value:
-                            ideas = value
-                            break
-                    
-                    # 配列が見つからない場合、オブジェクト自体を配列に変換
-                    if not ideas:
-                        ideas = [parsed_data]
-                
-                # 日本語キーから英語キーへの変換
-                normalized_ideas = []
-                print(f"パース成功。アイデア数: {len(ideas)}")
-                for i, idea in enumerate(ideas):
-                    print(f"アイデア{i+1}の内容: {list(idea.keys()) if isinstance(idea, dict) else type(idea)}")
-                    if isinstance(idea, dict):
-                        normalized_idea = {
-                            "name": idea.get("エモいアイデア名") or idea.get("name", "革新的ビジネス"),
-                            "concept": idea.get("コンセプト・物語") or idea.get("concept", "新しいコンセプト"),
-                            "services": idea.get("具体的なサービス内容") or idea.get("services", "特別なサービス"),
-                            "target_persona": idea.get("ターゲット顧客ペルソナ") or idea.get("target_persona", "ターゲット顧客"),
-                            "revenue_model": idea.get("感動の収益モデル") or idea.get("revenue_model", "収益モデル"),
-                            "success_keys": idea.get("成功の鍵＆実現可能性") or idea.get("success_keys", "成功要因"),
-                            "feasibility_score": idea.get("feasibility_score", 8),
-                            "expected_roi": idea.get("expected_roi", 10),
-                            "market_potential": idea.get("市場ポテンシャル＆期待ROI") or idea.get("market_potential", "市場分析"),
-                            "swot": idea.get("SWOT分析") or idea.get("swot", {
-                                "strengths": "強み",
-                                "weaknesses": "弱み", 
-                                "opportunities": "機会",
-                                "threats": "脅威"
-                            })
-                        }
-                        print(f"正規化後のアイデア{i+1}: name={normalized_idea['name']}, concept={normalized_idea['concept'][:50]}...")
-                        normalized_ideas.append(normalized_idea)
-                
-                print(f"最終的なアイデア数: {len(normalized_ideas)}")
-                return normalized_ideas[:3]  # 最大3つまで
+                # 待機中にキャンセルされても、後から確保された枠は返却される
+                await llm_limiter.acquire_async(estimated_tokens)
+            except BaseException as e:
+                if not isinstance(e, asyncio.CancelledError):
+                    span.set_error(e)
+                span.end()
+                raise
+            started_at = time.perf_counter()
+            span.set_attribute("llm.queue_wait_ms", round((started_at - queued) * 1000, 1))
+            stream = {"response": None}
+            pending = None  # ワーカースレッドで実行中の呼び出し（ストリーム作成・チャンク読み取り）
+            creating = None
+            failed = False
+            try:
+                pending = llm_limiter.submit(
+                    client.chat.completions.create,
+                    model="gpt-4o-mini", # より高性能なモデルを検討しても良い
+                    messages=messages,
+                    max_tokens=2500, # より多くの情報を生成できるように増量
+                    temperature=0.85, # 創造性を高めるために少し高めに設定
+                    response_format=BUSINESS_IDEAS_RESPONSE_FORMAT, # スキーマ制約付きJSON出力
+                    stream=True
+                )
+                creating = pending
+                stream["response"] = await asyncio.wrap_future(pending)
                 
-            except json.JSONDecodeError as e:
-                print(f"JSONパースエラー (ビジネスアイデア生成): {e}")
-                print(f"パース対象文字列: {json_str[:500] if 'json_str' in locals() else 'N/A'}")
+                # ストリームを逐次パースし、アイデアが1件完成するたびに返す
+                chunks = iter(stream["response"])
+                while True:
+                    pending = llm_limiter.submit(next, chunks, None)
+                    chunk = await asyncio.wrap_future(pending)
+                    if chunk is None:
+                        break
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    for idea in parser.feed(delta):
+                        if not isinstance(idea, dict):
+                            continue
+                        emitted += 1
+                        print(f"アイデア{emitted}生成完了 ({time.perf_counter() - started_at:.1f}秒): {idea.get('name', '')}")
+                        yield self._normalize_business_idea(idea)
+                        if emitted >= max_ideas:
+                            return
+            except BaseException as e:
+                failed = True
+                if not isinstance(e, (GeneratorExit, asyncio.CancelledError)):
+                    span.set_error(e)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started_at
                 
-                # より柔軟なJSONパースを試行
-                try:
-                    # コメントや不要な文字を除去
-                    cleaned_json = re.sub(r'//.*$', '', json_str, flags=re.MULTILINE)
-                    cleaned_json = re.sub(r'/\*.*?\*/', '', cleaned_json, flags=re.DOTALL)
-                    cleaned_json = cleaned_json.strip()
-                    
-                    # 再度パースを試行
-                    parsed_data = json.loads(cleaned_json)
-                    print("クリーニング後のJSONパース成功！")
-                    
-                    # 同じ正規化処理を適用
-                    ideas = []
-                    if isinstance(parsed_data, list):
-                        ideas = parsed_data
-                    elif isinstance(parsed_data, dict):
-                        for key, value in parsed_data.items():
-                            if isinstance(value, list) and value:
-                                ideas = value
-                                break
-                        if not ideas:
-                            ideas = [parsed_data]
-                    
-                    # 正規化処理
-                    normalized_ideas = []
-                    for i, idea in enumerate(ideas):
-                        if isinstance(idea, dict):
-                            normalized_idea = {
-                                "name": idea.get("エモいアイデア名") or idea.get("name", "革新的ビジネス"),
-                                "concept": idea.get("コンセプト・物語") or idea.get("concept", "新しいコンセプト"),
-                                "services": idea.get("具体的なサービス内容") or idea.get("services", "特別なサービス"),
-                                "target_persona": idea.get("ターゲット顧客ペルソナ") or idea.get("target_persona", "ターゲット顧客"),
-                                "revenue_model": idea.get("感動の収益モデル") or idea.get("revenue_model", "収益モデル"),
-                                "success_keys": idea.get("成功の鍵＆実現可能性") or idea.get("success_keys", "成功要因"),
-                                "feasibility_score": idea.get("feasibility_score", 8),
-                                "expected_roi": idea.get("expected_roi", 10),
-                                "market_potential": idea.get("市場ポテンシャル＆期待ROI") or idea.get("market_potential", "市場分析"),
-                                "swot": idea.get("SWOT分析") or idea.get("swot", {
-                                    "strengths": "強み",
-                                    "weaknesses": "弱み", 
-                                    "opportunities": "機会",
-                                    "threats": "脅威"
-                                })
-                            }
-                            normalized_ideas.append(normalized_idea)
-                    
-                    if normalized_ideas:
-                        print(f"正規化成功！最終アイデア数: {len(normalized_ideas)}")
-                        return normalized_ideas[:3]
-                        
-                except json.JSONDecodeError as e2:
-                    print(f"クリーニング後もJSONパース失敗: {e2}")
+                def _close_stream(done: Optional[Future] = None) -> None:
+                    # 必要数が揃った・キャンセルされたら残りの生成を打ち切ってから枠を返す
+                    response = stream["response"]
+                    if (response is None and done is not None and done is creating and not done.cancelled()
+                            and done.exception() is None):
+                        response = done.result()  # 作成中にキャンセルされたストリーム
+                    try:
+                        if response is not None and hasattr(response, "close"):
+                            response.close()
+                    finally:
+                        llm_limiter.release(elapsed, estimated_tokens, failed=failed)
                 
-                return self._generate_fallback_ideas(industry, area) # フォールバックを返す
+                if pending is not None and not pending.done():
+                    # 読み取り中のスレッドと並行してcloseしないよう、その呼び出しが戻ってから閉じる
+                    pending.add_done_callback(_close_stream)
+                else:
+                    _close_stream()
+                profile = _active_profile.get()
+                if profile is not None:
+                    profile.record_stage("llm.stream", started_at, elapsed)
+                span.set_attributes({"business.ideas_emitted": emitted, "gen_ai.response.chars": len(parser.buffer)})
+                span.end()
+            
+            if emitted == 0:
+                print(f"ストリームからアイデアを取得できませんでした: {parser.buffer[:200]}")
             
+        except LLMOverloadedError:
+            raise
         except Exception as e:
-            print(f"ビジネスアイデア生成エラー: {e}")
-            return self._generate_fallback_ideas(industry, area)
+            print(f"ビジネスアイデアストリーム生成エラー: {e}")
+    
+    def _normalize_business_idea(self, idea: Dict[str, Any]) -> Dict[str, Any]:
+        """日本語キー・英語キーのどちらで返ってきたアイデアも英語キーに正規化"""
+        return {
+            "name": idea.get("エモいアイデア名") or idea.get("name", "革新的ビジネス"),
+            "concept": idea.get("コンセプト・物語") or idea.get("concept", "新しいコンセプト"),
+            "services": idea.get("具体的なサービス内容") or idea.get("services", "特別なサービス"),
+            "target_persona": idea.get("ターゲット顧客ペルソナ") or idea.get("target_persona", "ターゲット顧客"),
+            "revenue_model": idea.get("感動の収益モデル") or idea.get("revenue_model", "収益モデル"),
+            "success_keys": idea.get("成功の鍵＆実現可能性") or idea.get("success_keys", "成功要因"),
+            "feasibility_score": idea.get("feasibility_score", 8),
+            "expected_roi": idea.get("expected_roi", 10),
+            "market_potential": idea.get("市場ポテンシャル＆期待ROI") or idea.get("market_potential", "市場分析"),
+            "swot": idea.get("SWOT分析") or idea.get("swot", {
+                "strengths": "強み",
+                "weaknesses": "弱み", 
+                "opportunities": "機会",
+                "threats": "脅威"
+            })
+        }
     
     def _generate_fallback_ideas(self, industry: str, area: str) -> List[Dict[str, Any]]:
         """フォールバック用のビジネスアイデア"""
@@ -1046,7 +4472,105 @@ class BusinessIntelligenceEngine:
                 "feasibility": 8,
                 "market_potential": 7
             }
-        ]
+        ]
+
+class AnalysisGridMaterializer:
+    """業界 × エリアの全組み合わせについてLLM以外の分析を定期的に事前計算し、メモリから提供する"""
+    
+    def __init__(self, engine: BusinessIntelligenceEngine, industries: List[str], areas: List[str],
+                 refresh_interval: float = 3600.0, concurrency: int = 2, max_age: Optional[float] = None):
+        self.engine = engine
+        self.industries = industries
+        self.areas = areas
+        self.refresh_interval = refresh_interval
+        self.concurrency = concurrency
+        self.max_age = max_age if max_age is not None else refresh_interval * 2
+        self._entries: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self.last_refresh_started: Optional[datetime] = None
+        self.last_refresh_completed: Optional[datetime] = None
+        self.last_refresh_errors = 0
+    
+    def get(self, industry: str, area: str) -> Optional[Dict[str, Any]]:
+        """鮮度が許容範囲内の事前計算結果を返す（なければNone）"""
+        entry = self._entries.get((industry, area))
+        if not entry:
+            return None
+        if (datetime.now() - entry["computed_at"]).total_seconds() > self.max_age:
+            return None
+        return entry
+    
+    def start(self) -> None:
+        """バックグラウンドスレッドで定期更新を開始"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._run()), name="analysis-grid", daemon=True)
+        self._thread.start()
+        print(f"分析グリッドの事前計算を開始: {len(self.industries)}業界 × {len(self.areas)}エリア")
+    
+    async def _run(self) -> None:
+        """全セルの更新を一定間隔で繰り返す"""
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(self.refresh_interval)
+    
+    async def refresh_all(self) -> None:
+        """全セルを再計算（古いセルから順に、同時実行数を制限して実行）"""
+        self.last_refresh_started = datetime.now()
+        self.last_refresh_errors = 0
+        if self.engine.data_api.circuit.state != CircuitBreaker.OPEN:
+            try:
+                # 時系列は変更のあったリソースだけ取り直す
+                await trend_engine.refresh(self.engine.data_api)
+            except Exception as e:
+                print(f"時系列トレンド更新エラー: {e}")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        cells = [(industry, area) for industry in self.industries for area in self.areas]
+        cells.sort(key=lambda cell: self._entries[cell]["computed_at"] if cell in self._entries else datetime.min)
+        
+        async def refresh(cell: Tuple[str, str]) -> None:
+            async with semaphore:
+                await self.refresh_cell(*cell)
+        
+        await asyncio.gather(*(refresh(cell) for cell in cells))
+        self.last_refresh_completed = datetime.now()
+        elapsed = (self.last_refresh_completed - self.last_refresh_started).total_seconds()
+        print(f"分析グリッド更新完了: {len(cells)}セル, {elapsed:.1f}秒, エラー{self.last_refresh_errors}件")
+    
+    async def refresh_cell(self, industry: str, area: str) -> None:
+        """1セル分の分析を計算して差し替え"""
+        if self.engine.data_api.circuit.state == CircuitBreaker.OPEN:
+            # 上流の遮断中は古いデータで上書きせず、既存の結果を保持する
+            return
+        started = time.perf_counter()
+        try:
+            analysis = await self.engine.compute_base_analysis(industry, area)
+            self._entries[(industry, area)] = {
+                "analysis": analysis,
+                "computed_at": datetime.now(),
+                "duration_seconds": round(time.perf_counter() - started, 2)
+            }
+        except Exception as e:
+            self.last_refresh_errors += 1
+            print(f"分析グリッド更新エラー ({industry}, {area}): {e}")
+    
+    def status(self) -> Dict[str, Any]:
+        """グリッドの充足率と鮮度を返す"""
+        now = datetime.now()
+        ages = [(now - entry["computed_at"]).total_seconds() for entry in self._entries.values()]
+        return {
+            "running": bool(self._thread and self._thread.is_alive()),
+            "cells_total": len(self.industries) * len(self.areas),
+            "cells_materialized": len(self._entries),
+            "cells_fresh": sum(1 for age in ages if age <= self.max_age),
+            "oldest_age_seconds": round(max(ages), 1) if ages else None,
+            "newest_age_seconds": round(min(ages), 1) if ages else None,
+            "refresh_interval_seconds": self.refresh_interval,
+            "max_age_seconds": self.max_age,
+            "last_refresh_started": self.last_refresh_started.isoformat() if self.last_refresh_started else None,
+            "last_refresh_completed": self.last_refresh_completed.isoformat() if self.last_refresh_completed else None,
+            "last_refresh_errors": self.last_refresh_errors
+        }
 
 class MarketingIntelligenceEngine:
     """マーケティングインテリジェンス - データドリブンなマーケティング戦略立案"""
@@ -1054,6 +4578,9 @@ class MarketingIntelligenceEngine:
     def __init__(self):
         self.data_api = KanazawaDataAPI()
     
+    @traced("marketing.strategy", lambda self, business_idea, target_segment, budget_range="中": {
+        "marketing.business_idea": business_idea, "marketing.segment": target_segment, "marketing.budget": budget_range
+    })
     async def generate_marketing_strategy(self, business_idea: str, target_segment: str, 
                                         budget_range: str = "中") -> Dict[str, Any]:
         """マーケティング戦略を生成"""
@@ -1084,10 +4611,13 @@ class MarketingIntelligenceEngine:
                 "marketing_strategy": strategy
             }
             
+        except LLMOverloadedError:
+            raise
         except Exception as e:
             print(f"マーケティング戦略生成エラー: {e}")
             return {"success": False, "error": str(e)}
     
+    @traced("marketing.target_segment")
     async def _analyze_target_segment(self, segment: str) -> Dict[str, Any]:
         """ターゲットセグメント分析"""
         # 金沢市の人口データを検索
@@ -1130,6 +4660,7 @@ class MarketingIntelligenceEngine:
             "data_availability": "高" if len(datasets) > 2 else "中"
         }
     
+    @traced("marketing.channels")
     async def _analyze_marketing_channels(self, target_segment: str, budget: str) -> Dict[str, Any]:
         """マーケティングチャネル分析"""
         channels = {
@@ -1191,6 +4722,7 @@ class MarketingIntelligenceEngine:
                 channels[3]: "20%" if len(channels) > 3 else "0%"
             }
     
+    @traced("marketing.competitors")
     async def _analyze_competitor_marketing(self, business_idea: str) -> Dict[str, Any]:
         """競合マーケティング分析"""
         # 簡易的な競合分析
@@ -1204,6 +4736,7 @@ class MarketingIntelligenceEngine:
             ]
         }
     
+    @traced("marketing.plan")
     async def _generate_marketing_plan(self, business_idea: str, target_analysis: Dict,
                                      channel_analysis: Dict, competitor_analysis: Dict,
                                      budget: str) -> Dict[str, Any]:
@@ -1232,7 +4765,7 @@ class MarketingIntelligenceEngine:
 JSON形式で回答してください。
 """
             
-            response = client.chat.completions.create(
+            response = await acreate_chat_completion(
                 model="gpt-4o-mini",
                 messages=[
                     {"role": "system", "content": "あなたは経験豊富なマーケティングストラテジストです。実用的で測定可能なマーケティング戦略を提案してください。"},
@@ -1253,6 +4786,8 @@ JSON形式で回答してください。
                 "success_metrics": ["リーチ数", "エンゲージメント率", "コンバージョン率", "ROI"]
             }
             
+        except LLMOverloadedError:
+            raise
         except Exception as e:
             print(f"マーケティングプラン生成エラー: {e}")
             return {
@@ -1261,6 +4796,404 @@ JSON形式で回答してください。
                 "budget_allocation": {"SNS": "50%", "Web": "50%"}
             }
 
+# 質問ルーティング用キーワード
+BUSINESS_KEYWORDS = ["ビジネス", "事業", "起業", "商売", "マーケティング", "戦略", "競合", "市場", "顧客", "売上", "収益"]
+
+INDUSTRY_KEYWORDS = {
+    "観光": "観光業", "飲食": "飲食業", "カフェ": "飲食業", "小売": "小売業", "IT": "IT業",
+    "教育": "教育業", "医療": "医療業", "介護": "介護業", "製造": "製造業",
+    "建設": "建設業", "サービス": "サービス業", "地域活性化": "サービス業"
+}
+
+AREA_KEYWORDS = ["金沢", "中央区", "東山", "香林坊", "武蔵", "駅西", "東区", "西区", "南区", "北区"]
+
+# エリアのおおよその範囲（中心の緯度・経度、半径km）。行政区画ではなく競合密度の集計用の目安
+AREA_GEOMETRY = {
+    "中央区": (36.5650, 136.6560, 2.0),
+    "東山": (36.5725, 136.6665, 0.8),
+    "香林坊": (36.5613, 136.6532, 0.6),
+    "武蔵": (36.5710, 136.6540, 0.6),
+    "駅西": (36.5790, 136.6400, 1.2),
+    "東区": (36.5780, 136.6900, 3.0),
+    "西区": (36.5700, 136.6200, 3.0),
+    "南区": (36.5300, 136.6600, 3.5),
+    "北区": (36.6000, 136.6800, 3.5)
+}
+KANAZAWA_CITY_AREA_KM2 = 468.64
+
+# 施設名・種別から業界を判定するキーワード
+FACILITY_INDUSTRY_KEYWORDS = {
+    "飲食業": ["飲食", "食堂", "レストラン", "カフェ", "喫茶", "料理", "居酒屋", "寿司", "ラーメン", "菓子"],
+    "観光業": ["観光", "旅館", "ホテル", "宿泊", "土産", "茶屋", "美術館", "博物館", "記念館"],
+    "医療業": ["病院", "診療所", "クリニック", "医院", "歯科", "薬局"],
+    "介護業": ["介護", "福祉", "デイサービス", "老人ホーム", "グループホーム"],
+    "教育業": ["学校", "保育", "幼稚園", "こども園", "塾", "教室", "図書館"],
+    "小売業": ["小売", "商店", "スーパー", "コンビニ", "販売", "市場", "店舗"],
+    "IT業": ["IT", "情報", "ソフトウェア", "コワーキング"],
+    "製造業": ["工場", "製造", "工業", "工房"],
+    "建設業": ["建設", "工務店", "建築"],
+    "サービス業": ["理容", "美容", "クリーニング", "銭湯", "サービス"]
+}
+# 施設データを探すためのカタログ検索クエリ
+FACILITY_SEARCH_QUERIES = ["施設 一覧", "店舗", "事業所", "飲食店", "宿泊施設", "医療機関", "介護 事業所", "保育施設", "文化施設"]
+
+# 時系列トレンドの対象指標（系列名・データセット名に含まれるキーワード）
+TREND_SERIES_METRICS = {
+    "入込客数": ["入込", "観光客", "来訪者", "来場者"],
+    "宿泊者数": ["宿泊"],
+    "事業所数": ["事業所"],
+    "人口": ["人口", "世帯", "歳"]
+}
+TREND_SEARCH_QUERIES = ["人口 推移", "年齢別 人口", "入込客数", "観光客数", "宿泊者数", "事業所数"]
+# 業界ごとに見る時系列指標
+INDUSTRY_TREND_METRICS = {
+    "観光業": ["入込客数", "宿泊者数"],
+    "飲食業": ["入込客数", "人口", "事業所数"],
+    "小売業": ["人口", "入込客数", "事業所数"],
+    "医療業": ["人口"],
+    "介護業": ["人口"],
+    "教育業": ["人口"]
+}
+DEFAULT_TREND_METRICS = ["人口", "事業所数"]
+FULLWIDTH_DIGITS = str.maketrans("０１２３４５６７８９．－／", "0123456789.-/")
+
+# 人口統計のターゲット層（比率とスコアはエリアセグメントから計算）
+DEMOGRAPHIC_SEGMENTS = {
+    "elderly": {"segment": "高齢者層（65歳以上）", "opportunity": "介護・健康・生活支援サービス",
+                "purchasing_power": "中〜高", "digital_adoption": "低（25%）"},
+    "young_adult": {"segment": "若年成人層（20-39歳）", "opportunity": "IT・エンタメ・ライフスタイル",
+                    "purchasing_power": "中", "digital_adoption": "高（85%）"},
+    "children": {"segment": "ファミリー層（子育て世代）", "opportunity": "教育・子育て支援・レジャー",
+                 "purchasing_power": "中〜高", "digital_adoption": "中（65%）"}
+}
+
+# エリアセグメント（flask --app app build-area-segments で構築）
+SEGMENT_SEARCH_QUERIES = ["町丁別 年齢別 人口", "年齢別 人口", "地区別 人口", "校下別 人口"]
+area_segments = AreaSegmentationModel(
+    os.getenv("AREA_SEGMENTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "area_segments")),
+    clusters=int(os.getenv("AREA_SEGMENT_CLUSTERS", "4"))
+)
+area_segments.load()
+
+# 時系列トレンド（flask --app app refresh-trend-series で構築・増分更新）
+trend_engine = TimeSeriesTrendEngine(os.getenv(
+    "TREND_SERIES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "trend_series.npz")
+))
+trend_engine.load()
+
+# 施設の空間インデックス（flask --app app build-facility-index で構築）
+facility_index = FacilitySpatialIndex(os.getenv(
+    "FACILITY_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "facility_index.npz")
+))
+facility_index.load()
+
+DEFAULT_BUSINESS_INDUSTRY = "飲食業"  # 業界が検出できない場合（カフェ開業を想定）
+
+# キーワードで判定できない曖昧な質問用のTF-IDF分類器の学習データ
+INTENT_TRAINING_QUESTIONS = [
+    ("金沢でカフェを開きたいのですが成功しますか", "business"),
+    ("観光客向けの店を出すならどこがいい", "business"),
+    ("香林坊で飲食店を始めるのはどうでしょう", "business"),
+    ("介護サービスを立ち上げたい", "business"),
+    ("IT企業を作るなら金沢は有利？", "business"),
+    ("東山でお土産屋をやりたい", "business"),
+    ("小売店の出店場所を探しています", "business"),
+    ("教育サービスの需要はありますか", "business"),
+    ("観光業で儲かるアイデアはある？", "business"),
+    ("医療系の開業に向いたエリアは", "business"),
+    ("駅西でゲストハウスを経営したい", "business"),
+    ("建設業の人手不足を解決するサービスを考えたい", "business"),
+    ("カフェの客単価はどれくらいが妥当ですか", "business"),
+    ("飲食店のターゲット層を知りたい", "business"),
+    ("新しいサービスを作って地域活性化したい", "business"),
+    ("兼六園の営業時間は？", "general"),
+    ("金沢市の人口は？", "general"),
+    ("ゴミの出し方について教えて", "general"),
+    ("おすすめの観光スポットを教えて", "general"),
+    ("金沢駅周辺の駐車場情報", "general"),
+    ("市役所の開庁時間は？", "general"),
+    ("近くの公園を教えて", "general"),
+    ("東山のひがし茶屋街への行き方は", "general"),
+    ("金沢の天気はどうですか", "general"),
+    ("美味しいカフェはどこ？", "general"),
+    ("介護保険の申請方法を知りたい", "general"),
+    ("子どもの医療費助成について", "general"),
+    ("図書館の場所を教えて", "general"),
+    ("観光案内所はどこにありますか", "general"),
+    ("金沢21世紀美術館の休館日は", "general"),
+]
+
+class KeywordMatcher:
+    """複数キーワードの一括マッチャー（登録順のキーワードそれぞれを部分文字列として判定する）
+    
+    キーワードは数十語と少なく質問も短いため、C実装の部分文字列検索をキーワードの数だけ行うほうが、
+    1文字ずつPythonで状態遷移するオートマトンや、多数の選択肢を持つ正規表現よりも速い。
+    """
+    
+    def __init__(self):
+        self._entries: List[Tuple[str, Any]] = []
+    
+    def add(self, keyword: str, payload: Any) -> None:
+        """キーワードと付随情報を登録"""
+        self._entries.append((keyword, payload))
+    
+    def match_payloads(self, text: str) -> List[Tuple[str, Any]]:
+        """テキストに含まれる (キーワード, 付随情報) を登録順に返す"""
+        return [entry for entry in self._entries if entry[0] in text]
+
+class QuestionClassifier:
+    """質問の意図（ビジネス/一般）・業界・エリアをキーワードの一括判定で抽出する分類器"""
+    
+    def __init__(self, use_tfidf: bool = True):
+        self.use_tfidf = use_tfidf
+        self.matcher = KeywordMatcher()
+        for keyword in BUSINESS_KEYWORDS:
+            self.matcher.add(keyword.lower(), ("intent", "business"))
+        for keyword, industry in INDUSTRY_KEYWORDS.items():
+            self.matcher.add(keyword.lower(), ("industry", industry))
+        for area in AREA_KEYWORDS:
+            self.matcher.add(area.lower(), ("area", area))
+        
+        # 学習済みの (analyzer, 重み, 切片, クラス) を1つのタプルとして公開する（学習途中の状態を見せない）
+        self._intent = None
+        self._intent_lock = threading.Lock()
+    
+    def classify(self, question: str) -> Dict[str, Any]:
+        """質問を分類して意図・業界・エリアを返す"""
+        best: Dict[str, str] = {}
+        matched_keywords = []
+        for keyword, (kind, value) in self.matcher.match_payloads(question.lower()):
+            matched_keywords.append(keyword)
+            # 従来の判定と同じく、登録順が先のキーワードを優先（一致は登録順に返る）
+            best.setdefault(kind, value)
+        
+        industry = best.get("industry")
+        area = best.get("area", "")
+        
+        if "intent" in best:
+            intent, intent_source, confidence = "business", "keyword", 1.0
+        elif industry and self.use_tfidf:
+            # 業界語はあるが意図語がない曖昧な質問はTF-IDF分類器で判定
+            intent, confidence = self._classify_intent_tfidf(question)
+            intent_source = "tfidf"
+            confidence = round(confidence, 3)
+        else:
+            intent, intent_source, confidence = "general", "keyword", 1.0
+        
+        return {
+            "intent": intent,
+            "industry": industry,
+            "area": area,
+            "intent_source": intent_source,
+            "confidence": confidence,
+            "matched_keywords": matched_keywords
+        }
+    
+    def _classify_intent_tfidf(self, question: str) -> Tuple[str, float]:
+        """学習済みTF-IDF分類器で意図を推定"""
+        intent = self._intent
+        if intent is None:
+            with self._intent_lock:
+                if self._intent is None:
+                    self._intent = self._train_intent_model()
+                intent = self._intent
+        analyzer, weights, intercept, classes = intent
+        
+        # sklearnの推論呼び出しは1件あたりのオーバーヘッドが大きいため、学習済みの重みで直接スコアを計算
+        counts: Dict[str, int] = {}
+        for ngram in analyzer(question):
+            if ngram in weights:
+                counts[ngram] = counts.get(ngram, 0) + 1
+        
+        norm = math.sqrt(sum((count * weights[ngram][0]) ** 2 for ngram, count in counts.items()))
+        score = intercept
+        if norm > 0:
+            score += sum(count * idf * coef for ngram, count in counts.items()
+                         for idf, coef in [weights[ngram]]) / norm
+        
+        probability = 1.0 / (1.0 + math.exp(-score))
+        if probability >= 0.5:
+            return classes[1], probability
+        return classes[0], 1.0 - probability
+    
+    @staticmethod
+    def _train_intent_model() -> Tuple[Any, Dict[str, Tuple[float, float]], float, Tuple[str, str]]:
+        """ラベル付き質問からTF-IDF + ロジスティック回帰の意図分類器を学習し、推論に使う値を返す"""
+        from sklearn.linear_model import LogisticRegression
+        texts = [text for text, _ in INTENT_TRAINING_QUESTIONS]
+        labels = [label for _, label in INTENT_TRAINING_QUESTIONS]
+        vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(1, 3))
+        features = vectorizer.fit_transform(texts)
+        model = LogisticRegression(max_iter=1000).fit(features, labels)
+        
+        coefficients = model.coef_[0]
+        weights = {
+            ngram: (float(vectorizer.idf_[index]), float(coefficients[index]))
+            for ngram, index in vectorizer.vocabulary_.items()
+        }
+        return vectorizer.build_analyzer(), weights, float(model.intercept_[0]), tuple(str(label) for label in model.classes_)
+
+# 質問の複雑さの手がかり（簡単な事実確認 / 計画・分析を求める質問）
+COMPLEXITY_SIMPLE_CUES = ("営業時間", "何時", "いつ", "どこ", "場所", "住所", "電話", "料金", "値段", "入場料",
+                          "アクセス", "行き方", "休館", "定休日", "駐車場", "何人", "何件")
+COMPLEXITY_DEEP_CUES = ("計画", "戦略", "プラン", "比較", "分析", "シミュレーション", "詳しく", "詳細", "具体的",
+                        "ステップ", "手順", "方法", "違い", "一覧", "収支", "資金", "ターゲット", "理由", "なぜ", "提案", "ロードマップ", "リスク")
+
+# ルート（意図.複雑さ）ごとのモデル・最大出力トークン数・入力トークン予算（LLM_ROUTING_POLICYで上書き可能）
+DEFAULT_LLM_ROUTING_POLICY = {
+    "general.simple": {"model": "gpt-4o-mini", "max_tokens": 250, "prompt_budget": 800,
+                       "instruction": "質問に1〜3行で端的に答えてください。"},
+    "general.standard": {"model": "gpt-4o-mini", "max_tokens": 600, "prompt_budget": 1500},
+    "general.complex": {"model": "gpt-4o-mini", "max_tokens": 1000, "prompt_budget": 2000},
+    # ビジネス回答はアイデアを省略せずに載せるため、出力トークン数に収まる件数だけ提示する
+    "business.simple": {"model": "gpt-4o-mini", "max_tokens": 1500, "ideas": 1},
+    "business.standard": {"model": "gpt-4o-mini", "max_tokens": 2500, "ideas": 2},
+    "business.complex": {"model": "gpt-4o-mini", "max_tokens": 3000, "ideas": 3}
+}
+
+# 1Mトークンあたりの料金（USD、入力・出力）。コストの目安の計算に使う
+LLM_MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1": (2.00, 8.00)
+}
+
+class QuestionComplexityRouter:
+    """質問の複雑さをローカルで採点し、ポリシー表からモデルと出力トークン数を選んで、ルート別の実績を記録する"""
+    
+    def __init__(self, policy: Dict[str, Dict[str, Any]], thresholds: Tuple[float, float] = (15.0, 55.0),
+                 enabled: bool = True, window: int = 500):
+        self.policy = policy
+        self.thresholds = thresholds
+        self.enabled = enabled
+        self.window = window
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls) -> "QuestionComplexityRouter":
+        """LLM_ROUTING_POLICY（JSON文字列またはJSONファイルのパス）でルート単位に既定のポリシーを上書きする"""
+        policy = {route: dict(settings) for route, settings in DEFAULT_LLM_ROUTING_POLICY.items()}
+        override = os.getenv("LLM_ROUTING_POLICY", "").strip()
+        if override:
+            try:
+                if not override.startswith("{"):
+                    with open(override, encoding="utf-8") as f:
+                        override = f.read()
+                for route, settings in json.loads(override).items():
+                    policy.setdefault(route, {}).update(settings)
+            except (OSError, ValueError) as e:
+                print(f"LLM_ROUTING_POLICYの読み込みに失敗したため既定のポリシーを使用: {e}")
+        thresholds = (15.0, 55.0)
+        raw_thresholds = os.getenv("LLM_ROUTING_THRESHOLDS", "15,55")
+        try:
+            simple, complex_ = (float(value) for value in raw_thresholds.split(","))
+            thresholds = (simple, complex_)
+        except ValueError as e:
+            print(f"LLM_ROUTING_THRESHOLDSの形式が不正なため既定値(15,55)を使用: {raw_thresholds!r} ({e})")
+        return cls(policy, thresholds, os.getenv("LLM_ROUTING_ENABLED", "true").lower() != "false")
+    
+    @staticmethod
+    def score(question: str, classification: Dict[str, Any]) -> float:
+        """0〜100の複雑さスコア（長さ・文の数・計画や分析を求める語・業界とエリアの指定で加点、事実確認の語で減点）"""
+        text = question.strip()
+        score = min(40.0, len(text) / 3)
+        score += min(48, 12 * sum(cue in text for cue in COMPLEXITY_DEEP_CUES))
+        score += 8 * max(0, len(re.findall(r"[。？！?!\n]", text.rstrip("。？！?! \n"))))
+        score += min(15, 5 * sum(keyword in BUSINESS_KEYWORDS for keyword in classification.get("matched_keywords", [])))
+        if classification.get("industry") and classification.get("area"):
+            score += 10
+        score -= min(30, 15 * sum(cue in text for cue in COMPLEXITY_SIMPLE_CUES))
+        return round(max(0.0, min(100.0, score)), 1)
+    
+    def route(self, question: str, classification: Dict[str, Any]) -> Dict[str, Any]:
+        """質問に使うルートとモデル・出力トークン数などの設定を返す（無効時は常にstandard）"""
+        intent = "business" if classification.get("intent") == "business" else "general"
+        score = self.score(question, classification)
+        if not self.enabled:
+            tier = "standard"
+        elif score < self.thresholds[0]:
+            tier = "simple"
+        elif score >= self.thresholds[1]:
+            tier = "complex"
+        else:
+            tier = "standard"
+        name = f"{intent}.{tier}"
+        settings = self.policy.get(name) or DEFAULT_LLM_ROUTING_POLICY[f"{intent}.standard"]
+        return {"route": name, "complexity_score": score, **settings}
+    
+    @staticmethod
+    def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> Optional[float]:
+        prices = LLM_MODEL_PRICES.get(model)
+        if prices is None:
+            return None
+        return (input_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+    
+    def record(self, route: Dict[str, Any], elapsed_seconds: float, input_tokens: int = 0,
+               output_tokens: int = 0, cached: bool = False, truncated: bool = False) -> None:
+        """ルート別に応答時間・トークン数・コストの目安を記録する（キャッシュ応答はトークン0として数える）
+
+        truncatedはmax_tokensに達して回答が途中で切れた呼び出し。多いルートは出力トークン数が足りていない
+        """
+        cost = 0.0 if cached else self.estimate_cost(route["model"], input_tokens, output_tokens)
+        with self._lock:
+            stats = self._stats.setdefault(route["route"], {
+                "requests": 0, "cache_hits": 0, "truncated": 0, "input_tokens": 0, "output_tokens": 0,
+                "cost_usd": 0.0, "latencies": deque(maxlen=self.window)
+            })
+            stats["requests"] += 1
+            stats["cache_hits"] += int(cached)
+            stats["truncated"] += int(truncated)
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+            stats["cost_usd"] += cost or 0.0
+            stats["latencies"].append(elapsed_seconds)
+        current_span().set_attributes({
+            "llm.route": route["route"], "llm.complexity_score": route["complexity_score"],
+            "llm.route_cost_usd": round(cost, 6) if cost is not None else None,
+            "llm.truncated": truncated
+        })
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {route: {**values, "latencies": list(values["latencies"])} for route, values in self._stats.items()}
+        routes = {}
+        for route, values in sorted(stats.items()):
+            latencies = values.pop("latencies")
+            requests_count = values["requests"] or 1
+            routes[route] = {
+                **values,
+                "cost_usd": round(values["cost_usd"], 6),
+                "avg_cost_usd": round(values["cost_usd"] / requests_count, 6),
+                "avg_output_tokens": round(values["output_tokens"] / requests_count, 1),
+                "p50_seconds": round(float(np.percentile(latencies, 50)), 3) if latencies else None,
+                "p95_seconds": round(float(np.percentile(latencies, 95)), 3) if latencies else None
+            }
+        return {
+            "enabled": self.enabled,
+            "thresholds": {"simple_below": self.thresholds[0], "complex_from": self.thresholds[1]},
+            "policy": self.policy,
+            "routes": routes
+        }
+
+def completion_token_usage(response: Any, messages: List[Dict[str, str]], text: str, model: str) -> Tuple[int, int]:
+    """APIが返したトークン数（返っていなければローカルで数えた値）を(入力, 出力)で返す"""
+    usage = getattr(response, "usage", None)
+    if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+        return usage.prompt_tokens, usage.completion_tokens or 0
+    return estimate_completion_tokens(messages, 0, model), count_tokens(text or "", model)
+
+def completion_truncated(response: Any, route: Dict[str, Any]) -> bool:
+    """max_tokensに達して回答が途中で切れたかどうか（切れていればログに残す）"""
+    truncated = getattr(response.choices[0], "finish_reason", None) == "length"
+    if truncated:
+        print(f"警告: 回答がmax_tokens({route['max_tokens']})で途中で切れました (ルート: {route['route']})")
+    return truncated
+
+llm_router = QuestionComplexityRouter.from_env()
+
 class KanazawaAI:
     """金沢AI助手 - OpenAI GPTを使用した質問応答システム"""
     
@@ -1268,6 +5201,9 @@ class KanazawaAI:
         self.data_api = KanazawaDataAPI()
         self.business_engine = BusinessIntelligenceEngine()
         self.marketing_engine = MarketingIntelligenceEngine()
+        self.classifier = QuestionClassifier(
+            use_tfidf=os.getenv("QUESTION_CLASSIFIER_TFIDF", "true").lower() != "false"
+        )
         self.system_prompt = """
 あなたは金沢市の情報に詳しいAI助手です。
 金沢市のオープンデータを活用して、質問に簡潔で分かりやすく答えてください。
@@ -1295,23 +5231,29 @@ class KanazawaAI:
 簡潔で実用的な情報提供を心がけてください。
 """
     
+    @traced("chat.generate_response", lambda self, user_question: {"query.text": user_question})
     async def generate_response(self, user_question: str) -> Dict[str, Any]:
         """ユーザーの質問に対してAI応答を生成"""
         try:
             print(f"質問受信: {user_question}")
             
-            # ビジネス関連の質問かどうかを判定
-            business_keywords = ["ビジネス", "事業", "起業", "商売", "マーケティング", "戦略", "競合", "市場", "顧客", "売上", "収益"]
-            is_business_question = any(keyword in user_question for keyword in business_keywords)
+            # ビジネス関連の質問かどうかを判定（意図・業界・エリアを一括抽出）
+            classification = self.classifier.classify(user_question)
+            current_span().set_attributes({"question.intent": classification["intent"],
+                                           "question.intent_source": classification["intent_source"]})
+            # 質問の複雑さからモデル・出力トークン数を決める
+            route = llm_router.route(user_question, classification)
+            started_at = time.perf_counter()
             
-            if is_business_question:
-                print("ビジネス関連の質問として処理")
-                return await self._handle_business_question(user_question)
+            if classification["intent"] == "business":
+                print(f"ビジネス関連の質問として処理 (判定: {classification['intent_source']}, ルート: {route['route']})")
+                return await self._handle_business_question(user_question, classification, route)
             
             # 通常の質問処理
             # 関連データセットを検索
-            datasets = await self.data_api.search_datasets(user_question, limit=5)
-            print(f"データセット検索結果: {len(datasets) if datasets else 0}件")
+            datasets, retrieval = await self._retrieve_datasets(user_question, limit=5)
+            print(f"データセット検索結果: {len(datasets) if datasets else 0}件 ({retrieval})")
+            current_span().set_attributes({"datasets.count": len(datasets) if datasets else 0, "retrieval.source": retrieval})
             
             # データセットの情報を整理
             context_data = []
@@ -1340,40 +5282,62 @@ class KanazawaAI:
             
             print(f"処理済みデータセット: {len(context_data)}件")
             
-            # プロンプト作成
+            # プロンプト作成（トークン予算内に収まるよう、関連度の低いデータセットから削る）
+            builder = PromptBuilder(
+                route.get("prompt_budget", PROMPT_TOKEN_BUDGETS["chat"]), reserved_tokens=count_tokens(self.system_prompt)
+            )
+            builder.add("question", f"質問: {user_question}\n", priority=100, required=True)
+            if route.get("instruction"):
+                builder.add("route_instruction", route["instruction"], priority=100, required=True)
             if context_data:
-                context_text = json.dumps(context_data, ensure_ascii=False, indent=2)
-                context_message = f"""
-質問: {user_question}
-
-関連する金沢市オープンデータ:
-{context_text}
-
-上記のデータを参考に、質問に答えてください。
-"""
+                builder.add("context_header", "関連する金沢市オープンデータ:", priority=90)
+                for rank, dataset in enumerate(d for d in datasets if d):
+                    builder.add(
+                        f"dataset_{rank + 1}",
+                        json.dumps(compact_dataset_context(dataset), ensure_ascii=False, separators=(",", ":")),
+                        priority=80 - rank,
+                        truncatable=True
+                    )
+                builder.add("instruction", "\n上記のデータを参考に、質問に答えてください。", priority=100, required=True)
+                builder.set_baseline(
+                    f"質問: {user_question}\n\n関連する金沢市オープンデータ:\n"
+                    f"{json.dumps(context_data, ensure_ascii=False, indent=2)}\n\n上記のデータを参考に、質問に答えてください。"
+                )
             else:
-                context_message = f"""
-質問: {user_question}
-
-関連する金沢市オープンデータは見つかりませんでしたが、金沢市の一般的な情報を基に質問にお答えください。
-特に観光地、文化施設、行政サービスなどについて、知っている情報があれば教えてください。
-"""
+                builder.add(
+                    "instruction",
+                    "関連する金沢市オープンデータは見つかりませんでしたが、金沢市の一般的な情報を基に質問にお答えください。\n"
+                    "特に観光地、文化施設、行政サービスなどについて、知っている情報があれば教えてください。",
+                    priority=100,
+                    required=True
+                )
+            context_message = builder.build()
+            print(f"プロンプトトークン: {builder.stats['input_tokens']} (削減: {builder.stats['tokens_saved']})")
             
-            print("OpenAI APIを呼び出し中...")
             messages = [
                 {"role": "system", "content": self.system_prompt},
                 {"role": "user", "content": context_message}
             ]
+            completion_params = {"model": route["model"], "messages": messages, "max_tokens": route["max_tokens"],
+                                 "temperature": route.get("temperature", 0.5)}
             
-            # OpenAI API呼び出し（同期版を使用）
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                max_tokens=600,
-                temperature=0.5
-            )
-            
-            ai_response = response.choices[0].message.content
+            # 同じプロンプトへの回答は共有キャッシュから返す（全ワーカー・全インスタンス共通）
+            ai_response = await shared_cache.aget("llm_answer", completion_params) if LLM_ANSWER_CACHE_TTL_SECONDS > 0 else None
+            truncated = False
+            if ai_response is None:
+                print(f"OpenAI APIを呼び出し中... (ルート: {route['route']}, モデル: {route['model']}, 最大{route['max_tokens']}トークン)")
+                # OpenAI API呼び出し（同期版を使用）
+                response = await acreate_chat_completion(**completion_params)
+                ai_response = response.choices[0].message.content
+                truncated = completion_truncated(response, route)
+                # 途中で切れた回答はキャッシュしない
+                if LLM_ANSWER_CACHE_TTL_SECONDS > 0 and ai_response and not truncated:
+                    await shared_cache.aset("llm_answer", completion_params, ai_response, ttl=LLM_ANSWER_CACHE_TTL_SECONDS)
+                input_tokens, output_tokens = completion_token_usage(response, messages, ai_response, route["model"])
+                llm_router.record(route, time.perf_counter() - started_at, input_tokens, output_tokens, truncated=truncated)
+            else:
+                print("キャッシュ済みの回答を使用")
+                llm_router.record(route, time.perf_counter() - started_at, cached=True)
             
             # レスポンステキストを整形
             formatted_response = format_response_text(ai_response)
@@ -1383,9 +5347,14 @@ class KanazawaAI:
                 "response": formatted_response,
                 "datasets_used": len(datasets),
                 "context_data": context_data[:3],  # 最初の3件のみ返す
-                "question_type": "general"
+                "question_type": "general",
+                "retrieval": retrieval,
+                "prompt_stats": builder.stats,
+                "llm_route": self._route_summary(route, truncated)
             }
             
+        except LLMOverloadedError:
+            raise
         except Exception as e:
             print(f"AI応答生成エラー: {e}")
             return {
@@ -1394,28 +5363,70 @@ class KanazawaAI:
                 "response": "申し訳ございません。現在システムに問題が発生しています。しばらく時間をおいてから再度お試しください。"
             }
     
-    async def _handle_business_question(self, question: str) -> Dict[str, Any]:
+    @traced("chat.retrieve_datasets", lambda self, question, limit=5: {"retrieval.mode": CHAT_RETRIEVAL_MODE, "retrieval.limit": limit})
+    async def _retrieve_datasets(self, question: str, limit: int = 5) -> Tuple[List[Dict[str, Any]], str]:
+        """質問に関連するデータセットを取得（vectorモードではローカルのインデックスを使い、使えなければCKAN検索）"""
+        if CHAT_RETRIEVAL_MODE == "vector" and vector_index.available:
+            return vector_index.search(question, k=limit, min_score=VECTOR_MIN_SCORE), "vector"
+        return await self.data_api.search_datasets(question, limit=limit), "ckan"
+    
+    async def answer_batch(self, questions: List[str], queue: asyncio.Queue, concurrency: int = 4) -> None:
+        """重複を除いた質問を並行して処理し、完了した順に結果をqueueへ入れる（最後に集計とNoneを入れる）"""
+        started = time.perf_counter()
+        unique: Dict[str, List[int]] = {}
+        for index, question in enumerate(questions):
+            unique.setdefault(" ".join(question.split()), []).append(index)
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        counts = {"succeeded": 0, "failed": 0}
+        
+        async def answer(question: str, indices: List[int]) -> None:
+            async with semaphore:
+                question_started = time.perf_counter()
+                try:
+                    result = await self.generate_response(question)
+                except LLMOverloadedError as e:
+                    result = {"success": False, "error": str(e), "reason": e.reason, "retry_after": e.retry_after}
+                counts["succeeded" if result.get("success") else "failed"] += 1
+                await queue.put({
+                    "type": "result",
+                    "indices": indices,
+                    "question": question,
+                    "elapsed_seconds": round(time.perf_counter() - question_started, 3),
+                    "result": result
+                })
+        
+        try:
+            with shared_upstream_fetches() as scope:
+                await asyncio.gather(*(answer(question, indices) for question, indices in unique.items()))
+            await queue.put({
+                "type": "summary",
+                "total_questions": len(questions),
+                "unique_questions": len(unique),
+                **counts,
+                "upstream_calls": len(scope["tasks"]),
+                "shared_upstream_calls": scope["shared"],
+                "elapsed_seconds": round(time.perf_counter() - started, 3)
+            })
+        finally:
+            await queue.put(None)
+    
+    @staticmethod
+    def _route_summary(route: Dict[str, Any], truncated: bool = False) -> Dict[str, Any]:
+        return {**{key: route[key] for key in ("route", "complexity_score", "model", "max_tokens")}, "truncated": truncated}
+    
+    @traced("chat.business_question")
+    async def _handle_business_question(self, question: str, classification: Optional[Dict[str, Any]] = None,
+                                        route: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """ビジネス関連の質問を、プロのマーケター視点で、感動的に処理"""
         try:
-            # 質問からキーワードを抽出（既存ロジック）
-            # ... (industry_keywords, detected_industry, area_keywords, detected_area の抽出処理はそのまま)
-            industry_keywords = {
-                "観光": "観光業", "飲食": "飲食業", "カフェ": "飲食業", "小売": "小売業", "IT": "IT業",
-                "教育": "教育業", "医療": "医療業", "介護": "介護業", "製造": "製造業",
-                "建設": "建設業", "サービス": "サービス業", "地域活性化": "サービス業"
-            }
-            detected_industry = "飲食業"  # デフォルト（カフェ開業を想定）
-            for keyword, industry_val in industry_keywords.items():
-                if keyword in question.lower(): # 小文字で比較
-                    detected_industry = industry_val
-                    break
-            
-            area_keywords = ["金沢", "中央区", "東山", "香林坊", "武蔵", "駅西", "東区", "西区", "南区", "北区"]
-            detected_area = ""
-            for area_val in area_keywords:
-                if area_val in question:
-                    detected_area = area_val
-                    break
+            started_at = time.perf_counter()
+            # 質問から業界・エリアを抽出
+            if classification is None:
+                classification = self.classifier.classify(question)
+            if route is None:
+                route = llm_router.route(question, classification)
+            detected_industry = classification["industry"] or DEFAULT_BUSINESS_INDUSTRY
+            detected_area = classification["area"]
             
             print(f"検出された業界: {detected_industry}, エリア: {detected_area if detected_area else '金沢市全域'}")
             
@@ -1447,9 +5458,10 @@ class KanazawaAI:
             
             # ビジネスアイデアを整形
             ideas_presentation = ""
+            idea_count = max(1, int(route.get("ideas", 3)))  # ルートの出力トークン数に収まる件数
             if business_analysis.get("business_ideas") and len(business_analysis["business_ideas"]) > 0:
-                print(f"生成されたビジネスアイデア数: {len(business_analysis['business_ideas'])}")
-                for i, idea in enumerate(business_analysis["business_ideas"][:3]): # 上位3アイデアを提示
+                print(f"生成されたビジネスアイデア数: {len(business_analysis['business_ideas'])} (提示: 上位{idea_count}件)")
+                for i, idea in enumerate(business_analysis["business_ideas"][:idea_count]): # 上位のアイデアを提示
                     if isinstance(idea, dict):
                         # SWOT分析の整形
                         swot = idea.get('swot', {})
@@ -1524,23 +5536,27 @@ class KanazawaAI:
 以下の要求に従って回答してください：
 1. 市場の現状を数値とともに簡潔に要約
 2. 上記の詳細なビジネスアイデアをそのまま表示（削除や要約は不要）
-3. 最も推奨するアイデアを1つ選択し、その理由を説明
+3. {"このアイデアを推奨する理由を説明" if idea_count == 1 else "最も推奨するアイデアを1つ選択し、その理由を説明"}
 4. 実行に向けた具体的なステップを3つ提示
 
 詳細なビジネスアイデアの内容は削除せず、完全な形で提示してください。
 """
             
-            response = client.chat.completions.create(
-                model="gpt-4o-mini", 
-                messages=[
-                    {"role": "system", "content": "あなたは、ユーザーの夢の実現を全力で応援する、情熱的でカリスマ的なビジネスプロデューサーAIです。詳細な分析結果を大切にし、豊富な情報を提供してください。"},
-                    {"role": "user", "content": final_prompt}
-                ],
-                max_tokens=3000, # 詳細な回答のために大幅に増量
-                temperature=0.7 # クリエイティブながらも確実な出力を促す
+            messages = [
+                {"role": "system", "content": "あなたは、ユーザーの夢の実現を全力で応援する、情熱的でカリスマ的なビジネスプロデューサーAIです。詳細な分析結果を大切にし、豊富な情報を提供してください。"},
+                {"role": "user", "content": final_prompt}
+            ]
+            response = await acreate_chat_completion(
+                model=route["model"],
+                messages=messages,
+                max_tokens=route["max_tokens"], # 質問の複雑さに応じて決める（詳細な計画の相談では最大3000）
+                temperature=route.get("temperature", 0.7) # クリエイティブながらも確実な出力を促す
             )
             
             ai_response = response.choices[0].message.content
+            input_tokens, output_tokens = completion_token_usage(response, messages, ai_response, route["model"])
+            truncated = completion_truncated(response, route)
+            llm_router.record(route, time.perf_counter() - started_at, input_tokens, output_tokens, truncated=truncated)
             
             # 最終レスポンス整形 (format_response_text は汎用的なので、ここではAIの出力を尊重)
             # 必要であれば、ここでさらに特定の整形処理を追加可能
@@ -1552,9 +5568,12 @@ class KanazawaAI:
                 "detected_industry": detected_industry,
                 "detected_area": detected_area,
                 "business_analysis": business_analysis, # 詳細分析結果も返す
-                "datasets_used": business_analysis.get('data_sources_used', 0)
+                "datasets_used": business_analysis.get('data_sources_used', 0),
+                "llm_route": self._route_summary(route, truncated)
             }
             
+        except LLMOverloadedError:
+            raise
         except Exception as e:
             print(f"ビジネス質問処理エラー (感動生成): {e}")
             # エラー時も、ユーザーを励ますメッセージを返す
@@ -1570,9 +5589,282 @@ class KanazawaAI:
                 "response": error_message 
             }
 
+VERBOSITY_LEVELS = ("minimal", "standard", "full")
+
+# CKANのfl（返却フィールド指定）で取得できるトップレベルのフィールド
+CKAN_PUSHDOWN_FIELDS = {
+    "id", "name", "title", "notes", "url", "version", "state", "type", "license_id", "license_title",
+    "author", "maintainer", "metadata_created", "metadata_modified", "num_resources", "num_tags", "owner_org"
+}
+
+# ルートごとのverbosity定義（includeは残すフィールド、excludeは除外するフィールド）
+RESPONSE_VIEWS = {
+    "datasets_search": {
+        "minimal": {"include": ["success", "count", "datasets.id", "datasets.name", "datasets.title"]},
+        "standard": {"include": [
+            "success", "count", "datasets.id", "datasets.name", "datasets.title", "datasets.notes",
+            "datasets.metadata_modified", "datasets.num_resources", "datasets.tags.display_name",
+            "datasets.organization.title", "datasets.resources.name", "datasets.resources.format",
+            "datasets.resources.url"
+        ]}
+    },
+    "datasets_similar": {
+        "minimal": {"include": ["success", "query", "count", "datasets.id", "datasets.title", "datasets.score", "elapsed_ms"]},
+        "standard": {"exclude": ["datasets.resources"]}
+    },
+    "chat": {
+        "minimal": {"include": ["success", "response", "question_type", "error"]},
+        "standard": {"exclude": ["business_analysis", "prompt_stats"]}
+    },
+    "business_analyze": {
+        "minimal": {"include": [
+            "success", "industry", "target_area", "error", "datasets_analyzed",
+            "market_analysis.market_size_score", "market_analysis.market_potential_level",
+            "market_analysis.estimated_roi_percentage", "competition_analysis.competition_level",
+            "business_ideas.name", "analysis_freshness"
+        ]},
+        "standard": {"exclude": [
+            "market_analysis.key_indicators", "market_analysis.growth_signals",
+            "market_analysis.economic_indicators", "market_analysis.numerical_insights"
+        ]}
+    },
+    "business_analyze_batch": {
+        "minimal": {"include": ["success", "target_area", "comparison", "recommended_industry", "batch_stats", "error"]},
+        "standard": {"exclude": [
+            "analyses.market_analysis.key_indicators", "analyses.market_analysis.growth_signals",
+            "analyses.market_analysis.economic_indicators", "analyses.market_analysis.numerical_insights"
+        ]}
+    },
+    "marketing_strategy": {
+        "minimal": {"include": [
+            "success", "business_idea", "target_segment", "error",
+            "marketing_strategy.recommended_channels", "marketing_strategy.budget_allocation"
+        ]},
+        "standard": {"exclude": ["channel_analysis.available_channels"]}
+    },
+    "comprehensive": {
+        "minimal": {"include": ["success", "analysis_timestamp", "input_parameters", "executive_summary", "error"]},
+        "standard": {"exclude": [
+            "business_analysis.market_analysis.key_indicators", "business_analysis.market_analysis.growth_signals",
+            "business_analysis.market_analysis.economic_indicators", "business_analysis.market_analysis.numerical_insights",
+            "marketing_strategies.strategy.channel_analysis.available_channels"
+        ]}
+    },
+    "extract_numbers": {
+        "minimal": {"include": [
+            "success", "query", "message", "datasets_searched",
+            "professional_analysis.executive_summary", "professional_analysis.key_metrics"
+        ]},
+        "standard": {"exclude": [
+            "raw_data", "professional_analysis.detailed_insights.extracted_values.raw_match"
+        ]}
+    }
+}
+
+def _build_field_tree(paths: List[str]) -> Dict[str, Any]:
+    """ドット区切りのフィールドパスをツリーに変換（葉はNone）"""
+    tree: Dict[str, Any] = {}
+    for path in paths:
+        node = tree
+        parts = [part for part in path.split(".") if part]
+        for i, part in enumerate(parts):
+            if i == len(parts) - 1:
+                node[part] = None
+            else:
+                if node.get(part, {}) is None:
+                    break  # 親フィールド全体が指定済み
+                node = node.setdefault(part, {})
+    return tree
+
+def project_fields(value: Any, tree: Optional[Dict[str, Any]]) -> Any:
+    """指定フィールドのみを残した新しいオブジェクトを返す（リストは各要素に適用）"""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project_fields(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: project_fields(value[key], subtree) for key, subtree in tree.items() if key in value}
+    return value
+
+def exclude_fields(value: Any, tree: Dict[str, Any]) -> Any:
+    """指定フィールドを除いた新しいオブジェクトを返す（元のオブジェクトは変更しない）"""
+    if isinstance(value, list):
+        return [exclude_fields(item, tree) for item in value]
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key not in tree:
+                result[key] = item
+            elif tree[key] is not None:
+                result[key] = exclude_fields(item, tree[key])
+        return result
+    return value
+
+def get_response_view_params(data: Optional[Dict[str, Any]] = None) -> Tuple[Optional[List[str]], str]:
+    """クエリ文字列またはJSONボディから fields / verbosity を取得"""
+    data = data or {}
+    fields = request.args.get("fields") or data.get("fields")
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+    verbosity = (request.args.get("verbosity") or data.get("verbosity") or "full").strip().lower()
+    if verbosity not in VERBOSITY_LEVELS:
+        raise ValueError(f"verbosityは {', '.join(VERBOSITY_LEVELS)} のいずれかを指定してください")
+    return fields or None, verbosity
+
+def apply_response_view(result: Dict[str, Any], view_name: str, fields: Optional[List[str]],
+                        verbosity: str) -> Dict[str, Any]:
+    """fields（優先）またはverbosityに従ってレスポンスを絞り込み、上流の劣化があれば明示する"""
+    with profile_stage("response.view"):
+        return _apply_response_view(result, view_name, fields, verbosity)
+
+def _apply_response_view(result: Dict[str, Any], view_name: str, fields: Optional[List[str]],
+                         verbosity: str) -> Dict[str, Any]:
+    view = RESPONSE_VIEWS.get(view_name, {}).get(verbosity)
+    if fields:
+        result = project_fields(result, _build_field_tree(fields))
+    elif view and "include" in view:
+        result = project_fields(result, _build_field_tree(view["include"]))
+    elif view:
+        result = exclude_fields(result, _build_field_tree(view["exclude"]))
+    
+    upstream_status = get_upstream_status()
+    if upstream_status and isinstance(result, dict):
+        result = {**result, "upstream_status": upstream_status}
+    return result
+
+def ckan_pushdown_fields(fields: Optional[List[str]], verbosity: str, prefix: str = "datasets.") -> Optional[List[str]]:
+    """CKANのflに渡せるフィールドリストを返す（ネストしたフィールドを含む場合はNone）"""
+    if fields:
+        requested = [field[len(prefix):] for field in fields if field.startswith(prefix)]
+    else:
+        view = RESPONSE_VIEWS["datasets_search"].get(verbosity, {})
+        requested = [field[len(prefix):] for field in view.get("include", []) if field.startswith(prefix)]
+    if requested and all(field in CKAN_PUSHDOWN_FIELDS for field in requested):
+        return sorted(set(requested) | {"id"})
+    return None
+
 # グローバルインスタンス
 kanazawa_ai = KanazawaAI()
 
+# バッチチャットの上限（1リクエストあたりの質問数・同時に処理する質問数）
+CHAT_BATCH_MAX_QUESTIONS = int(os.getenv("CHAT_BATCH_MAX_QUESTIONS", "50"))
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+# 複数業界比較分析で1リクエストに指定できる業界数
+BUSINESS_BATCH_MAX_INDUSTRIES = int(os.getenv("BUSINESS_BATCH_MAX_INDUSTRIES", "10"))
+
+# 業界 × エリアの分析グリッド（ANALYSIS_GRID_ENABLED=true で事前計算を有効化）
+_grid_refresh_interval = float(os.getenv("ANALYSIS_GRID_REFRESH_SECONDS", "3600"))
+analysis_grid = AnalysisGridMaterializer(
+    kanazawa_ai.business_engine,
+    industries=list(dict.fromkeys(INDUSTRY_KEYWORDS.values())),
+    areas=[""] + AREA_KEYWORDS,
+    refresh_interval=_grid_refresh_interval,
+    concurrency=int(os.getenv("ANALYSIS_GRID_CONCURRENCY", "2")),
+    max_age=float(os.getenv("ANALYSIS_GRID_MAX_AGE_SECONDS", str(_grid_refresh_interval * 2)))
+)
+if os.getenv("ANALYSIS_GRID_ENABLED", "false").lower() == "true":
+    kanazawa_ai.business_engine.analysis_grid = analysis_grid
+    analysis_grid.start()
+
+class StartupWarmup:
+    """ワーカー起動直後の準備（ライブラリの読み込み、接続確認、インデックス読み込み、よく使う検索の先読み）を順に実行する"""
+    
+    def __init__(self, hot_queries: List[str], enabled: bool = True):
+        self.hot_queries = hot_queries
+        self.enabled = enabled
+        self.steps: Dict[str, Dict[str, Any]] = {}
+        self.started_at: Optional[datetime] = None
+        self.completed_at: Optional[datetime] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def ready(self) -> bool:
+        return not self.enabled or self.completed_at is not None
+    
+    def start(self) -> None:
+        """バックグラウンドでウォームアップを開始（2回目以降の呼び出しは何もしない）"""
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self.started_at = datetime.now()
+            self._thread = threading.Thread(target=self.run, name="startup-warmup", daemon=True)
+            self._thread.start()
+    
+    def run(self) -> None:
+        steps = [
+            ("imports", self._import_libraries),
+            ("tokenizer", lambda: _get_token_encoding("gpt-4o-mini") is not None),
+            ("question_classifier", lambda: kanazawa_ai.classifier.classify("金沢でカフェを開きたい")["intent"]),
+            ("cache_backend", shared_cache.backend.ping),
+            ("indexes", self._load_indexes),
+            ("cpu_pool", self._start_cpu_pool),
+            ("hot_searches", lambda: asyncio.run(self._prefetch_searches()))
+        ]
+        print("ウォームアップ開始")
+        for name, step in steps:
+            self.steps[name] = {"status": "running"}
+            started = time.perf_counter()
+            try:
+                detail = step()
+                self.steps[name] = {"status": "ok", "detail": detail}
+            except Exception as e:
+                # 準備に失敗しても処理はできるため、失敗を記録して次へ進む
+                self.steps[name] = {"status": "failed", "error": str(e)}
+                print(f"ウォームアップ失敗 ({name}): {e}")
+            self.steps[name]["seconds"] = round(time.perf_counter() - started, 3)
+        self.completed_at = datetime.now()
+        print(f"ウォームアップ完了: {(self.completed_at - self.started_at).total_seconds():.1f}秒")
+    
+    @staticmethod
+    def _import_libraries() -> List[str]:
+        """初回リクエストで遅延importされるライブラリを先に読み込む"""
+        import csv  # noqa: F401
+        import joblib  # noqa: F401
+        from sklearn.decomposition import TruncatedSVD  # noqa: F401
+        from sklearn.linear_model import LogisticRegression  # noqa: F401
+        return ["csv", "joblib", "sklearn.decomposition", "sklearn.linear_model"]
+    
+    @staticmethod
+    def _load_indexes() -> Dict[str, bool]:
+        return {
+            "vector_index": vector_index.load(),
+            "facility_index": facility_index.available,
+            "trend_series": trend_engine.available,
+            "area_segments": area_segments.available
+        }
+    
+    @staticmethod
+    def _start_cpu_pool() -> int:
+        cpu_pool.ensure_warm()
+        return cpu_pool.workers
+    
+    async def _prefetch_searches(self) -> Dict[str, int]:
+        """よく使われる検索を先に実行して共有キャッシュに載せる"""
+        if kanazawa_ai.data_api.circuit.state == CircuitBreaker.OPEN:
+            return {}
+        results = await asyncio.gather(*(kanazawa_ai.data_api.search_datasets(query) for query in self.hot_queries))
+        return {query: len(datasets) for query, datasets in zip(self.hot_queries, results)}
+    
+    def status(self) -> Dict[str, Any]:
+        elapsed = None
+        if self.started_at:
+            elapsed = ((self.completed_at or datetime.now()) - self.started_at).total_seconds()
+        return {
+            "enabled": self.enabled,
+            "state": "ready" if self.ready else "warming_up" if self.started_at else "not_started",
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "completed_at": self.completed_at.isoformat() if self.completed_at else None,
+            "elapsed_seconds": round(elapsed, 2) if elapsed is not None else None,
+            "steps": self.steps
+        }
+
+# 起動時のウォームアップ（WARMUP_ENABLED=false で無効化。完了まで /api/ready は503を返す）
+startup_warmup = StartupWarmup(
+    hot_queries=[query.strip() for query in os.getenv("WARMUP_QUERIES", "観光,人口,子育て,飲食店,ごみ").split(",") if query.strip()],
+    enabled=os.getenv("WARMUP_ENABLED", "true").lower() != "false"
+)
+
 @app.route('/')
 def index():
     """メインページ"""
@@ -1584,6 +5876,10 @@ def chat():
     try:
         data = request.get_json()
         user_message = data.get('message', '').strip()
+        try:
+            fields, verbosity = get_response_view_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         if not user_message:
             return jsonify({
@@ -1591,6 +5887,7 @@ def chat():
                 "error": "メッセージが空です"
             }), 400
         
+        llm_limiter.check_admission()  # LLM待ち行列が満杯なら即座に拒否
         # AI応答生成（非同期処理を同期的に実行）
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
@@ -1599,8 +5896,10 @@ def chat():
         finally:
             loop.close()
         
-        return jsonify(result)
+        return jsonify(apply_response_view(result, "chat", fields, verbosity))
         
+    except LLMOverloadedError:
+        raise
     except Exception as e:
         print(f"チャットAPIエラー: {e}")
         return jsonify({
@@ -1609,28 +5908,85 @@ def chat():
             "response": "申し訳ございません。システムエラーが発生しました。"
         }), 500
 
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """バッチチャットAPI - 複数の質問をまとめて処理し、完了した順にNDJSONで返す"""
+    data = request.get_json(silent=True) or {}
+    questions = data.get('questions')
+    try:
+        fields, verbosity = get_response_view_params(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    if not isinstance(questions, list) or not questions:
+        return jsonify({"success": False, "error": "questionsに質問の配列を指定してください"}), 400
+    questions = [str(question).strip() for question in questions]
+    if any(not question for question in questions):
+        return jsonify({"success": False, "error": "空の質問が含まれています"}), 400
+    if len(questions) > CHAT_BATCH_MAX_QUESTIONS:
+        return jsonify({"success": False, "error": f"質問は最大{CHAT_BATCH_MAX_QUESTIONS}件までです"}), 400
+    try:
+        concurrency = min(int(data.get('concurrency', CHAT_BATCH_CONCURRENCY)), CHAT_BATCH_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "concurrencyは整数で指定してください"}), 400
+    
+    llm_limiter.check_admission()  # LLM待ち行列が満杯なら即座に拒否
+    print(f"バッチチャットリクエスト: {len(questions)}件 (並行数: {concurrency})")
+    
+    def generate():
+        # 完了した回答をasyncio.Queueから取り出すたびにイベントループを進める
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            queue: asyncio.Queue = asyncio.Queue()
+            runner = loop.create_task(kanazawa_ai.answer_batch(questions, queue, concurrency))
+            while True:
+                item = loop.run_until_complete(queue.get())
+                if item is None:
+                    break
+                if item["type"] == "result":
+                    item["result"] = apply_response_view(item["result"], "chat", fields, verbosity)
+                yield app.json.dumps(item) + "\n"
+            loop.run_until_complete(runner)
+        finally:
+            # クライアントが途中で切断した場合も残りの処理を止める
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+    
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 @app.route('/api/datasets/search')
 def search_datasets():
     """データセット検索API"""
     try:
         query = request.args.get('q', '')
         limit = min(int(request.args.get('limit', 10)), 50)
+        try:
+            fields, verbosity = get_response_view_params()
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         data_api = KanazawaDataAPI()
         
-        # 非同期処理を同期的に実行
+        # 非同期処理を同期的に実行（可能ならCKAN側で返却フィールドを絞り込む）
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            datasets = loop.run_until_complete(data_api.search_datasets(query, limit))
+            datasets = loop.run_until_complete(
+                data_api.search_datasets(query, limit, fields=ckan_pushdown_fields(fields, verbosity))
+            )
         finally:
             loop.close()
         
-        return jsonify({
+        return jsonify(apply_response_view({
             "success": True,
             "datasets": datasets,
             "count": len(datasets)
-        })
+        }, "datasets_search", fields, verbosity))
         
     except Exception as e:
         print(f"データセット検索エラー: {e}")
@@ -1639,6 +5995,41 @@ def search_datasets():
             "error": str(e)
         }), 500
 
+@app.route('/api/datasets/similar')
+def similar_datasets():
+    """類似データセット検索API（ローカルのインデックスでコサイン類似度、またはmode=keywordで転置インデックスの上位k件）"""
+    query = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'vector')
+    try:
+        k = min(max(int(request.args.get('k', 5)), 1), 100)
+        min_score = float(request.args.get('min_score', 0.01))
+        fields, verbosity = get_response_view_params()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if mode not in ("vector", "keyword"):
+        return jsonify({"success": False, "error": "modeには vector または keyword を指定してください"}), 400
+    
+    if not query:
+        return jsonify({"success": False, "error": "検索クエリを指定してください"}), 400
+    if not vector_index.available:
+        return jsonify({
+            "success": False,
+            "error": "ベクトルインデックスが未構築です（flask --app app build-vector-index を実行してください）"
+        }), 503
+    
+    started = time.perf_counter()
+    search = vector_index.search if mode == "vector" else vector_index.keyword_search
+    datasets = search(query, k=k, min_score=min_score)
+    return jsonify(apply_response_view({
+        "success": True,
+        "query": query,
+        "mode": mode,
+        "count": len(datasets),
+        "datasets": datasets,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        "index": {key: vector_index.meta.get(key) for key in ("built_at", "documents", "dimensions")}
+    }, "datasets_similar", fields, verbosity))
+
 @app.route('/api/health')
 def health_check():
     """ヘルスチェックAPI"""
@@ -1648,6 +6039,64 @@ def health_check():
         "version": "1.0.0"
     })
 
+@app.route('/api/ready')
+def readiness_check():
+    """レディネスAPI（ウォームアップが終わるまで503。ロードバランサーの振り分け判定用）"""
+    ready = startup_warmup.ready
+    response = jsonify({
+        "ready": ready,
+        "warmup": startup_warmup.status(),
+        "cache": shared_cache.snapshot(),
+        "indexes": {
+            "vector_index": vector_index.status(),
+            "facility_index": facility_index.status(),
+            "trend_series": trend_engine.status(),
+            "area_segments": area_segments.status()
+        },
+        "cpu_pool": cpu_pool.snapshot(),
+        "ckan_circuit_state": ckan_circuit.state
+    })
+    response.status_code = 200 if ready else 503
+    return response
+
+@app.route('/api/profiles/<profile_id>')
+def get_request_profile(profile_id: str):
+    """保存済みプロファイルのサマリー（format=speedscopeでspeedscopeファイル）を返す。X-Profileに管理トークンが必要"""
+    if not PROFILING_ADMIN_TOKEN or request.headers.get("X-Profile") != PROFILING_ADMIN_TOKEN:
+        return jsonify({"success": False, "error": "プロファイルの参照には管理トークンが必要です"}), 403
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", profile_id):
+        return jsonify({"success": False, "error": "プロファイルIDが不正です"}), 400
+    suffix = "speedscope.json" if request.args.get("format") == "speedscope" else "summary.json"
+    if not os.path.exists(os.path.join(PROFILING_OUTPUT_DIR, f"{profile_id}.{suffix}")):
+        return jsonify({"success": False, "error": "プロファイルが見つかりません"}), 404
+    return send_from_directory(PROFILING_OUTPUT_DIR, f"{profile_id}.{suffix}", mimetype="application/json")
+
+@app.route('/api/metrics')
+def metrics():
+    """運用メトリクスAPI（LLM呼び出しの待ち行列・拒否数、キャッシュ、CPUワーカー、CKANのサーキットブレーカー状態）"""
+    return jsonify({
+        "success": True,
+        "timestamp": datetime.now().isoformat(),
+        "llm": llm_limiter.snapshot(),
+        "cache": shared_cache.snapshot(),
+        "cpu_pool": cpu_pool.snapshot(),
+        "tracing": span_exporter.snapshot(),
+        "llm_routing": llm_router.snapshot(),
+        "ckan": {
+            "circuit": ckan_circuit.snapshot(),
+            "latency": ckan_latency.snapshot()
+        }
+    })
+
+@app.route('/api/business/grid/status')
+def analysis_grid_status():
+    """分析グリッドの事前計算状況API"""
+    return jsonify({
+        "success": True,
+        "enabled": kanazawa_ai.business_engine.analysis_grid is not None,
+        **analysis_grid.status()
+    })
+
 @app.route('/api/business/analyze', methods=['POST'])
 def analyze_business_opportunities():
     """ビジネス機会分析API"""
@@ -1655,6 +6104,10 @@ def analyze_business_opportunities():
         data = request.get_json()
         industry = data.get('industry', '').strip()
         target_area = data.get('target_area', '').strip()
+        try:
+            fields, verbosity = get_response_view_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         if not industry:
             return jsonify({
@@ -1664,6 +6117,12 @@ def analyze_business_opportunities():
         
         print(f"ビジネス分析リクエスト: 業界={industry}, エリア={target_area}")
         
+        llm_limiter.check_admission()  # LLM待ち行列が満杯なら即座に拒否
+        if data.get('stream'):
+            # 分析結果とアイデアを完成した順にNDJSONで返す（最初のアイデアを全件の完成を待たずに表示できる）
+            return Response(stream_with_context(
+                stream_business_analysis(industry, target_area, fields, verbosity)
+            ), mimetype="application/x-ndjson")
         # ビジネス機会分析実行
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
@@ -1674,8 +6133,10 @@ def analyze_business_opportunities():
         finally:
             loop.close()
         
-        return jsonify(result)
+        return jsonify(apply_response_view(result, "business_analyze", fields, verbosity))
         
+    except LLMOverloadedError:
+        raise
     except Exception as e:
         print(f"ビジネス分析APIエラー: {e}")
         return jsonify({
@@ -1684,6 +6145,90 @@ def analyze_business_opportunities():
             "details": str(e)
         }), 500
 
+def stream_business_analysis(industry: str, target_area: str, fields: Optional[List[str]], verbosity: str):
+    """ビジネス機会分析のイベントをNDJSONの行として順に返すジェネレータ"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    events = kanazawa_ai.business_engine.stream_business_opportunities(industry, target_area)
+    try:
+        while True:
+            try:
+                event = loop.run_until_complete(events.__anext__())
+            except StopAsyncIteration:
+                break
+            except LLMOverloadedError as e:
+                yield app.json.dumps({"type": "error", "success": False, "error": str(e),
+                                      "reason": e.reason, "retry_after": e.retry_after}) + "\n"
+                break
+            except Exception as e:
+                print(f"ビジネス分析ストリームエラー: {e}")
+                yield app.json.dumps({"type": "error", "success": False,
+                                      "error": "ビジネス分析中にエラーが発生しました", "details": str(e)}) + "\n"
+                break
+            if event["type"] == "analysis":
+                event = {"type": "analysis", **apply_response_view(event, "business_analyze", fields, verbosity)}
+            yield app.json.dumps(event) + "\n"
+    finally:
+        # クライアントが途中で切断した場合も残りの生成を止める
+        loop.run_until_complete(events.aclose())
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+@app.route('/api/business/analyze/batch', methods=['POST'])
+def analyze_business_opportunities_batch():
+    """複数業界のビジネス機会比較分析API（同じエリアの検索・データ取得を共有）"""
+    try:
+        data = request.get_json()
+        industries = data.get('industries')
+        target_area = data.get('target_area', '').strip()
+        include_ideas = bool(data.get('include_ideas', False))
+        try:
+            fields, verbosity = get_response_view_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        
+        if not isinstance(industries, list) or not industries:
+            return jsonify({
+                "success": False,
+                "error": "industriesに業界の配列を指定してください"
+            }), 400
+        # 重複を除き、指定順を保つ
+        industries = list(dict.fromkeys(str(industry).strip() for industry in industries if str(industry).strip()))
+        if not industries or len(industries) > BUSINESS_BATCH_MAX_INDUSTRIES:
+            return jsonify({
+                "success": False,
+                "error": f"業界は1〜{BUSINESS_BATCH_MAX_INDUSTRIES}件で指定してください"
+            }), 400
+        
+        if include_ideas:
+            llm_limiter.check_admission()  # LLM待ち行列が満杯なら即座に拒否
+        print(f"複数業界ビジネス分析リクエスト: 業界={industries}, エリア={target_area}")
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            result = loop.run_until_complete(
+                kanazawa_ai.business_engine.analyze_industries(industries, target_area, include_ideas)
+            )
+        finally:
+            loop.close()
+        
+        return jsonify(apply_response_view(result, "business_analyze_batch", fields, verbosity))
+        
+    except LLMOverloadedError:
+        raise
+    except Exception as e:
+        print(f"複数業界ビジネス分析APIエラー: {e}")
+        return jsonify({
+            "success": False,
+            "error": "ビジネス分析中にエラーが発生しました",
+            "details": str(e)
+        }), 500
+
 @app.route('/api/marketing/strategy', methods=['POST'])
 def generate_marketing_strategy():
     """マーケティング戦略生成API"""
@@ -1692,6 +6237,10 @@ def generate_marketing_strategy():
         business_idea = data.get('business_idea', '').strip()
         target_segment = data.get('target_segment', '').strip()
         budget_range = data.get('budget_range', '中').strip()
+        try:
+            fields, verbosity = get_response_view_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         if not business_idea or not target_segment:
             return jsonify({
@@ -1701,6 +6250,7 @@ def generate_marketing_strategy():
         
         print(f"マーケティング戦略リクエスト: {business_idea} -> {target_segment} (予算: {budget_range})")
         
+        llm_limiter.check_admission()  # LLM待ち行列が満杯なら即座に拒否
         # マーケティング戦略生成実行
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
@@ -1713,8 +6263,10 @@ def generate_marketing_strategy():
         finally:
             loop.close()
         
-        return jsonify(result)
+        return jsonify(apply_response_view(result, "marketing_strategy", fields, verbosity))
         
+    except LLMOverloadedError:
+        raise
     except Exception as e:
         print(f"マーケティング戦略APIエラー: {e}")
         return jsonify({
@@ -1731,6 +6283,10 @@ def comprehensive_business_intelligence():
         industry = data.get('industry', '').strip()
         target_area = data.get('target_area', '').strip()
         budget_range = data.get('budget_range', '中').strip()
+        try:
+            fields, verbosity = get_response_view_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         if not industry:
             return jsonify({
@@ -1739,6 +6295,7 @@ def comprehensive_business_intelligence():
             }), 400
         
         print(f"総合BI分析リクエスト: 業界={industry}, エリア={target_area}, 予算={budget_range}")
+        llm_limiter.check_admission()  # LLM待ち行列が満杯なら即座に拒否
         
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
@@ -1788,8 +6345,10 @@ def comprehensive_business_intelligence():
         finally:
             loop.close()
         
-        return jsonify(comprehensive_report)
+        return jsonify(apply_response_view(comprehensive_report, "comprehensive", fields, verbosity))
         
+    except LLMOverloadedError:
+        raise
     except Exception as e:
         print(f"総合BI分析APIエラー: {e}")
         return jsonify({
@@ -1798,6 +6357,149 @@ def comprehensive_business_intelligence():
             "details": str(e)
         }), 500
 
+def _negotiate_content_encoding(accept_encoding: str) -> Optional[str]:
+    """Accept-Encodingヘッダーから使用する圧縮方式を決定（brotli優先、次にgzip）"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    
+    candidates = (["br"] if brotli else []) + ["gzip"]
+    for encoding in candidates:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0:
+            return encoding
+    return None
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    """レスポンスボディを指定方式で圧縮"""
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+def _profile_request_id() -> str:
+    """X-Request-IDがファイル名に使える形式ならそれを使い、なければ生成する"""
+    request_id = request.headers.get("X-Request-ID", "")
+    return request_id if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", request_id) else uuid.uuid4().hex[:16]
+
+@app.before_request
+def start_request_profile():
+    """管理トークン付きのX-Profileヘッダー、またはサンプリング率に当たったAPIリクエストをプロファイルする"""
+    if request.path.startswith("/api/profiles/"):
+        return
+    requested = bool(PROFILING_ADMIN_TOKEN) and request.headers.get("X-Profile") == PROFILING_ADMIN_TOKEN
+    sampled = PROFILING_SAMPLE_RATE > 0 and request.path.startswith("/api/") and random.random() < PROFILING_SAMPLE_RATE
+    if not (requested or sampled):
+        return
+    profile = RequestProfile(_profile_request_id(), request.method, request.path, PROFILING_INTERVAL_SECONDS)
+    g.profile = profile
+    g.profile_token = _active_profile.set(profile)
+    profile.start()
+
+@app.after_request
+def tag_request_profile(response):
+    profile = g.get("profile")
+    if profile is not None:
+        profile.status_code = response.status_code
+        response.headers["X-Profile-Id"] = profile.request_id
+    return response
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    """プロファイルを止めてspeedscopeファイルとサマリーを書き出す（ストリーミングはレスポンス送信完了後）"""
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    profile.stop()
+    try:
+        _active_profile.reset(g.pop("profile_token"))
+    except ValueError:
+        _active_profile.set(None)
+    try:
+        speedscope_path, _ = profile.write(PROFILING_OUTPUT_DIR)
+        print(f"プロファイル保存: {profile.method} {profile.path} {profile.elapsed * 1000:.0f}ms -> {speedscope_path}")
+    except OSError as e:
+        print(f"プロファイル保存エラー: {e}")
+
+@app.before_request
+def start_request_span():
+    """リクエスト全体のサーバースパンを開始（traceparentヘッダーがあれば呼び出し元のトレースに連結）"""
+    if not TRACING_ENABLED:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    span = start_span(f"{request.method} {route}", "server", {
+        "http.request.method": request.method,
+        "http.route": route,
+        "url.path": request.path,
+        "http.request.body.size": request.content_length,
+        "user_agent.original": request.headers.get("User-Agent")
+    }, traceparent=request.headers.get("traceparent", ""))
+    g.trace_span = span
+    g.trace_token = _current_span.set(span)
+
+@app.after_request
+def tag_request_span(response):
+    span = g.get("trace_span")
+    if span is not None:
+        span.set_attribute("http.response.status_code", response.status_code)
+        if not response.is_streamed:
+            span.set_attribute("http.response.body.size", response.calculate_content_length())
+        if response.status_code >= 500:
+            span.status_code = SPAN_STATUS_ERROR
+        response.headers["X-Trace-Id"] = span.trace_id
+    return response
+
+@app.teardown_request
+def finish_request_span(error=None):
+    """サーバースパンを終了（ストリーミングはレスポンス送信完了後）"""
+    span = g.pop("trace_span", None)
+    if span is None:
+        return
+    try:
+        _current_span.reset(g.pop("trace_token"))
+    except ValueError:
+        _current_span.set(None)
+    if error is not None:
+        span.set_error(error)
+    span.end()
+
+@app.before_request
+def start_warmup():
+    """WSGIサーバー経由の起動でも最初のリクエスト（通常は /api/ready の確認）でウォームアップを始める"""
+    if startup_warmup.enabled:
+        startup_warmup.start()
+    else:
+        cpu_pool.ensure_warm()
+
+@app.after_request
+def compress_response(response):
+    """閾値以上のレスポンスをクライアントが対応する方式で圧縮"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+    
+    encoding = _negotiate_content_encoding(request.headers.get("Accept-Encoding", ""))
+    if not encoding:
+        return response
+    
+    response.set_data(compress_body(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({
@@ -1805,6 +6507,18 @@ def not_found(error):
         "error": "エンドポイントが見つかりません"
     }), 404
 
+@app.errorhandler(LLMOverloadedError)
+def llm_overloaded(error):
+    response = jsonify({
+        "success": False,
+        "error": "現在混雑しています。しばらく時間をおいてから再度お試しください。",
+        "reason": error.reason,
+        "retry_after": error.retry_after
+    })
+    response.status_code = error.status_code
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
 @app.errorhandler(500)
 def internal_error(error):
     return jsonify({
@@ -1819,6 +6533,10 @@ def extract_numerical_data():
         data = request.get_json()
         query = data.get('query', '').strip()
         limit = min(int(data.get('limit', 10)), 20)
+        try:
+            fields, verbosity = get_response_view_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         if not query:
             return jsonify({
@@ -1834,16 +6552,16 @@ def extract_numerical_data():
         try:
             data_api = KanazawaDataAPI()
             
-            # データセットを検索
-            datasets = loop.run_until_complete(data_api.search_datasets(query, limit))
+            # データセットを検索（以降の処理で使うのはIDとタイトルのみ）
+            datasets = loop.run_until_complete(data_api.search_datasets(query, limit, fields=["id", "title"]))
             
             if not datasets:
-                return jsonify({
+                return jsonify(apply_response_view({
                     "success": True,
                     "message": "関連するデータセットが見つかりませんでした",
                     "numerical_insights": {},
                     "datasets_searched": 0
-                })
+                }, "extract_numbers", fields, verbosity))
             
             # 数値データを抽出
             numerical_insights = loop.run_until_complete(data_api.extract_numerical_data(datasets))
@@ -1865,13 +6583,13 @@ def extract_numerical_data():
             "data_quality_assessment": _assess_data_quality(numerical_insights, datasets)
         }
         
-        return jsonify({
+        return jsonify(apply_response_view({
             "success": True,
             "query": query,
             "professional_analysis": professional_summary,
             "raw_data": numerical_insights,
             "datasets_metadata": [{"title": d.get("title", ""), "id": d.get("id", "")} for d in datasets[:5]]
-        })
+        }, "extract_numbers", fields, verbosity))
         
     except Exception as e:
         print(f"数値データ抽出APIエラー: {e}")
@@ -1958,11 +6676,146 @@ def _assess_data_quality(numerical_insights: Dict, datasets: List[Dict]) -> Dict
     
     return assessment
 
+@app.cli.command("build-vector-index")
+def build_vector_index_command():
+    """CKANカタログ全体を取得してベクトルインデックスを構築する"""
+    datasets = asyncio.run(KanazawaDataAPI().fetch_catalog())
+    stats = vector_index.build(datasets)
+    print(f"ベクトルインデックスを構築しました: {stats['documents']}件, {stats['dimensions']}次元, "
+          f"{stats['file_bytes'] / 1024 / 1024:.1f}MB, {stats['build_seconds']}秒 -> {vector_index.path}")
+
+async def collect_facility_points(index: FacilitySpatialIndex, data_api: "KanazawaDataAPI") -> List[str]:
+    """施設・事業所系のデータセットを検索し、CSVリソースを施設インデックスに取り込む"""
+    seen_resources = set()
+    sources = []
+    for query in FACILITY_SEARCH_QUERIES:
+        for dataset in DatasetRecord.from_ckan_list(await data_api.search_datasets(query, limit=50)):
+            for resource in dataset.resources:
+                if resource.format not in TABLE_RESOURCE_FORMATS or not resource.url or resource.url in seen_resources:
+                    continue
+                seen_resources.add(resource.url)
+                text = await data_api.download_table(resource)
+                if not text:
+                    continue
+                points = await cpu_pool.run(FacilitySpatialIndex.parse_csv, text, f"{dataset.title} {resource.name}", size=len(text))
+                added = index.add_points(points)
+                if added:
+                    sources.append(f"{dataset.title}/{resource.name}")
+                    print(f"施設データ取り込み: {dataset.title}/{resource.name} {added}件")
+    return sources
+
+async def collect_area_age_tables(data_api: "KanazawaDataAPI") -> Dict[str, Dict[str, float]]:
+    """町丁別・地区別の年齢別人口CSVを集める（同じ町丁は先に見つかった表を使う）"""
+    units: Dict[str, Dict[str, float]] = {}
+    seen_resources = set()
+    for query in SEGMENT_SEARCH_QUERIES:
+        for dataset in DatasetRecord.from_ckan_list(await data_api.search_datasets(query, limit=20)):
+            for resource in dataset.resources:
+                if resource.format not in TABLE_RESOURCE_FORMATS or not resource.url or resource.url in seen_resources:
+                    continue
+                seen_resources.add(resource.url)
+                text = await data_api.download_table(resource)
+                table = await cpu_pool.run(AreaSegmentationModel.extract_age_table, text, size=len(text)) if text else {}
+                if table:
+                    print(f"年齢別人口の取り込み: {dataset.title}/{resource.name} {len(table)}地区")
+                    for unit, bins in table.items():
+                        units.setdefault(unit, bins)
+    return units
+
+@app.cli.command("build-area-segments")
+def build_area_segments_command():
+    """町丁・地区ごとの年齢構成と施設集積からエリアセグメントを構築する"""
+    units = asyncio.run(collect_area_age_tables(KanazawaDataAPI()))
+    stats = area_segments.build(units)
+    print(f"エリアセグメントを構築しました: {stats['units']}地区, {stats['clusters']}クラスタ "
+          f"({', '.join(stats['cluster_labels'])}) -> {area_segments.directory}")
+
+@app.cli.command("refresh-trend-series")
+def refresh_trend_series_command():
+    """人口・入込客数などの時系列リソースを取り込む（更新日時が変わったリソースだけを取り直す）"""
+    stats = asyncio.run(trend_engine.refresh(KanazawaDataAPI()))
+    print(f"時系列トレンドを更新しました: {stats['series']}系列 -> {trend_engine.path}")
+
+@app.cli.command("build-facility-index")
+def build_facility_index_command():
+    """施設・事業所のCSVリソースから空間インデックスを構築する"""
+    index = FacilitySpatialIndex(facility_index.path)
+    sources = asyncio.run(collect_facility_points(index, KanazawaDataAPI()))
+    meta = index.finalize(sources)
+    index.save()
+    print(f"施設空間インデックスを構築しました: {meta['points']}件"
+          f"（座標あり {meta['points_with_coordinates']}件）-> {index.path}")
+
+def load_trace_spans(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """OTLP/JSONのスパンファイルを読み、trace_idごとのスパン一覧にする"""
+    traces: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line).get("resourceSpans", []):
+                for scope_spans in resource_spans.get("scopeSpans", []):
+                    for span in scope_spans.get("spans", []):
+                        traces.setdefault(span["traceId"], []).append(span)
+    return traces
+
+def format_trace_tree(spans: List[Dict[str, Any]]) -> List[str]:
+    """スパンを親子関係のツリーにし、所要時間と主な属性を1行ずつ整形する"""
+    by_id = {span["spanId"]: span for span in spans}
+    children: Dict[str, List[Dict[str, Any]]] = {}
+    roots = []
+    for span in spans:
+        parent = span.get("parentSpanId", "")
+        if parent in by_id:
+            children.setdefault(parent, []).append(span)
+        else:
+            roots.append(span)
+    trace_start = min(int(span["startTimeUnixNano"]) for span in spans)
+    lines = []
+    
+    def visit(span: Dict[str, Any], depth: int) -> None:
+        start_ms = (int(span["startTimeUnixNano"]) - trace_start) / 1e6
+        duration_ms = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6
+        attributes = ", ".join(
+            f"{attribute['key']}={next(iter(attribute['value'].values()))}" for attribute in span.get("attributes", [])
+        )
+        error = " [ERROR]" if span.get("status", {}).get("code") == SPAN_STATUS_ERROR else ""
+        lines.append(f"{start_ms:9.1f}ms {duration_ms:9.1f}ms  {'  ' * depth}{span['name']}{error}  {attributes}")
+        for child in sorted(children.get(span["spanId"], []), key=lambda item: int(item["startTimeUnixNano"])):
+            visit(child, depth + 1)
+    
+    for root in sorted(roots, key=lambda item: int(item["startTimeUnixNano"])):
+        visit(root, 0)
+    return lines
+
+@app.cli.command("trace-report")
+@click.argument("trace_id", required=False)
+def trace_report_command(trace_id: Optional[str] = None):
+    """書き出したスパンからトレースのツリーを表示する（trace_id省略時は最も時間のかかったトレース）"""
+    traces = load_trace_spans(span_exporter.path)
+    if not traces:
+        print(f"スパンがありません: {span_exporter.path}")
+        return
+    if trace_id is None:
+        trace_id = max(traces, key=lambda key: max(int(span["endTimeUnixNano"]) for span in traces[key])
+                       - min(int(span["startTimeUnixNano"]) for span in traces[key]))
+    if trace_id not in traces:
+        print(f"トレースが見つかりません: {trace_id}")
+        return
+    print(f"trace_id={trace_id} ({len(traces[trace_id])}スパン)")
+    print(f"{'開始':>11} {'所要時間':>9}  スパン")
+    for line in format_trace_tree(traces[trace_id]):
+        print(line)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_ENV') == 'development'
     
     print("🚀 金沢AI助手を起動中...")
+    if startup_warmup.enabled:
+        startup_warmup.start()
+    else:
+        cpu_pool.warm_up()
     print(f"📍 http://localhost:{port}")
     
     app.run(host='0.0.0.0', port=port, debug=debug) 
\ No newline at end of file
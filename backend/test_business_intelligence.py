@@ -4,10 +4,565 @@
 新しく追加されたビジネス分析とマーケティング機能をテストします
 """
 
+import argparse
+import os
+import random
+import threading
 import requests
 import json
 import time
-from typing import Dict, Any
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+# 負荷テストで使用するエンドポイントとリクエストペイロード
+LOAD_TEST_ENDPOINTS = {
+    "chat": {
+        "path": "/api/chat",
+        "payloads": [
+            {"message": "金沢でカフェを開業したいのですが、どんなビジネス機会がありますか？"},
+            {"message": "兼六園の営業時間は？"},
+            {"message": "金沢市の人口は？"},
+        ],
+    },
+    "business": {
+        "path": "/api/business/analyze",
+        "payloads": [
+            {"industry": "観光業", "target_area": "金沢"},
+            {"industry": "飲食業", "target_area": "中央区"},
+        ],
+    },
+    "marketing": {
+        "path": "/api/marketing/strategy",
+        "payloads": [
+            {"business_idea": "金沢観光ガイドアプリ", "target_segment": "若年層", "budget_range": "中"},
+            {"business_idea": "地域密着型カフェ", "target_segment": "ファミリー層", "budget_range": "低"},
+        ],
+    },
+    "comprehensive": {
+        "path": "/api/intelligence/comprehensive",
+        "payloads": [
+            {"industry": "観光業", "target_area": "金沢", "budget_range": "中"},
+        ],
+    },
+}
+
+# デフォルトのリクエスト配分（重み）
+DEFAULT_LOAD_MIX = {"chat": 6, "business": 2, "marketing": 1, "comprehensive": 1}
+
+
+def parse_load_mix(mix_text: str) -> Dict[str, int]:
+    """"chat=6,business=2" 形式のリクエスト配分をパース"""
+    mix = {}
+    for item in mix_text.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in LOAD_TEST_ENDPOINTS:
+            raise ValueError(f"不明なエンドポイント名: {name}（{', '.join(LOAD_TEST_ENDPOINTS)}から選択）")
+        try:
+            mix[name] = int(weight) if weight.strip() else 1
+        except ValueError:
+            raise ValueError(f"配分の重みは0以上の整数で指定してください: {item.strip()}") from None
+        if mix[name] < 0:
+            raise ValueError(f"配分の重みは0以上の整数で指定してください: {item.strip()}")
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("リクエスト配分が空です")
+    return mix
+
+
+def load_mix_argument(mix_text: str) -> Dict[str, int]:
+    """--mixの値を検証する（不正な値はargparseの使い方エラーとして表示）"""
+    try:
+        return parse_load_mix(mix_text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    """ソート済みの値から線形補間でパーセンタイルを算出"""
+    if not sorted_values:
+        return 0.0
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    rank = (len(sorted_values) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+# 質問ルーティング評価用のラベル付き質問セット（質問, 意図, 業界, エリア）
+# app.INTENT_TRAINING_QUESTIONS（TF-IDF分類器の学習データ）とは重ならない質問だけで評価する
+LABELED_ROUTING_QUESTIONS = [
+    ("金沢でカフェを開業したいのですが、どんなビジネス機会がありますか？", "business", "飲食業", "金沢"),
+    ("観光業でマーケティング戦略を考えています", "business", "観光業", ""),
+    ("IT企業を金沢で起業する際の市場状況を教えて", "business", "IT業", "金沢"),
+    ("香林坊で飲食店の競合はどれくらい？", "business", "飲食業", "香林坊"),
+    ("東山で観光客向けの事業を始めたい", "business", "観光業", "東山"),
+    ("駅西で介護の事業を立ち上げる際の顧客層は", "business", "介護業", "駅西"),
+    ("小売の売上を伸ばす戦略を知りたい", "business", "小売業", ""),
+    ("武蔵で教育サービスの起業を検討中", "business", "教育業", "武蔵"),
+    ("医療分野の市場規模を教えて", "business", "医療業", ""),
+    ("中央区で製造業の商売は成り立つ？", "business", "製造業", "中央区"),
+    ("香林坊にカフェを出店したら採算は取れる？", "business", "飲食業", "香林坊"),
+    ("東山で着物レンタルの観光ショップを開店したい", "business", "観光業", "東山"),
+    ("駅西で飲食店を経営したい", "business", "飲食業", "駅西"),
+    ("建設関係で新しく会社を立ち上げたい", "business", "建設業", ""),
+    ("兼六園の入園料はいくら？", "general", None, ""),
+    ("金沢市の世帯数を知りたい", "general", None, "金沢"),
+    ("雨の日でも楽しめる観光地はある？", "general", "観光業", ""),
+    ("金沢市の公園一覧", "general", None, "金沢"),
+    ("粗大ごみの収集日はいつ？", "general", None, ""),
+    ("金沢駅から近江町市場までのバス", "general", None, "金沢"),
+    ("市役所の営業時間は？", "general", None, ""),
+    ("東山のおいしいカフェはどこ？", "general", "飲食業", "東山"),
+    ("医療費の助成制度について教えて", "general", "医療業", ""),
+    ("西区の図書館の場所は？", "general", None, "西区"),
+]
+
+
+def _legacy_classify_question(question: str) -> Dict[str, Any]:
+    """従来のキーワード線形走査による判定（ベンチマーク比較用）"""
+    import app
+    intent = "business" if any(keyword in question for keyword in app.BUSINESS_KEYWORDS) else "general"
+    industry = None
+    for keyword, industry_val in app.INDUSTRY_KEYWORDS.items():
+        if keyword in question.lower():
+            industry = industry_val
+            break
+    area = ""
+    for area_val in app.AREA_KEYWORDS:
+        if area_val in question:
+            area = area_val
+            break
+    return {"intent": intent, "industry": industry, "area": area}
+
+
+def run_router_benchmark(iterations: int = 200) -> Dict[str, Any]:
+    """質問ルーティングの精度とスループットを従来方式と比較（サーバー不要）"""
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")  # LLMは呼ばないためダミーキーで読み込む
+    import app
+    
+    training = {text for text, _ in app.INTENT_TRAINING_QUESTIONS}
+    overlap = [question for question, *_ in LABELED_ROUTING_QUESTIONS if question in training]
+    if overlap:
+        raise ValueError(f"評価用の質問が学習データと重複しています: {overlap}")
+    
+    methods = {
+        "legacy_keyword_scan": _legacy_classify_question,
+        "keyword_matcher": app.QuestionClassifier(use_tfidf=False).classify,
+        "keyword_matcher_tfidf": app.QuestionClassifier().classify
+    }
+    results = {}
+    
+    for name, classify in methods.items():
+        correct = {"intent": 0, "industry": 0, "area": 0, "all": 0}
+        for question, intent, industry, area in LABELED_ROUTING_QUESTIONS:
+            predicted = classify(question)
+            hits = {
+                "intent": predicted["intent"] == intent,
+                "industry": predicted["industry"] == industry,
+                "area": predicted["area"] == area
+            }
+            for key, hit in hits.items():
+                correct[key] += hit
+            correct["all"] += all(hits.values())
+        
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for question, *_ in LABELED_ROUTING_QUESTIONS:
+                classify(question)
+        elapsed = time.perf_counter() - started
+        total = iterations * len(LABELED_ROUTING_QUESTIONS)
+        
+        results[name] = {
+            "accuracy": {key: round(value / len(LABELED_ROUTING_QUESTIONS), 3) for key, value in correct.items()},
+            "questions_per_second": round(total / elapsed, 1),
+            "microseconds_per_question": round(elapsed / total * 1_000_000, 1)
+        }
+    
+    print(f"\n🧭 質問ルーティング ベンチマーク（学習データと重ならない{len(LABELED_ROUTING_QUESTIONS)}問で評価）")
+    print(f"{'方式':<22}{'意図':>7}{'業界':>7}{'エリア':>7}{'全一致':>7}{'質問/秒':>12}")
+    for name, result in results.items():
+        accuracy = result["accuracy"]
+        print(f"{name:<22}{accuracy['intent']:>7.0%}{accuracy['industry']:>7.0%}{accuracy['area']:>7.0%}"
+              f"{accuracy['all']:>7.0%}{result['questions_per_second']:>12,.0f}")
+    return {"timestamp": datetime.now().isoformat(), "labelled_questions": len(LABELED_ROUTING_QUESTIONS),
+            "held_out": True, "results": results}
+
+
+def _representative_payloads() -> Dict[str, Any]:
+    """シリアライズ計測用の代表的なレスポンス（保存済みの総合分析結果があればそれを使用）"""
+    idea = {
+        "name": "金箔×珈琲 ひがし茶屋街ナイトカフェ",
+        "concept": "伝統工芸と夜の茶屋街を結ぶ体験型カフェ。" * 12,
+        "services": "金箔貼り体験、加賀棒茶ラテ、地元作家の器で提供するスイーツ。" * 8,
+        "target_persona": "30代の国内外観光客、SNSで体験を共有する層。" * 5,
+        "revenue_model": "飲食売上、体験料金、器・金箔グッズ販売、法人向け貸切。" * 6,
+        "success_keys": "地元工房との連携とナイトタイムの集客導線。" * 6,
+        "feasibility_score": 8,
+        "expected_roi": 18.5,
+        "market_potential": "年間観光客数と夜間消費の伸びから高い需要が見込める。" * 6,
+        "swot": {key: "分析テキスト" * 20 for key in ["strengths", "weaknesses", "opportunities", "threats"]}
+    }
+    comprehensive = {
+        "success": True,
+        "analysis_timestamp": datetime.now().isoformat(),
+        "business_analysis": {
+            "success": True,
+            "market_analysis": {
+                "market_size_score": 85,
+                "actual_metrics": {"population": "462,361人", "business_establishments": "23,456件"},
+                "key_indicators": [{"title": f"経済センサス 事業所数 {i}", "relevance_score": 60, "data_quality": "高"} for i in range(5)],
+                "numerical_insights": {"data_points_found": 120, "categories_covered": ["人口統計", "事業統計"]}
+            },
+            "demographic_insights": {"target_segments": [{"segment": "高齢者層（65歳以上）", "market_potential_score": 60}]},
+            "competition_analysis": {"competition_level": "中", "business_density_score": 45},
+            "business_ideas": [idea] * 3
+        },
+        "marketing_strategies": [
+            {"business_idea": idea["name"], "strategy": {"marketing_strategy": {"strategy_overview": "施策の詳細。" * 400}}}
+        ] * 2
+    }
+    extracted_values = [
+        {"category": "population", "value": 1000.0 + i, "unit": "人", "context": "年齢別人口（町丁別）", "raw_match": f"{1000 + i}人"}
+        for i in range(400)
+    ]
+    numerical_insights = {"population_data": {"total_population": 462361.0}, "extracted_values": extracted_values,
+                          "summary": {"data_points_found": 400}}
+    extract_numbers = {
+        "success": True,
+        "professional_analysis": {"detailed_insights": numerical_insights},
+        "raw_data": numerical_insights
+    }
+    payloads = {"comprehensive_synthetic": comprehensive, "extract_numbers_synthetic": extract_numbers}
+    
+    if os.path.exists('comprehensive_analysis_result.json'):
+        with open('comprehensive_analysis_result.json', encoding='utf-8') as f:
+            payloads["comprehensive_saved"] = json.load(f)
+    return payloads
+
+
+def run_serialization_benchmark(iterations: int = 100) -> Dict[str, Any]:
+    """標準json（Flask既定）とorjson、gzip/brotli圧縮のサイズと所要時間を比較（サーバー不要）"""
+    import gzip
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    
+    def measure(func) -> Tuple[Any, float]:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            result = func()
+        return result, (time.perf_counter() - started) / iterations * 1000
+    
+    results = {}
+    for name, payload in _representative_payloads().items():
+        # Flask既定のDefaultJSONProviderと同じ設定（ensure_ascii, sort_keys, コンパクト区切り）
+        stdlib_body, stdlib_ms = measure(lambda: json.dumps(payload, ensure_ascii=True, sort_keys=True, separators=(",", ":")).encode())
+        result = {"stdlib_json": {"bytes": len(stdlib_body), "serialize_ms": round(stdlib_ms, 3)}}
+        
+        body = stdlib_body
+        if orjson:
+            body, orjson_ms = measure(lambda: orjson.dumps(payload))
+            result["orjson"] = {"bytes": len(body), "serialize_ms": round(orjson_ms, 3)}
+        
+        gzip_body, gzip_ms = measure(lambda: gzip.compress(body, compresslevel=6))
+        result["gzip"] = {"bytes": len(gzip_body), "compress_ms": round(gzip_ms, 3)}
+        if brotli:
+            br_body, br_ms = measure(lambda: brotli.compress(body, quality=5))
+            result["brotli"] = {"bytes": len(br_body), "compress_ms": round(br_ms, 3)}
+        results[name] = result
+    
+    print("\n📦 シリアライズ・圧縮 ベンチマーク")
+    for name, result in results.items():
+        print(f"\n[{name}]")
+        for method, stats in result.items():
+            timing = stats.get("serialize_ms", stats.get("compress_ms"))
+            ratio = stats["bytes"] / result["stdlib_json"]["bytes"]
+            print(f"  {method:<12}{stats['bytes']:>10,}バイト ({ratio:>6.1%}){timing:>10.3f}ms")
+    return {"timestamp": datetime.now().isoformat(), "iterations": iterations, "results": results}
+
+
+def _synthetic_resource_body(seed: int, size: int) -> str:
+    """数値抽出の対象になる、人口・事業所・観光の数値を含むCSV風テキスト"""
+    rng = random.Random(seed)
+    lines = ["地区,人口,事業所数,観光客数,売上"]
+    length = 0
+    while length < size:
+        line = (f"地区{rng.randint(1, 999)},人口：{rng.randint(100, 99999):,}人,事業所数：{rng.randint(1, 999)},"
+                f"観光客数：{rng.randint(1000, 999999):,},売上：{rng.randint(1, 9999):,}万円")
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def run_cpu_pool_benchmark(bodies: int = 32, body_kb: int = 256) -> Dict[str, Any]:
+    """数値抽出をスレッドで実行した場合（プール無効時）と、CPUワーカープールのワーカー数別のスループットを比較（サーバー不要）"""
+    import asyncio
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")  # LLMは呼ばないためダミーキーで読み込む
+    import app
+    
+    texts = [_synthetic_resource_body(seed, body_kb * 1024) for seed in range(bodies)]
+    total_mb = sum(len(text.encode("utf-8")) for text in texts) / 1024 / 1024
+    cpu_count = os.cpu_count() or 1
+    worker_counts = sorted({0, 1, cpu_count} | {n for n in (2, 4, 8) if n <= cpu_count})
+    
+    async def measure(pool) -> Tuple[float, float]:
+        # 処理中にイベントループがどれだけ止まるか（5ms間隔のタイマーの最大遅れ）を同時に計測
+        max_lag = 0.0
+        done = asyncio.Event()
+        
+        async def ticker():
+            nonlocal max_lag
+            while not done.is_set():
+                expected = time.perf_counter() + 0.005
+                await asyncio.sleep(0.005)
+                max_lag = max(max_lag, time.perf_counter() - expected)
+        
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await asyncio.gather(*(pool.run(app.extract_numbers_from_text, text, f"bench{i}") for i, text in enumerate(texts)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await tick
+        return elapsed, max_lag
+    
+    results = {}
+    for workers in worker_counts:
+        pool = app.CPUWorkPool(workers=workers, max_pending=bodies)
+        pool.warm_up()
+        elapsed, max_lag = asyncio.run(measure(pool))
+        pool.shutdown(wait=True)  # 終了処理中にプールの管理スレッドが閉じたパイプへ書き込まないよう待つ
+        results["thread" if workers == 0 else f"workers_{workers}"] = {
+            "workers": workers,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_mb_per_second": round(total_mb / elapsed, 2),
+            "max_event_loop_lag_ms": round(max_lag * 1000, 1)
+        }
+    
+    baseline = results["thread"]["elapsed_seconds"]
+    print(f"\n🧮 CPUワーカープール ベンチマーク（{bodies}件 × {body_kb}KB = {total_mb:.1f}MB, CPU {cpu_count}コア）")
+    for name, result in results.items():
+        result["speedup"] = round(baseline / result["elapsed_seconds"], 2)
+        print(f"  {name:<12}{result['elapsed_seconds']:>8.2f}秒 {result['throughput_mb_per_second']:>8.2f}MB/s "
+              f"x{result['speedup']:<5} ループ最大遅延 {result['max_event_loop_lag_ms']:>8.1f}ms")
+    return {"timestamp": datetime.now().isoformat(), "bodies": bodies, "body_kb": body_kb,
+            "cpu_count": cpu_count, "results": results}
+
+
+class FakeLLMClient:
+    """出力トークン数に比例して応答が遅くなるChat Completions互換の偽クライアント（ベンチマーク用）"""
+    
+    def __init__(self, count_tokens, first_token_seconds: float = 0.4, seconds_per_token: float = 0.012,
+                 idea_chars: int = 320):
+        from types import SimpleNamespace
+        self.namespace = SimpleNamespace
+        self.count_tokens = count_tokens
+        self.first_token_seconds = first_token_seconds
+        self.seconds_per_token = seconds_per_token
+        self.idea_chars = idea_chars
+        self.chat = SimpleNamespace(completions=self)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+    
+    def _idea(self, number: int) -> Dict[str, Any]:
+        filler = "金沢の伝統と新しい体験を組み合わせた提案です。" * (self.idea_chars // 96 + 1)
+        text = filler[: self.idea_chars // 6]
+        return {
+            "name": f"金沢アイデア{number}号", "concept": text, "services": text, "target_persona": text,
+            "revenue_model": text, "success_keys": text, "feasibility_score": 8, "expected_roi": 15,
+            "market_potential": text,
+            "swot": {"strengths": "強み", "weaknesses": "弱み", "opportunities": "機会", "threats": "脅威"}
+        }
+    
+    def create(self, **kwargs: Any):
+        schema = kwargs["response_format"]["json_schema"]["name"]
+        with self.lock:
+            self.calls += 1
+            number = self.calls
+            self.input_tokens += sum(self.count_tokens(m["content"]) for m in kwargs["messages"])
+        if schema == "business_ideas":
+            text = json.dumps({"ideas": [self._idea(number * 10 + i) for i in range(3)]}, ensure_ascii=False)
+        else:
+            text = json.dumps(self._idea(number), ensure_ascii=False)
+        tokens = self.count_tokens(text)
+        with self.lock:
+            self.output_tokens += tokens
+        if kwargs.get("stream"):
+            return self._stream(text, tokens)
+        time.sleep(self.first_token_seconds + tokens * self.seconds_per_token)
+        message = self.namespace(content=text)
+        usage = self.namespace(prompt_tokens=0, completion_tokens=tokens, total_tokens=tokens)
+        return self.namespace(choices=[self.namespace(message=message)], usage=usage)
+    
+    def _stream(self, text: str, tokens: int):
+        # 約10トークンずつ、生成にかかる時間だけ待ってから返す
+        time.sleep(self.first_token_seconds)
+        pieces = max(1, tokens // 10)
+        step = -(-len(text) // pieces)
+        for start in range(0, len(text), step):
+            time.sleep(tokens / pieces * self.seconds_per_token)
+            delta = self.namespace(content=text[start:start + step])
+            yield self.namespace(choices=[self.namespace(delta=delta)])
+
+
+def run_idea_generation_benchmark(rounds: int = 2, seconds_per_token: float = 0.012) -> Dict[str, Any]:
+    """ビジネスアイデア生成の1回呼び出し（single）と切り口別の並列生成（parallel）の所要時間とトークン数を比較（サーバー不要）"""
+    import asyncio
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")  # 偽クライアントに差し替えるためダミーキーで読み込む
+    import app
+    
+    engine = app.BusinessIntelligenceEngine()
+    market = {"market_size_score": 70, "growth_potential_score": 60, "estimated_roi_percentage": 15,
+              "analysis_confidence": "中", "actual_metrics": {"population": "約46万人"}}
+    demographics = {"primary_target_recommendation": "20-40代", "population_trend": "横ばい"}
+    competition = {"competition_level": "中", "market_entry_difficulty": 5, "recommended_strategy": "差別化戦略"}
+    original_client, original_mode = app.client, app.BUSINESS_IDEAS_MODE
+    
+    results = {}
+    try:
+        for mode in ("single", "parallel"):
+            fake = FakeLLMClient(app.count_tokens, seconds_per_token=seconds_per_token)
+            app.client, app.BUSINESS_IDEAS_MODE = fake, mode
+            timings = []
+            ideas = []
+            for _ in range(rounds):
+                started = time.perf_counter()
+                ideas = asyncio.run(engine._generate_business_ideas(market, demographics, competition, "飲食業", "香林坊"))
+                timings.append(time.perf_counter() - started)
+            results[mode] = {
+                "avg_seconds": round(sum(timings) / len(timings), 2),
+                "ideas": len(ideas),
+                "llm_calls_per_request": fake.calls // rounds,
+                "input_tokens_per_request": fake.input_tokens // rounds,
+                "output_tokens_per_request": fake.output_tokens // rounds
+            }
+    finally:
+        app.client, app.BUSINESS_IDEAS_MODE = original_client, original_mode
+    
+    single, parallel = results["single"], results["parallel"]
+    print(f"\n💡 ビジネスアイデア生成 ベンチマーク（偽LLM: {seconds_per_token * 1000:.0f}ms/トークン, {rounds}回平均）")
+    for mode, result in results.items():
+        print(f"  {mode:<10}{result['avg_seconds']:>7.2f}秒  アイデア{result['ideas']}件  呼び出し{result['llm_calls_per_request']}回  "
+              f"入力{result['input_tokens_per_request']:>6,}トークン  出力{result['output_tokens_per_request']:>6,}トークン")
+    print(f"  速度向上: x{single['avg_seconds'] / parallel['avg_seconds']:.2f}  "
+          f"入力トークン: x{parallel['input_tokens_per_request'] / max(single['input_tokens_per_request'], 1):.2f}")
+    return {"timestamp": datetime.now().isoformat(), "rounds": rounds,
+            "seconds_per_token": seconds_per_token, "results": results}
+
+
+class RespStandInServer:
+    """キャッシュ検証用のRedisプロトコル互換スタンドイン（GET/SET/DEL/PING/AUTH/SELECTのみ対応）"""
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        import socketserver
+        store: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        lock = threading.Lock()
+        
+        class Handler(socketserver.StreamRequestHandler):
+            def read_command(self) -> Optional[List[bytes]]:
+                header = self.rfile.readline()
+                if not header:
+                    return None
+                args = []
+                for _ in range(int(header[1:-2])):
+                    length = int(self.rfile.readline()[1:-2])
+                    args.append(self.rfile.read(length + 2)[:-2])
+                return args
+            
+            def handle(self) -> None:
+                while True:
+                    args = self.read_command()
+                    if args is None:
+                        return
+                    name = args[0].upper()
+                    with lock:
+                        if name == b"GET":
+                            value, expires_at = store.get(args[1], (None, None))
+                            if value is not None and expires_at is not None and expires_at < time.time():
+                                value = store.pop(args[1])[0] and None
+                            reply = b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+                        elif name == b"SET":
+                            ttl = int(args[4]) / 1000 if len(args) >= 5 and args[3].upper() == b"PX" else None
+                            store[args[1]] = (args[2], time.time() + ttl if ttl else None)
+                            reply = b"+OK\r\n"
+                        elif name == b"DEL":
+                            reply = b":%d\r\n" % int(store.pop(args[1], None) is not None)
+                        elif name == b"PING":
+                            reply = b"+PONG\r\n"
+                        elif name in (b"AUTH", b"SELECT"):
+                            reply = b"+OK\r\n"
+                        else:
+                            reply = b"-ERR unknown command\r\n"
+                    self.wfile.write(reply)
+        
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"redis://{host}:{self.server.server_address[1]}/0"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_cache_benchmark(iterations: int = 200) -> Dict[str, Any]:
+    """キャッシュバックエンド（memory / sqlite / redis）の読み書き時間と圧縮率を比較（サーバー不要）"""
+    import tempfile
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")  # LLMは呼ばないためダミーキーで読み込む
+    import app
+    
+    # CACHE_REDIS_URLがなければローカルのスタンドインで計測
+    stand_in = None if os.getenv("CACHE_REDIS_URL") else RespStandInServer()
+    tmpdir = tempfile.mkdtemp()
+    backends = {
+        "memory": app.MemoryCacheBackend(),
+        "sqlite": app.SQLiteCacheBackend(os.path.join(tmpdir, "bench.sqlite3")),
+        "redis": app.RedisCacheBackend(os.getenv("CACHE_REDIS_URL") or stand_in.url)
+    }
+    payloads = _representative_payloads()
+    results = {}
+    try:
+        for name, backend in backends.items():
+            cache = app.SharedCache(backend, version="bench")
+            for index, payload in enumerate(payloads.values()):
+                cache.set("bench", index, payload, ttl=60)  # 接続確立・テーブル作成を計測から除く
+            started = time.perf_counter()
+            for i in range(iterations):
+                for index, payload in enumerate(payloads.values()):
+                    cache.set("bench", (i, index), payload, ttl=60)
+            set_ms = (time.perf_counter() - started) / (iterations * len(payloads)) * 1000
+            started = time.perf_counter()
+            for i in range(iterations):
+                for index in range(len(payloads)):
+                    assert cache.get("bench", (i, index)) is not None
+            get_ms = (time.perf_counter() - started) / (iterations * len(payloads)) * 1000
+            snapshot = cache.snapshot()
+            results[name] = {
+                "set_ms": round(set_ms, 3),
+                "get_ms": round(get_ms, 3),
+                "compression_ratio": snapshot["compression_ratio"],
+                "errors": snapshot["errors"]
+            }
+    finally:
+        if stand_in:
+            stand_in.close()
+    
+    print("\n🗄️ キャッシュバックエンド ベンチマーク" + (" (Redisはローカルのスタンドイン)" if stand_in else ""))
+    print(f"{'バックエンド':<10}{'set(ms)':>10}{'get(ms)':>10}{'圧縮率':>10}")
+    for name, result in results.items():
+        print(f"{name:<12}{result['set_ms']:>10.3f}{result['get_ms']:>10.3f}{result['compression_ratio']:>10.1%}")
+    return {"timestamp": datetime.now().isoformat(), "iterations": iterations, "results": results}
+
 
 class BusinessIntelligenceTester:
     """ビジネスインテリジェンス機能のテスター"""
@@ -165,21 +720,156 @@ class BusinessIntelligenceTester:
             
             time.sleep(2)
     
-    def run_all_tests(self) -> None:
-        """全テストを実行"""
-        print("🎉 金沢ビジネスインテリジェンス機能テスト開始！")
-        print("=" * 60)
+
+    def run_load_test(self, concurrency: int = 4, ramp_up: float = 10.0, duration: float = 60.0,
+                      mix: Optional[Dict[str, int]] = None, timeout: float = 60.0) -> Dict[str, Any]:
+        """並行ユーザーによる負荷テストを実行し、結果レポートを返す"""
+        mix = mix or DEFAULT_LOAD_MIX
+        print(f"🔥 負荷テスト開始: 並行数={concurrency}, ランプアップ={ramp_up}秒, 実行時間={duration}秒")
+        print(f"   リクエスト配分: {mix}")
+        
+        samples: List[Dict[str, Any]] = []
+        samples_lock = threading.Lock()
+        started_at = time.monotonic()
+        deadline = started_at + ramp_up + duration
+        
+        workers = []
+        for worker_id in range(concurrency):
+            # ランプアップ期間中に均等な間隔でワーカーを起動
+            start_delay = ramp_up * worker_id / concurrency if concurrency > 0 else 0
+            worker = threading.Thread(
+                target=self._load_worker,
+                args=(worker_id, start_delay, started_at, deadline, mix, timeout, samples, samples_lock),
+                daemon=True
+            )
+            workers.append(worker)
+            worker.start()
+        
+        for worker in workers:
+            worker.join()
+        
+        elapsed = time.monotonic() - started_at
+        report = self._summarize_load_results(samples, elapsed)
+        report["config"] = {
+            "base_url": self.base_url,
+            "concurrency": concurrency,
+            "ramp_up_seconds": ramp_up,
+            "duration_seconds": duration,
+            "mix": mix,
+            "timeout_seconds": timeout
+        }
+        return report
+    
+    def _load_worker(self, worker_id: int, start_delay: float, started_at: float, deadline: float,
+                     mix: Dict[str, int], timeout: float, samples: List[Dict[str, Any]],
+                     samples_lock: threading.Lock) -> None:
+        """負荷テスト用ワーカー：締め切りまで配分に従ってリクエストを送り続ける"""
+        rng = random.Random(worker_id)
+        names = list(mix.keys())
+        weights = [mix[name] for name in names]
+        session = requests.Session()
+        
+        time.sleep(max(0.0, started_at + start_delay - time.monotonic()))
+        
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights=weights)[0]
+            endpoint = LOAD_TEST_ENDPOINTS[name]
+            payload = rng.choice(endpoint["payloads"])
+            
+            sample = {"endpoint": name, "started": time.monotonic() - started_at}
+            request_start = time.perf_counter()
+            try:
+                response = session.post(f"{self.base_url}{endpoint['path']}", json=payload, timeout=timeout)
+                sample["status"] = response.status_code
+                sample["ok"] = 200 <= response.status_code < 300
+                sample["bytes"] = len(response.content)
+            except Exception as e:
+                sample["status"] = None
+                sample["ok"] = False
+                sample["error"] = type(e).__name__
+            sample["latency"] = time.perf_counter() - request_start
+            
+            with samples_lock:
+                samples.append(sample)
         
-        # サーバーの生存確認
+        session.close()
+    
+    def _summarize_load_results(self, samples: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+        """負荷テストのサンプルからレイテンシ・エラー率・スループットを集計"""
+        def summarize(group: List[Dict[str, Any]]) -> Dict[str, Any]:
+            latencies = sorted(sample["latency"] for sample in group)
+            errors = [sample for sample in group if not sample["ok"]]
+            status_counts: Dict[str, int] = {}
+            for sample in group:
+                key = str(sample["status"]) if sample["status"] is not None else sample.get("error", "error")
+                status_counts[key] = status_counts.get(key, 0) + 1
+            return {
+                "requests": len(group),
+                "errors": len(errors),
+                "error_rate": round(len(errors) / len(group), 4) if group else 0.0,
+                "throughput_rps": round(len(group) / elapsed, 3) if elapsed > 0 else 0.0,
+                "latency_ms": {
+                    "min": round(latencies[0] * 1000, 1) if latencies else 0.0,
+                    "mean": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+                    "p50": round(_percentile(latencies, 50) * 1000, 1),
+                    "p90": round(_percentile(latencies, 90) * 1000, 1),
+                    "p95": round(_percentile(latencies, 95) * 1000, 1),
+                    "p99": round(_percentile(latencies, 99) * 1000, 1),
+                    "max": round(latencies[-1] * 1000, 1) if latencies else 0.0
+                },
+                "status_counts": status_counts
+            }
+        
+        endpoints = {}
+        for name in LOAD_TEST_ENDPOINTS:
+            group = [sample for sample in samples if sample["endpoint"] == name]
+            if group:
+                endpoints[name] = summarize(group)
+        
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "elapsed_seconds": round(elapsed, 2),
+            "overall": summarize(samples),
+            "endpoints": endpoints
+        }
+    
+    def print_load_report(self, report: Dict[str, Any]) -> None:
+        """負荷テスト結果を表形式で表示"""
+        print("\n" + "=" * 60)
+        print(f"📈 負荷テスト結果（経過時間: {report['elapsed_seconds']}秒）")
+        print(f"{'エンドポイント':<16}{'件数':>6}{'エラー率':>9}{'RPS':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+        rows = list(report["endpoints"].items()) + [("合計", report["overall"])]
+        for name, stats in rows:
+            latency = stats["latency_ms"]
+            print(f"{name:<16}{stats['requests']:>6}{stats['error_rate']:>9.1%}{stats['throughput_rps']:>8.2f}"
+                  f"{latency['p50']:>9.0f}{latency['p95']:>9.0f}{latency['p99']:>9.0f}")
+        print("（レイテンシの単位: ミリ秒）")
+    
+    def export_load_report(self, report: Dict[str, Any], path: str) -> None:
+        """負荷テスト結果をトレンド分析用にJSONで保存"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 負荷テスト結果を {path} に保存")
+    
+    def check_server(self) -> bool:
+        """サーバーの生存確認"""
         try:
             response = requests.get(f"{self.base_url}/api/health", timeout=5)
             if response.status_code == 200:
                 print("✅ サーバー接続確認完了")
-            else:
-                print("❌ サーバーに接続できません")
-                return
+                return True
+            print("❌ サーバーに接続できません")
+            return False
         except Exception as e:
             print(f"❌ サーバー接続エラー: {e}")
+            return False
+    
+    def run_all_tests(self) -> None:
+        """全テストを実行"""
+        print("🎉 金沢ビジネスインテリジェンス機能テスト開始！")
+        print("=" * 60)
+        
+        if not self.check_server():
             return
         
         # 各テストを実行
@@ -193,11 +883,45 @@ class BusinessIntelligenceTester:
 
 def main():
     """メイン関数"""
+    parser = argparse.ArgumentParser(description="金沢ビジネスインテリジェンス機能テスター")
+    parser.add_argument("--base-url", default="http://localhost:5000", help="テスト対象サーバーのURL")
+    parser.add_argument("--load", action="store_true", help="機能テストの代わりに負荷テストを実行")
+    parser.add_argument("--concurrency", type=int, default=4, help="負荷テストの並行ユーザー数")
+    parser.add_argument("--ramp-up", type=float, default=10.0, help="全ユーザーが起動するまでの秒数")
+    parser.add_argument("--duration", type=float, default=60.0, help="ランプアップ後の負荷継続秒数")
+    parser.add_argument("--mix", type=load_mix_argument, default=None, help="リクエスト配分 例: chat=6,business=2,marketing=1,comprehensive=1")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1リクエストあたりのタイムアウト秒数")
+    parser.add_argument("--export", default=None, help="負荷テスト・ベンチマーク結果を保存するJSONファイルパス")
+    parser.add_argument("--bench", choices=["router", "serialization", "cache", "cpu-pool", "ideas"], default=None,
+                        help="サーバーを使わないローカルベンチマークを実行")
+    args = parser.parse_args()
+    
+    if args.bench:
+        benchmarks = {"router": run_router_benchmark, "serialization": run_serialization_benchmark,
+                      "cache": run_cache_benchmark, "cpu-pool": run_cpu_pool_benchmark,
+                      "ideas": run_idea_generation_benchmark}
+        report = benchmarks[args.bench]()
+        if args.export:
+            with open(args.export, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"📄 ベンチマーク結果を {args.export} に保存")
+        return
+    
     print("金沢ビジネスインテリジェンス機能テスター")
-    print("使用方法: python test_business_intelligence.py")
-    print("注意: サーバーが http://localhost:5000 で起動している必要があります\n")
+    print("使用方法: python test_business_intelligence.py [--load --concurrency 8 --duration 120 --export load.json]")
+    print(f"注意: サーバーが {args.base_url} で起動している必要があります\n")
+    
+    tester = BusinessIntelligenceTester(args.base_url)
+    
+    if args.load:
+        if not tester.check_server():
+            return
+        report = tester.run_load_test(args.concurrency, args.ramp_up, args.duration, args.mix, args.timeout)
+        tester.print_load_report(report)
+        if args.export:
+            tester.export_load_report(report, args.export)
+        return
     
-    tester = BusinessIntelligenceTester()
     tester.run_all_tests()
 
 if __name__ == "__main__":